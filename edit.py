@@ -11,7 +11,7 @@ gi.require_version('Gtk', '3.0')
 gi.require_version('GtkSource', '3.0')
 
 import argparse
-from gi.repository import Gtk, Gdk
+from gi.repository import GLib, Gtk, Gdk
 from graph.source_graph import SourceGraph
 import logging
 import os.path
@@ -19,6 +19,7 @@ import signal
 import sys
 from typing import List
 from ui.main_window import MainWindow
+from workspace.watcher import InotifyWatcher
 from workspace.workspace import Workspace, initialize_workspace
 
 log = logging.getLogger(__name__)
@@ -28,8 +29,24 @@ def open_workspace(args:argparse.Namespace) -> Workspace:
         initialize_workspace(args.workspace)
     if not os.path.isdir(args.workspace):
         log.warn( 'Workspace doesn\'t exist: {}'.format(args.workspace))
-    return Workspace(args.workspace)
+    # Paint from the last listing; start_reload() brings it up to date
+    return Workspace(args.workspace, crawl=False)
     
+def watch_files(ws:Workspace) -> None:
+    '''
+    Keep the workspace file list up to date, if possible.
+    '''
+    if not ws.watch_files:
+        return
+    watcher = InotifyWatcher.create(ws)
+    if not watcher:
+        return
+    def on_events(_fd:int, _cond:GLib.IOCondition) -> bool:
+        watcher.process_events()
+        return True
+    GLib.io_add_watch(
+        watcher.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, on_events)
+
 def load_css(ws:Workspace) -> None:
     '''
     Check if an override stylesheet exists, and apply it if it does.
@@ -59,13 +76,25 @@ def main(argv:List[str]) -> None:
     args = parser.parse_args(argv)
     
     workspace = open_workspace(args)
-    src_graph = SourceGraph(workspace)
+    watch_files(workspace)
+    # Either way, the graph fills in while the window is up
+    src_graph = SourceGraph(workspace, lazy=workspace.lazy_graph,
+        compact=workspace.compact_graph, background=True)
  
     load_css(workspace)
     win = MainWindow(workspace, src_graph)
     win.connect("delete-event", Gtk.main_quit)
     win.show_all()
+
+    dispatch = lambda fn: GLib.idle_add(fn)
+    workspace.start_reload(dispatch)
+    if src_graph.lazy:
+        src_graph.start_importer_index(dispatch)
+    else:
+        src_graph.start_build(dispatch)
     Gtk.main()
+    # Don't lose saves still being written
+    win.edit_pane.save_queue.wait()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+from array import array
+from bisect import bisect_left
+from graph.edge import Edge
+import itertools
+from typing import (
+    Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple)
+from workspace.path import Path
+
+class CSR(object):
+    '''
+    Immutable compressed sparse row adjacency: the neighbours of node u are
+    targets[offsets[u]:offsets[u + 1]], in sorted order.
+    '''
+    __slots__ = ('offsets', 'targets')
+
+    def __init__(self, num_nodes:int, pairs:Iterable[Tuple[int, int]]) -> None:
+        buckets: List[List[int]] = [[] for _ in range(num_nodes)]
+        for u, v in pairs:
+            buckets[u].append(v)
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        for b in buckets:
+            if b:
+                self.targets.extend(sorted(set(b)))
+            self.offsets.append(len(self.targets))
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def neighbours(self, u:int) -> Sequence[int]:
+        if u + 1 >= len(self.offsets):
+            return ()
+        return self.targets[self.offsets[u]:self.offsets[u + 1]]
+
+    def has(self, u:int, v:int) -> bool:
+        if u + 1 >= len(self.offsets):
+            return False
+        hi = self.offsets[u + 1]
+        i = bisect_left(self.targets, v, self.offsets[u], hi)
+        return i < hi and self.targets[i] == v
+
+    def pairs(self) -> Iterator[Tuple[int, int]]:
+        offsets, targets = self.offsets, self.targets
+        for u in range(len(offsets) - 1):
+            for i in range(offsets[u], offsets[u + 1]):
+                yield u, targets[i]
+
+class Adjacency(object):
+    '''
+    One direction of the edges of one type.  A CSR base, plus added and
+    removed edges since it was built.  The changes are folded into a new base
+    once they outgrow it, so the cost of updates is amortized O(1).
+    '''
+    MIN_COMPACT = 1024
+
+    def __init__(self) -> None:
+        self.base = CSR(0, [])
+        self._added: Dict[int, Set[int]] = {}
+        self._removed: Dict[int, Set[int]] = {}
+        self._changes = 0
+
+    def __len__(self) -> int:
+        return (len(self.base) + sum(len(s) for s in self._added.values()) -
+            sum(len(s) for s in self._removed.values()))
+
+    def neighbours(self, u:int) -> List[int]:
+        res = list(self.base.neighbours(u))
+        removed = self._removed.get(u)
+        if removed:
+            res = [v for v in res if v not in removed]
+        added = self._added.get(u)
+        if added:
+            res.extend(added)
+        return res
+
+    def has(self, u:int, v:int) -> bool:
+        if v in self._added.get(u, ()):
+            return True
+        return self.base.has(u, v) and v not in self._removed.get(u, ())
+
+    def add(self, u:int, v:int) -> bool:
+        '''
+        @return whether the edge is new
+        '''
+        removed = self._removed.get(u)
+        if removed and v in removed:
+            removed.discard(v)
+        elif self.base.has(u, v) or v in self._added.get(u, ()):
+            return False
+        else:
+            self._added.setdefault(u, set()).add(v)
+        self._changed()
+        return True
+
+    def remove(self, u:int, v:int) -> bool:
+        '''
+        @return whether the edge existed
+        '''
+        added = self._added.get(u)
+        if added and v in added:
+            added.discard(v)
+        elif self.base.has(u, v) and v not in self._removed.get(u, ()):
+            self._removed.setdefault(u, set()).add(v)
+        else:
+            return False
+        self._changed()
+        return True
+
+    def add_all(self, pairs:Iterable[Tuple[int, int]]) -> None:
+        '''
+        Add many edges at once, rebuilding the base.
+        '''
+        pairs = list(pairs)
+        num_nodes = max([len(self.base.offsets) - 1] +
+            [u + 1 for u in self._added] + [u + 1 for u, _ in pairs])
+        self.base = CSR(num_nodes, itertools.chain(self._pairs(), pairs))
+        self._added = {}
+        self._removed = {}
+        self._changes = 0
+
+    def _changed(self) -> None:
+        self._changes += 1
+        if self._changes > max(self.MIN_COMPACT, len(self.base)):
+            self.compact()
+
+    def compact(self) -> None:
+        self.add_all([])
+
+    def _pairs(self) -> Iterator[Tuple[int, int]]:
+        for u, v in self.base.pairs():
+            if v not in self._removed.get(u, ()):
+                yield u, v
+        for u, vs in self._added.items():
+            for v in vs:
+                yield u, v
+
+class NodeView(object):
+    '''
+    A node of an AdjacencyStore, with the outgoing and incoming edge sets of
+    graph.node.Node, built on each access.
+    '''
+    __slots__ = ('store', 'id', 'path', 'imports')
+
+    def __init__(self, store:'AdjacencyStore', id:int, path:Path) -> None:
+        self.store = store
+        self.id = id
+        self.path = path
+        self.imports: Set[Path] = set()
+
+    def __repr__(self) -> str:
+        return 'NodeView({}, {!r})'.format(self.id, self.path)
+
+    @property
+    def outgoing(self) -> Set[Edge]:
+        store = self.store
+        return set(Edge(t, self, store.view(v))
+            for t in store.edge_types for v in store.successors(t, self.id))
+
+    @property
+    def incoming(self) -> Set[Edge]:
+        store = self.store
+        return set(Edge(t, store.view(u), self)
+            for t in store.edge_types for u in store.predecessors(t, self.id))
+
+class AdjacencyStore(object):
+    '''
+    Graph storage with integer node ids, and forward and reverse CSR adjacency
+    for each edge type.  Much more compact than sets of Edges on each node.
+    '''
+
+    def __init__(self) -> None:
+        self._ids: Dict[Path, int] = {}
+        self._views: List[NodeView] = []
+        # edge type -> (forward, reverse)
+        self._edges: Dict[str, Tuple[Adjacency, Adjacency]] = {}
+
+    def __len__(self) -> int:
+        return len(self._views)
+
+    @property
+    def edge_types(self) -> List[str]:
+        return list(self._edges)
+
+    def node(self, path:Path) -> NodeView:
+        '''
+        Get the node for a path, allocating it an id if it's new.
+        '''
+        id = self._ids.get(path)
+        if id is None:
+            id = self._ids[path] = len(self._views)
+            self._views.append(NodeView(self, id, path))
+        return self._views[id]
+
+    def find(self, path:Path) -> Optional[NodeView]:
+        id = self._ids.get(path)
+        return self._views[id] if id is not None else None
+
+    def view(self, id:int) -> NodeView:
+        return self._views[id]
+
+    def num_edges(self, edge_type:str) -> int:
+        edges = self._edges.get(edge_type)
+        return len(edges[0]) if edges else 0
+
+    def successors(self, edge_type:str, u:int) -> List[int]:
+        edges = self._edges.get(edge_type)
+        return edges[0].neighbours(u) if edges else []
+
+    def predecessors(self, edge_type:str, v:int) -> List[int]:
+        edges = self._edges.get(edge_type)
+        return edges[1].neighbours(v) if edges else []
+
+    def has_edge(self, edge_type:str, u:int, v:int) -> bool:
+        edges = self._edges.get(edge_type)
+        return edges[0].has(u, v) if edges else False
+
+    def add_edge(self, edge_type:str, u:int, v:int) -> bool:
+        '''
+        @return whether the edge is new
+        '''
+        edges = self._edges.get(edge_type)
+        if edges is None:
+            edges = self._edges[edge_type] = (Adjacency(), Adjacency())
+        if not edges[0].add(u, v):
+            return False
+        edges[1].add(v, u)
+        return True
+
+    def add_edges(self, edge_type:str, pairs:Iterable[Tuple[int, int]]
+            ) -> None:
+        '''
+        Bulk load (source id, dest id) edges.
+        '''
+        pairs = list(pairs)
+        edges = self._edges.get(edge_type)
+        if edges is None:
+            edges = self._edges[edge_type] = (Adjacency(), Adjacency())
+        edges[0].add_all(pairs)
+        edges[1].add_all((v, u) for u, v in pairs)
+
+    def remove_edge(self, edge_type:str, u:int, v:int) -> bool:
+        '''
+        @return whether the edge existed
+        '''
+        edges = self._edges.get(edge_type)
+        if edges is None or not edges[0].remove(u, v):
+            return False
+        edges[1].remove(v, u)
+        return True
+
+    def compact(self) -> None:
+        '''
+        Fold all changes into the CSR bases.
+        '''
+        for fwd, rev in self._edges.values():
+            fwd.compact()
+            rev.compact()
+
+import random
+import unittest
+
+class AdjacencyTest(unittest.TestCase):
+    def test_csr(self) -> None:
+        c = CSR(4, [(0, 2), (0, 1), (2, 3), (0, 1)])
+        self.assertEqual(list(c.neighbours(0)), [1, 2])
+        self.assertEqual(list(c.neighbours(1)), [])
+        self.assertEqual(list(c.neighbours(7)), [])
+        self.assertTrue(c.has(2, 3))
+        self.assertFalse(c.has(3, 2))
+        self.assertEqual(list(c.pairs()), [(0, 1), (0, 2), (2, 3)])
+
+    def test_matches_sets(self) -> None:
+        rand = random.Random(7)
+        a = Adjacency()
+        a.MIN_COMPACT = 16
+        expected: Dict[int, Set[int]] = {}
+        for _ in range(2000):
+            u, v = rand.randrange(50), rand.randrange(50)
+            if rand.random() < 0.7:
+                self.assertEqual(a.add(u, v), v not in expected.get(u, ()))
+                expected.setdefault(u, set()).add(v)
+            else:
+                self.assertEqual(a.remove(u, v), v in expected.get(u, ()))
+                expected.get(u, set()).discard(v)
+        for u in range(60):
+            self.assertEqual(set(a.neighbours(u)), expected.get(u, set()))
+            self.assertEqual(len(a.neighbours(u)), len(expected.get(u, ())))
+        self.assertEqual(len(a), sum(len(s) for s in expected.values()))
+
+class AdjacencyStoreTest(unittest.TestCase):
+    def test_views(self) -> None:
+        s = AdjacencyStore()
+        a = s.node(Path('/a', '/'))
+        b = s.node(Path('/b', '/'))
+        self.assertIs(s.node(Path('/a', '/')), a)
+        self.assertTrue(s.add_edge('import', a.id, b.id))
+        self.assertFalse(s.add_edge('import', a.id, b.id))
+        self.assertEqual(a.outgoing, set([Edge('import', a, b)]))
+        self.assertEqual(b.incoming, set([Edge('import', a, b)]))
+        self.assertEqual(a.incoming, set())
+        self.assertTrue(s.remove_edge('import', a.id, b.id))
+        self.assertEqual(b.incoming, set())
+        self.assertFalse(s.remove_edge('import', a.id, b.id))
+
+    def test_add_edges(self) -> None:
+        s = AdjacencyStore()
+        a, b, c = [s.node(Path(p, '/')) for p in ['/a', '/b', '/c']]
+        s.add_edge('import', a.id, b.id)
+        s.add_edges('import', [(a.id, c.id), (b.id, c.id), (a.id, b.id)])
+        self.assertEqual(sorted(s.successors('import', a.id)), [b.id, c.id])
+        self.assertEqual(sorted(s.predecessors('import', c.id)), [a.id, b.id])
+        self.assertEqual(s.num_edges('import'), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Compares the memory and time costs of storing a graph as sets of Edges on
+each node against an AdjacencyStore, both bare and as the edges of a whole
+SourceGraph.  Run as:
+    python3 -m graph.adjacency_bench [--edges N ...] [--files N ...]
+'''
+
+import argparse
+import gc
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, List, Set, Tuple
+
+from graph.adjacency import AdjacencyStore
+from graph.edge import Edge, EdgeType
+from graph.node import File
+from graph.source_graph import SourceGraph
+from workspace.path import Path
+from workspace.workspace import Workspace
+
+# Average imports per file
+DEGREE = 10
+
+def random_edges(num_edges:int, seed:int=1) -> Tuple[int, List[Tuple[int, int]]]:
+    num_nodes = max(2, num_edges // DEGREE)
+    rand = random.Random(seed)
+    edges: Set[Tuple[int, int]] = set()
+    while len(edges) < num_edges:
+        edges.add((rand.randrange(num_nodes), rand.randrange(num_nodes)))
+    return num_nodes, list(edges)
+
+def measure(fn:Callable[[], Any]) -> Tuple[float, int, Any]:
+    '''
+    @return (seconds, bytes allocated and still live, result)
+    Timed and traced separately, as tracing slows allocation.
+    '''
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    res = fn()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, size, res
+
+def build_sets(paths:List[Path], edges:List[Tuple[int, int]]) -> List[File]:
+    nodes = [File(p) for p in paths]
+    for u, v in edges:
+        e = Edge(EdgeType.IMPORT, nodes[u], nodes[v])
+        nodes[u].outgoing.add(e)
+        nodes[v].incoming.add(e)
+    return nodes
+
+def build_store(paths:List[Path], edges:List[Tuple[int, int]]
+        ) -> AdjacencyStore:
+    store = AdjacencyStore()
+    for p in paths:
+        store.node(p)
+    store.add_edges(EdgeType.IMPORT, edges)
+    return store
+
+def bench(num_edges:int) -> None:
+    num_nodes, edges = random_edges(num_edges)
+    paths = [Path.canonical('/ws/file{}.py'.format(i), '/ws')
+        for i in range(num_nodes)]
+    print('{} nodes, {} edges'.format(num_nodes, num_edges))
+
+    elapsed, size, nodes = measure(lambda: build_sets(paths, edges))
+    print('  {:<8} build: {:7.3f}s {:9.1f} MB ({:.0f} B/edge)'.format(
+        'sets', elapsed, size / 2**20, size / num_edges))
+    start = time.perf_counter()
+    for n in nodes:
+        for e in n.outgoing:
+            e.dest
+    print('  {:<8} walk:  {:7.3f}s'.format(
+        'sets', time.perf_counter() - start))
+    del nodes
+
+    elapsed, size, store = measure(lambda: build_store(paths, edges))
+    print('  {:<8} build: {:7.3f}s {:9.1f} MB ({:.0f} B/edge)'.format(
+        'store', elapsed, size / 2**20, size / num_edges))
+    start = time.perf_counter()
+    for u in range(num_nodes):
+        for v in store.successors(EdgeType.IMPORT, u):
+            pass
+    print('  {:<8} walk:  {:7.3f}s'.format(
+        'store', time.perf_counter() - start))
+
+    # Incremental updates, as from file saves
+    start = time.perf_counter()
+    for u, v in edges[:10000]:
+        store.remove_edge(EdgeType.IMPORT, u, v)
+        store.add_edge(EdgeType.IMPORT, u, v)
+    print('  {:<8} 10k updates: {:7.3f}s'.format(
+        'store', time.perf_counter() - start))
+
+def bench_graph(num_files:int) -> None:
+    '''
+    Build a SourceGraph of a workspace of num_files modules, with and without
+    compact mode.  Besides the edges, a graph keeps the imports of each file
+    as sets of Paths, in both directions, so the saving is smaller than for a
+    bare store.
+    '''
+    num_nodes, edges = random_edges(num_files * DEGREE)
+    imports: List[List[int]] = [[] for _ in range(num_nodes)]
+    for u, v in edges:
+        imports[u].append(v)
+    root = os.path.realpath(tempfile.mkdtemp())
+    try:
+        ws_dir = os.path.join(root, '.workspace')
+        os.mkdir(ws_dir)
+        with open(os.path.join(ws_dir, 'config'), 'w') as f:
+            f.write('{"python_path": [ "'+root+'" ] }')
+        for u, vs in enumerate(imports):
+            with open(os.path.join(root, 'm{}.py'.format(u)), 'w') as f:
+                f.write(''.join('import m{}\n'.format(v) for v in vs))
+        ws = Workspace(ws_dir)
+        print('SourceGraph: {} files, {} edges'.format(num_nodes, len(edges)))
+        for compact in [False, True]:
+            def build() -> SourceGraph:
+                sg = SourceGraph(ws, compact=compact)
+                ws.file_listeners.remove(sg.files_changed)
+                return sg
+            elapsed, size, _sg = measure(build)
+            print('  {:<8} build: {:7.3f}s {:9.1f} MB ({:.0f} B/edge)'.format(
+                'compact' if compact else 'default', elapsed, size / 2**20,
+                size / len(edges)))
+    finally:
+        shutil.rmtree(root)
+
+def main(argv:List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', '-e', type=int, nargs='+',
+        default=[10000, 100000, 1000000])
+    parser.add_argument('--files', '-f', type=int, nargs='+',
+        default=[5000])
+    args = parser.parse_args(argv)
+    for n in args.edges:
+        bench(n)
+    for n in args.files:
+        bench_graph(n)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,14 +7,19 @@
 # (at your option) any later version.
 
 import argparse
-from graph.db import Sqlite
-from graph.indexer import Indexer
+from graph.cycles import components, index_imports
+from graph.db import FileStamp, Sqlite
+from graph.indexer import Indexer, hash_file
 from graph.parsers.python3 import Py3Parser
+from graph.parsers.resolver import ImportResolver
 import logging
+import os
 import os.path
+import re
 import shutil
 import sys
 from typing import List
+from workspace.grep import Grep, workspace_files
 from workspace.workspace import Workspace
 from workspace.path import Path
 
@@ -33,21 +38,33 @@ def do_create(args:argparse.Namespace) -> None:
     Sqlite(ws.symbol_index, create=True)
     print('Created index in working dir: {}'.format(ws.workspace_dir))
 
+def make_parser(ws:Workspace) -> Py3Parser:
+    return Py3Parser(ws.python_path,
+        ImportResolver(module_map=ws.module_map))
+
 def do_update(args:argparse.Namespace)->None:
     ws = Workspace(args.dir, must_exist=True)
     path = Path(args.path, ws.root_dir)
-    syms, imports = Py3Parser().parse(path)
+    # Stat before parsing, as Indexer does, so update-all can skip the file
+    st = os.stat(path.abs)
+    stamp = FileStamp(st.st_mtime_ns, st.st_size, hash_file(path))
+    syms, imports = make_parser(ws).parse(path)
     db = Sqlite(ws.symbol_index)
     try:
-        db.update_file(path, syms, imports)
+        db.update_file(path, syms, imports, stamp)
     finally:
         db.close()
 
 def do_update_all(args:argparse.Namespace) -> None:
     ws = Workspace(args.dir, must_exist=True)
     db = Sqlite(ws.symbol_index)
-    i = Indexer(ws, db, [Py3Parser()])
-    i.update()
+    try:
+        i = Indexer(ws, db, [make_parser(ws)])
+        stats = i.update(args.jobs)
+    finally:
+        db.close()
+    print('Skipped: {}, Reparsed: {}, Failed: {}'.format(
+        stats.skipped, stats.reparsed, stats.failed))
 
 def do_dump(args:argparse.Namespace)->None:
     ws = Workspace(args.dir, must_exist=True)
@@ -90,6 +107,45 @@ def do_imports(args:argparse.Namespace)->None:
     finally:
         db.close()
 
+def do_cycles(args:argparse.Namespace)->None:
+    ws = Workspace(args.dir, must_exist=True)
+    db = Sqlite(ws.symbol_index)
+    try:
+        imports = index_imports(db, ws.root_dir)
+    finally:
+        db.close()
+    num_cycles = 0
+    num_layers = 0
+    for c in components(imports):
+        num_layers = max(num_layers, c.layer + 1)
+        if c.cyclic:
+            num_cycles += 1
+            print('{:>3}: cycle of {}: {}'.format(c.layer, len(c.files),
+                ' '.join(sorted(p.rel for p in c.files))), flush=True)
+        elif not args.cycles_only:
+            print('{:>3}: {}'.format(c.layer, c.files[0].rel), flush=True)
+    print('Total Files: {}'.format(len(imports)))
+    print('Total Cycles: {}'.format(num_cycles))
+    print('Total Layers: {}'.format(num_layers))
+    if args.check and num_cycles:
+        sys.exit(1)
+
+def do_grep(args:argparse.Namespace)->None:
+    ws = Workspace(args.dir, must_exist=True)
+    try:
+        grep = Grep(args.pattern, regex=not args.fixed_strings,
+            ignore_case=args.ignore_case, jobs=args.jobs)
+    except (re.error, ValueError) as e:
+        print('Bad pattern: {}'.format(e), file=sys.stderr)
+        sys.exit(2)
+    num_matches = 0
+    for matches in grep.search(workspace_files(ws)):
+        num_matches += len(matches)
+        for m in matches:
+            print('{}:{}:{}'.format(m.path.rel, m.line, m.text))
+    if not num_matches:
+        sys.exit(1)
+
 def main(argv:List[str]) -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--dir', '-d', type=str, required=True,
@@ -110,6 +166,8 @@ def main(argv:List[str]) -> None:
     update.set_defaults(func=do_update)
 
     update_all = subparsers.add_parser('update-all', help="Re-index all files")
+    update_all.add_argument('--jobs', '-j', type=int, default=1,
+        help='Number of processes to parse with.  [default: 1]')
     update_all.set_defaults(func=do_update_all)
 
     dump = subparsers.add_parser('dump',
@@ -122,6 +180,26 @@ def main(argv:List[str]) -> None:
     imports.add_argument('path', type=str)
     imports.set_defaults(func=do_imports)
 
+    cycles = subparsers.add_parser('cycles',
+        help='List import cycles, and the layer of each file')
+    cycles.add_argument('--cycles-only', action='store_true', default=False,
+        help='Only list cycles')
+    cycles.add_argument('--check', action='store_true', default=False,
+        help='Exit with status 1 if there are any cycles')
+    cycles.set_defaults(func=do_cycles)
+
+    grep = subparsers.add_parser('grep',
+        help='Search the workspace files for a regex.  Exits with status 1 '
+            'if there are no matches')
+    grep.add_argument('pattern', type=str)
+    grep.add_argument('--fixed-strings', '-F', action='store_true',
+        default=False, help='Match the pattern literally')
+    grep.add_argument('--ignore-case', '-i', action='store_true',
+        default=False, help='Ignore ASCII case')
+    grep.add_argument('--jobs', '-j', type=int, default=None,
+        help='Number of processes to search with.  [default: one per CPU]')
+    grep.set_defaults(func=do_grep)
+
     stats = subparsers.add_parser('stats')
     stats.set_defaults(func=do_stats)
 
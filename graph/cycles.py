@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Import cycle detection and layering, over a SourceGraph or the symbol index.
+'''
+
+from graph.db import Sqlite
+from graph.scc import strongly_connected
+from graph.source_graph import SourceGraph, import_paths
+import logging
+from typing import (
+    AbstractSet, Dict, Generic, Hashable, Iterator, List, Mapping, Set,
+    TypeVar)
+from workspace.path import Path
+
+log = logging.getLogger(__name__)
+
+N = TypeVar('N', bound=Hashable)
+
+class Component(Generic[N]):
+    '''
+    A strongly connected component of the import graph: either one file, or a
+    cycle of files which all (indirectly) import each other.
+
+    Files which import nothing are in layer 0.  Otherwise, a component's
+    layer is one more than the highest layer of the components it imports.
+    '''
+    __slots__ = ('layer', 'files', 'cyclic')
+
+    def __init__(self, layer:int, files:List[N], cyclic:bool) -> None:
+        self.layer = layer
+        self.files = files
+        self.cyclic = cyclic
+
+    def __repr__(self) -> str:
+        return 'Component({}, {!r}, {})'.format(
+            self.layer, self.files, self.cyclic)
+
+def components(imports:Mapping[N, AbstractSet[N]]) -> Iterator[Component[N]]:
+    '''
+    Find the cycles and layers of an import map.  Imports of files which
+    aren't keys of the map are ignored.
+
+    Components are yielded as they're found, each after all the components
+    it imports.  Linear in files and imports.
+    '''
+    # Files outside the map are in layer -1
+    layer_of: Dict[N, int] = {}
+    get_layer = layer_of.__getitem__
+    no_imports: AbstractSet[N] = frozenset()
+    for comp in strongly_connected(imports,
+            lambda f: imports.get(f, no_imports)):
+        f = comp[0]
+        if f not in imports:
+            layer_of[f] = -1
+            continue
+        if len(comp) == 1:
+            # The common case, kept to builtins for speed
+            f_imports = imports[f]
+            cyclic = f in f_imports
+            if cyclic:
+                f_imports = set(f_imports) - set([f])
+            layer = max(map(get_layer, f_imports), default=-1) + 1
+        else:
+            cyclic = True
+            members = set(comp)
+            layer = max((layer_of[i] for g in comp for i in imports[g]
+                if i not in members), default=-1) + 1
+        for g in comp:
+            layer_of[g] = layer
+        yield Component(layer, comp, cyclic)
+
+def graph_components(sg:SourceGraph) -> Iterator[Component[Path]]:
+    '''
+    Find the cycles and layers of the workspace files of a SourceGraph.  A
+    lazy graph only covers the files it knows the imports of so far.
+    '''
+    return components(sg.import_map)
+
+def index_imports(db:Sqlite, ws_root:str) -> Dict[Path, Set[Path]]:
+    '''
+    Read the import map of all the files in the symbol index, whether or not
+    they were indexed with a stamp.
+    '''
+    imports = db.dump_all_imports()
+    return {Path.canonical(p, ws_root):
+        import_paths(imports.get(p, ()), ws_root) for p in db.dump_paths()}
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+class ComponentsTest(unittest.TestCase):
+    def test_components(self) -> None:
+        imports = {
+            'a': set(['b', 'os']),
+            'b': set(['c', 'd']),
+            'c': set(['b']),
+            'd': set(),
+            'e': set(['e', 'a']),
+        }
+        res = [(c.layer, sorted(c.files), c.cyclic)
+            for c in components(imports)]
+        self.assertEqual(res, [
+            (0, ['d'], False),
+            (1, ['b', 'c'], True),
+            (2, ['a'], False),
+            (3, ['e'], True),
+        ])
+
+    def test_long_chain(self) -> None:
+        n = 50000
+        imports = {i: set([i + 1]) if i < n else set() for i in range(n + 1)}
+        res = list(components(imports))
+        self.assertEqual(len(res), n + 1)
+        self.assertEqual(res[-1].layer, n)
+
+class IndexComponentsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = os.path.realpath(tempfile.mkdtemp())
+        self.ws = os.path.join(self.dir, '.workspace')
+        os.mkdir(self.ws)
+        with open(os.path.join(self.ws, 'config'), 'w') as f:
+            f.write('{"python_path": [ "'+self.dir+'" ] }')
+        for name, src in [
+                ('foo.py', 'import bar'),
+                ('bar.py', 'import foo, baz'),
+                ('baz.py', 'import os')]:
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(src)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def test_index_and_graph_agree(self) -> None:
+        from graph.indexer import Indexer
+        from graph.parsers.python3 import Py3Parser
+        from graph.parsers.resolver import ImportResolver
+        from workspace.workspace import Workspace
+        w = Workspace(self.ws)
+        db = Sqlite(w.symbol_index, create=True)
+        parser = Py3Parser(w.python_path,
+            ImportResolver(module_map=w.module_map))
+        try:
+            Indexer(w, db, [parser]).update()
+            from_index = [(c.layer, sorted(p.rel for p in c.files), c.cyclic)
+                for c in components(index_imports(db, w.root_dir))]
+        finally:
+            db.close()
+        self.assertEqual(from_index, [
+            (0, ['baz.py'], False),
+            (1, ['bar.py', 'foo.py'], True),
+        ])
+        sg = SourceGraph(w)
+        from_graph = [(c.layer, sorted(p.rel for p in c.files), c.cyclic)
+            for c in graph_components(sg)]
+        self.assertEqual(from_graph, from_index)
+
+    def test_index_without_stamp(self) -> None:
+        from graph.indexer import Indexer
+        from graph.parsers.python3 import Py3Parser
+        from graph.parsers.resolver import ImportResolver
+        from workspace.workspace import Workspace
+        w = Workspace(self.ws)
+        db = Sqlite(w.symbol_index, create=True)
+        parser = Py3Parser(w.python_path,
+            ImportResolver(module_map=w.module_map))
+        try:
+            Indexer(w, db, [parser]).update()
+            path = Path('foo.py', w.root_dir)
+            syms, imports = parser.parse(path)
+            db.update_file(path, syms, imports)
+            res = [(c.layer, sorted(p.rel for p in c.files), c.cyclic)
+                for c in components(index_imports(db, w.root_dir))]
+        finally:
+            db.close()
+        self.assertEqual(res, [
+            (0, ['baz.py'], False),
+            (1, ['bar.py', 'foo.py'], True),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
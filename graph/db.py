@@ -7,15 +7,37 @@
 # (at your option) any later version.
 
 from graph.symbol import Symbol, SymbolClass, SymbolType
+import logging
 import os.path
 import sqlite3
-from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
 from workspace.path import Path
 
+log = logging.getLogger(__name__)
+
 class DBException(Exception):
     def __init__(self, msg: str) -> None:
         super(DBException, self).__init__(msg)
         
+class FileStamp(NamedTuple):
+    '''
+    Identifies the indexed content of a file.  mtime (in ns) and size are cheap
+    to check with a stat; hash is a digest of the file's content.
+    '''
+    mtime: int
+    size: int
+    hash: str
+
+class FileUpdate(NamedTuple):
+    '''
+    New index content for a file.  If symbols is None, only the file's stamp
+    is updated.
+    '''
+    path: Path
+    symbols: Optional[List[Symbol]]
+    imports: List[Tuple[str, Path]]
+    stamp: Optional[FileStamp]
+
 class DB(object):
     '''
     Defines the interface of a symbol database.
@@ -51,7 +73,7 @@ class DB(object):
         raise NotImplementedError()
 
 class Sqlite(DB):
-    SCHEMA_VERSION = "3"
+    SCHEMA_VERSION = "5"
 
     def __init__(self, db_path: Path, create: bool=False) -> None:
         need_create = False
@@ -62,11 +84,14 @@ class Sqlite(DB):
 
 
         self.conn: sqlite3.Connection = sqlite3.connect(db_path.abs)
+        # Cache of path -> id for files written through this connection
+        self._file_ids: Dict[str, int] = {}
         try:
             if need_create:
                 self._create_db()
             else:
                 self._check_version()
+                self._recover()
         except:
             self.conn.close()
             raise
@@ -80,7 +105,9 @@ class Sqlite(DB):
                 CREATE TABLE files (
                     id integer PRIMARY KEY,
                     path text UNIQUE NOT NULL,
-                    hash text)''')
+                    hash text,
+                    mtime integer,
+                    size integer)''')
             self.conn.execute('''
                 CREATE TABLE symbol_classes (
                     id integer UNIQUE NOT NULL,
@@ -127,8 +154,7 @@ class Sqlite(DB):
                     FOREIGN KEY (src) REFERENCES landmarks(id),
                     FOREIGN KEY (dst) REFERENCES landmarks(id)
                 )''')
-            self.conn.execute('CREATE INDEX sym_by_file ON symbols(file)')
-            self.conn.execute('CREATE INDEX sym_by_name ON symbols(name)')
+            self._create_indexes()
             self.conn.execute('INSERT INTO meta VALUES ("version", ?)',
                 Sqlite.SCHEMA_VERSION)
             self.conn.executemany(
@@ -140,10 +166,46 @@ class Sqlite(DB):
 
     def _check_version(self) -> None:
         vers = self.get_schema_version()
-        if vers != Sqlite.SCHEMA_VERSION:
+        if vers in ('3', '4'):
+            self._migrate(vers)
+        elif vers != Sqlite.SCHEMA_VERSION:
             raise DBException('Schema version mismatch: want {}, is {}'.format(
                 Sqlite.SCHEMA_VERSION, vers))
 
+    def _migrate(self, vers: str) -> None:
+        '''
+        Upgrade an older db in place.  Version 3 had no file mtimes or sizes,
+        and version 4 didn't record the parent packages of imports, so all
+        stamps are cleared: the next update reparses every file.
+        '''
+        log.info('Upgrading symbol index from version {} to {}'.format(
+            vers, Sqlite.SCHEMA_VERSION))
+        with self.conn:
+            if vers == '3':
+                self.conn.execute('ALTER TABLE files ADD COLUMN mtime integer')
+                self.conn.execute('ALTER TABLE files ADD COLUMN size integer')
+            self.conn.execute(
+                'UPDATE files SET hash=NULL, mtime=NULL, size=NULL')
+            self.conn.execute('UPDATE meta SET value=? WHERE key="version"',
+                [Sqlite.SCHEMA_VERSION])
+
+    def _recover(self) -> None:
+        '''
+        Finish a bulk load which was interrupted, e.g. by the process dying,
+        before it could delete stale rows and recreate the indexes.
+        '''
+        with self.conn:
+            res = dict(self.conn.execute(
+                'SELECT key, value FROM meta WHERE key IN (?, ?)',
+                ['bulk_max_sym', 'bulk_max_imp']).fetchall())
+        if len(res) == 2:
+            log.warning('Finishing an interrupted bulk load')
+            self._end_unindexed_load(
+                (int(res['bulk_max_sym']), int(res['bulk_max_imp'])))
+        else:
+            with self.conn:
+                self._create_indexes()
+
     def get_schema_version(self) -> str:
         with self.conn:
             ((vers,),) = self.conn.execute(
@@ -164,31 +226,198 @@ class Sqlite(DB):
             return fid
 
     def update_file(self, path: Path, symbols: List[Symbol],
-            imports: List[Tuple[str, Path]]) -> None:
+            imports: List[Tuple[str, Path]], stamp: FileStamp=None) -> None:
         '''
         Update db with new symbols for the given file.
+        @param stamp if given, recorded so that unchanged files can be skipped
+          by later updates.
+        '''
+        self.bulk_update([FileUpdate(path, symbols, imports, stamp)])
+
+    def update_stamp(self, path: Path, stamp: FileStamp) -> None:
+        '''
+        Record a new stamp for an indexed file whose content is unchanged,
+        without touching its symbols.
+        '''
+        self.bulk_update([FileUpdate(path, None, [], stamp)])
+
+    def bulk_update(self, updates: Iterable[FileUpdate],
+            batch_size: int=1000, rebuild_indexes: bool=False) -> int:
+        '''
+        Apply many file updates, committing once per batch_size files.
+        updates may be a generator; it is consumed as the db is written.
+        @param rebuild_indexes drop the symbol indexes for the duration of the
+          load and recreate them afterwards.  Worthwhile when (re)loading a
+          large fraction of the db.
+        @return the number of updates applied
+        '''
+        count = 0
+        stale_before: Optional[Tuple[int, int]] = None
+        if rebuild_indexes:
+            stale_before = self._begin_unindexed_load()
+        try:
+            batch: List[FileUpdate] = []
+            for u in updates:
+                batch.append(u)
+                if len(batch) >= batch_size:
+                    self._write_batch(batch, stale_before is not None)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self._write_batch(batch, stale_before is not None)
+                count += len(batch)
+        finally:
+            if stale_before is not None:
+                self._end_unindexed_load(stale_before)
+        return count
+
+    def _write_batch(self, batch: List[FileUpdate], defer_delete: bool) -> None:
+        '''
+        Write a batch of updates in one transaction.  If defer_delete, stale
+        symbols of updated files are left in place, and their file ids are
+        recorded in bulk_stale for _end_unindexed_load to clean up.  Of
+        several updates of one file, the last wins.
+        '''
+        latest: Dict[str, FileUpdate] = {}
+        for u in batch:
+            prev = latest.pop(u.path.abs, None)
+            if prev is not None and u.symbols is None and \
+                    prev.symbols is not None:
+                u = prev._replace(stamp=u.stamp)
+            latest[u.path.abs] = u
+        batch = list(latest.values())
+        symbols: List[Tuple[int, int, int, str, int]] = []
+        imports: List[Tuple[int, str, str]] = []
+        stale: List[int] = []
+        try:
+            with self.conn:
+                for u in batch:
+                    assert u.symbols is None or \
+                        all([s.path == u.path for s in u.symbols])
+                    mtime, size, digest = u.stamp if u.stamp else \
+                        (None, None, None)
+                    file_id = self._file_ids.get(u.path.abs)
+                    if file_id is None:
+                        file_id = self._get_file_id(u.path)
+                    if u.symbols is None:
+                        # Stamp-only update; nothing to do for unknown files
+                        if file_id is not None:
+                            self.conn.execute(
+                                'UPDATE files SET hash=?, mtime=?, size=? '
+                                'WHERE id=?', [digest, mtime, size, file_id])
+                        continue
+
+                    if file_id is None:
+                        # New file, add it to the files table to get an id
+                        file_id = self.conn.execute(
+                            'INSERT INTO files (path, hash, mtime, size) '
+                            'VALUES (?,?,?,?)',
+                            [u.path.abs, digest, mtime, size]).lastrowid
+                        assert file_id is not None
+                    else:
+                        # The file is known, old symbols must go:
+                        stale.append(file_id)
+                        self.conn.execute(
+                            'UPDATE files SET hash=?, mtime=?, size=? WHERE id=?',
+                            [digest, mtime, size, file_id])
+                    self._file_ids[u.path.abs] = file_id
+
+                    symbols.extend(
+                        (file_id, s.line, s.column, s.name, s.sym_type.value)
+                        for s in u.symbols)
+                    imports.extend(
+                        (file_id, name, path.abs) for name, path in u.imports)
+
+                if defer_delete:
+                    self.conn.executemany(
+                        'INSERT OR IGNORE INTO bulk_stale VALUES (?)',
+                        [(i,) for i in stale])
+                else:
+                    self.conn.executemany(
+                        'DELETE FROM symbols WHERE file=?', [(i,) for i in stale])
+                    self.conn.executemany(
+                        'DELETE FROM imports WHERE file=?', [(i,) for i in stale])
+                self.conn.executemany(
+                    'INSERT INTO symbols VALUES (?,?,?,?,?)', symbols)
+                self.conn.executemany(
+                    'INSERT INTO imports VALUES (?,?,?)', imports)
+        except:
+            # Ids assigned in the rolled back transaction are not valid
+            self._file_ids.clear()
+            raise
+
+    def _begin_unindexed_load(self) -> Tuple[int, int]:
+        '''
+        Drop the symbol indexes for a bulk load.  Without an index on file,
+        deleting a file's old symbols is a table scan, so deletes are deferred
+        until the end of the load.  The stale file ids and the max rowids are
+        kept in the db, so that if the load is interrupted, the next open can
+        finish it.
+        @return the max rowids of symbols and imports before the load.  Rows
+          above these are new, and must not be deleted.
         '''
-        assert all([s.path == path for s in symbols])
         with self.conn:
-            # Check if this path is known:
-            file_id = self._get_file_id(path)
-            if file_id is None:
-                # It isn't, add it to the files table to get a file id
-                self.conn.execute('INSERT INTO files (path) VALUES (?)',
-                    [path.abs])
-                file_id = self._get_file_id(path)
-            else:
-                # The file is known, delete all old symbols for it:
-                self.conn.execute('DELETE FROM symbols WHERE file=?', [file_id])
-                self.conn.execute('DELETE FROM imports WHERE file=?', [file_id])
-            assert file_id is not None
+            self.conn.execute('DROP INDEX IF EXISTS sym_by_file')
+            self.conn.execute('DROP INDEX IF EXISTS sym_by_name')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS bulk_stale '
+                '(id integer PRIMARY KEY)')
+            self.conn.execute('DELETE FROM bulk_stale')
+            ((max_sym,),) = self.conn.execute(
+                'SELECT coalesce(max(rowid), 0) FROM symbols')
+            ((max_imp,),) = self.conn.execute(
+                'SELECT coalesce(max(rowid), 0) FROM imports')
+            self.conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [('bulk_max_sym', str(max_sym)),
+                    ('bulk_max_imp', str(max_imp))])
+        return max_sym, max_imp
+
+    def _end_unindexed_load(self, stale_before: Tuple[int, int]) -> None:
+        max_sym, max_imp = stale_before
+        with self.conn:
+            self.conn.execute(
+                '''
+                    DELETE FROM symbols
+                    WHERE rowid <= ? AND file IN (SELECT id FROM bulk_stale)
+                ''', [max_sym])
+            self.conn.execute(
+                '''
+                    DELETE FROM imports
+                    WHERE rowid <= ? AND file IN (SELECT id FROM bulk_stale)
+                ''', [max_imp])
+            self.conn.execute('DELETE FROM bulk_stale')
+            self.conn.execute(
+                'DELETE FROM meta WHERE key IN (?, ?)',
+                ['bulk_max_sym', 'bulk_max_imp'])
+            self._create_indexes()
+
+    def _create_indexes(self) -> None:
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS sym_by_file ON symbols(file)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS sym_by_name ON symbols(name)')
+
+    def dump_stamps(self) -> Dict[str, FileStamp]:
+        '''
+        Fetch the stamps of all indexed files, keyed by absolute path.  Files
+        indexed without a stamp are omitted.
+        '''
+        with self.conn:
+            res = self.conn.execute(
+                '''
+                    SELECT path, mtime, size, hash
+                    FROM files
+                    WHERE hash IS NOT NULL
+                ''').fetchall()
+        return {p: FileStamp(m, s, h) for p, m, s, h in res}
 
-            self.conn.executemany(
-                'INSERT INTO symbols VALUES (?,?,?,?,?)',
-                [(file_id, s.line, s.column, s.name, s.sym_type.value) for s in symbols])
-            self.conn.executemany(
-                'INSERT INTO imports VALUES (?,?,?)',
-                [(file_id, name, path.abs) for name, path in imports])
+    def dump_paths(self) -> List[str]:
+        '''
+        Fetch the absolute paths of all indexed files, with or without stamps.
+        '''
+        with self.conn:
+            res = self.conn.execute('SELECT path FROM files').fetchall()
+        return [p for (p,) in res]
 
     def dump_file(self, path: Path) -> List[Symbol]:
         '''
@@ -237,9 +466,29 @@ class Sqlite(DB):
                 (file_id,))
             all_resolutions = all_res_c.fetchall()
 
-        resolved_map = {n: Path(p, path.ws_root) for n, p in all_resolutions}
+        resolved_map = {n: Path.canonical(p, path.ws_root)
+            for n, p in all_resolutions}
         return {n: resolved_map.get(n, None) for n in all_imports}
 
+    def dump_all_imports(self) -> Dict[str, List[Tuple[str, str]]]:
+        '''
+        Fetch the resolved imports of every indexed file in one pass.
+        @return A map from the absolute path of each file with resolved imports
+          to its (name, resolved path) pairs
+        '''
+        res: Dict[str, List[Tuple[str, str]]] = {}
+        with self.conn:
+            c = self.conn.execute(
+                '''
+                    SELECT files.path, imports.name, imports.resolved_path
+                    FROM imports
+                    INNER JOIN files ON files.id=imports.file
+                    WHERE imports.resolved_path IS NOT NULL
+                ''')
+            for path, name, resolved in c:
+                res.setdefault(path, []).append((name, resolved))
+        return res
+
     def dump_stats(self) -> Dict:
         res: Dict = {}
 
@@ -318,7 +567,7 @@ class Sqlite(DB):
             res = c.fetchall()
         if res is None:
             return []
-        return [Symbol(Path(r[0], path_root), r[1], r[2], r[3],
+        return [Symbol(Path.canonical(r[0], path_root), r[1], r[2], r[3],
             SymbolType(r[4])) for r in res]
 
 
@@ -389,6 +638,19 @@ class SqliteTest(unittest.TestCase):
         with self.assertRaisesRegexp(DBException, "Schema version mismatch"):
             Sqlite(path)
 
+    def test_migrate(self) -> None:
+        self.create_db()
+        p = Path('foo', self.temp_dir)
+        syms = [Symbol(p, 42, 12, 'foo', SymbolType.CLASS)]
+        self.db.update_file(p, syms, [], FileStamp(1, 2, 'abc'))
+        with self.db.conn:
+            self.db.conn.execute('UPDATE meta SET value="4" WHERE key="version"')
+        self.db.close()
+        self.create_db()
+        self.assertEqual(self.db.get_schema_version(), Sqlite.SCHEMA_VERSION)
+        self.assertEqual(self.db.dump_stamps(), {})
+        self.assertEqual(self.db.dump_file(p), syms)
+
     def test_update_file(self) -> None:
         self.create_db()
         p = Path('foo', self.temp_dir)
@@ -420,6 +682,130 @@ class SqliteTest(unittest.TestCase):
             self.assertEqual(i, [
                 (1, 'bar', os.path.join(self.temp_dir, 'bar'))])
 
+    def test_update_file_stamp(self) -> None:
+        self.create_db()
+        p = Path('foo', self.temp_dir)
+        self.db.update_file(p, [], [], FileStamp(1, 2, 'abc'))
+        self.assertEqual(self.db.dump_stamps(), {p.abs: FileStamp(1, 2, 'abc')})
+        self.db.update_file(p, [], [], FileStamp(3, 4, 'def'))
+        self.assertEqual(self.db.dump_stamps(), {p.abs: FileStamp(3, 4, 'def')})
+
+    def test_update_file_no_stamp(self) -> None:
+        self.create_db()
+        self.db.update_file(Path('foo', self.temp_dir), [], [])
+        self.assertEqual(self.db.dump_stamps(), {})
+        self.assertEqual(self.db.dump_paths(),
+            [os.path.join(self.temp_dir, 'foo')])
+
+    def test_update_stamp_keeps_symbols(self) -> None:
+        self.create_db()
+        p = Path('foo', self.temp_dir)
+        self.db.update_file(p, [Symbol(p, 42, 12, 'foo', SymbolType.CLASS)],
+            [], FileStamp(1, 2, 'abc'))
+        self.db.update_stamp(p, FileStamp(5, 2, 'abc'))
+        self.assertEqual(self.db.dump_stamps(), {p.abs: FileStamp(5, 2, 'abc')})
+        self.assertEqual(self.db.dump_file(p),
+            [Symbol(p, 42, 12, 'foo', SymbolType.CLASS)])
+
+    def dump_tables(self) -> List:
+        return [self.db.conn.execute('SELECT * FROM {}'.format(t)).fetchall()
+            for t in ['files', 'symbols', 'imports']]
+
+    def make_updates(self, gen: int) -> List[FileUpdate]:
+        res = []
+        for name in ['foo', 'bar', 'baz']:
+            p = Path(name, self.temp_dir)
+            res.append(FileUpdate(p,
+                [Symbol(p, gen, 0, name, SymbolType.CLASS),
+                    Symbol(p, gen + 1, 4, 'f', SymbolType.FUNCTION)],
+                [(name, Path(name + '.py', self.temp_dir))],
+                FileStamp(gen, 2, name)))
+        return res
+
+    def test_bulk_update_matches_update_file(self) -> None:
+        self.create_db()
+        for gen in [1, 10]:
+            for u in self.make_updates(gen):
+                assert u.symbols is not None
+                self.db.update_file(u.path, u.symbols, u.imports, u.stamp)
+        expected = self.dump_tables()
+        self.db.close()
+        os.unlink(os.path.join(self.temp_dir, 'test.db'))
+
+        for rebuild in [False, True]:
+            self.create_db()
+            self.assertEqual(self.db.bulk_update(
+                iter(self.make_updates(1)), batch_size=2), 3)
+            self.assertEqual(self.db.bulk_update(
+                iter(self.make_updates(10)), batch_size=2,
+                rebuild_indexes=rebuild), 3)
+            self.assertEqual(self.dump_tables(), expected)
+            self.db.close()
+            os.unlink(os.path.join(self.temp_dir, 'test.db'))
+
+    def test_bulk_update_rebuilds_indexes(self) -> None:
+        self.create_db()
+        self.db.bulk_update(self.make_updates(1), rebuild_indexes=True)
+        indexes = self.db.conn.execute(
+            'SELECT name FROM sqlite_master WHERE type="index" AND tbl_name="symbols"'
+            ).fetchall()
+        self.assertEqual(set(indexes), {('sym_by_file',), ('sym_by_name',)})
+
+    def test_bulk_update_failure_cleans_up(self) -> None:
+        self.create_db()
+        self.db.bulk_update(self.make_updates(1))
+        def updates():
+            yield self.make_updates(10)[0]
+            raise RuntimeError('boom')
+        with self.assertRaises(RuntimeError):
+            self.db.bulk_update(updates(), batch_size=1, rebuild_indexes=True)
+        p = Path('foo', self.temp_dir)
+        self.assertEqual(self.db.dump_file(p), [
+            Symbol(p, 10, 0, 'foo', SymbolType.CLASS),
+            Symbol(p, 11, 4, 'f', SymbolType.FUNCTION)])
+
+    def test_bulk_update_interrupted(self) -> None:
+        self.create_db()
+        self.db.bulk_update(self.make_updates(1))
+        self.db.bulk_update(self.make_updates(10))
+        expected = self.dump_tables()
+        self.db.close()
+        os.unlink(os.path.join(self.temp_dir, 'test.db'))
+
+        self.create_db()
+        self.db.bulk_update(self.make_updates(1))
+        # As if the process died before the end of the load
+        self.db._end_unindexed_load = lambda stale_before: None # type: ignore
+        self.db.bulk_update(self.make_updates(10), rebuild_indexes=True)
+        self.db.close()
+        self.create_db()
+        self.assertEqual(self.dump_tables(), expected)
+        indexes = self.db.conn.execute(
+            'SELECT name FROM sqlite_master WHERE type="index" AND tbl_name="symbols"'
+            ).fetchall()
+        self.assertEqual(set(indexes), {('sym_by_file',), ('sym_by_name',)})
+
+    def test_bulk_update_duplicate_paths(self) -> None:
+        self.create_db()
+        updates = self.make_updates(1)
+        self.db.bulk_update(updates + self.make_updates(10) +
+            [FileUpdate(updates[0].path, None, [], FileStamp(5, 6, 'x'))])
+        p = updates[0].path
+        self.assertEqual(self.db.dump_file(p), [
+            Symbol(p, 10, 0, 'foo', SymbolType.CLASS),
+            Symbol(p, 11, 4, 'f', SymbolType.FUNCTION)])
+        self.assertEqual(self.db.dump_stamps()[p.abs], FileStamp(5, 6, 'x'))
+
+    def test_dump_all_imports(self) -> None:
+        self.create_db()
+        foo = Path('foo', self.temp_dir)
+        bar = Path('bar', self.temp_dir)
+        baz = Path('baz', self.temp_dir)
+        self.db.update_file(foo, [], [('bar', bar), ('baz', baz)])
+        self.db.update_file(bar, [], [])
+        self.assertEqual(self.db.dump_all_imports(),
+            {foo.abs: [('bar', bar.abs), ('baz', baz.abs)]})
+
     def test_find_single_symbol(self) -> None:
         self.create_db()
         p = Path('foo', self.temp_dir)
@@ -6,16 +6,78 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
-from graph.db import Sqlite
+from graph.db import FileStamp, FileUpdate, Sqlite
 from graph.parsers.python3 import Py3Parser
+from graph.symbol import Symbol
+import hashlib
 import logging
-from typing import List
+import multiprocessing
+import os
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 from workspace.workspace import Workspace
 from workspace.path import Path
 
 log = logging.getLogger(__name__)
 
+class IndexStats(NamedTuple):
+    skipped: int
+    reparsed: int
+    failed: int
+
+class ParseResult(NamedTuple):
+    '''
+    The outcome of re-indexing one file.  If neither parsed nor error is set,
+    the file was touched but its content is unchanged.
+    '''
+    path: Path
+    stamp: Optional[FileStamp]
+    parsed: Optional[Tuple[List[Symbol], List[Tuple[str, Path]]]]
+    error: Optional[str]
+
+# (parser index, path, previously indexed stamp)
+ParseJob = Tuple[int, Path, Optional[FileStamp]]
+
+def hash_file(path:Path) -> str:
+    '''
+    Digest the content of the given file.
+    '''
+    h = hashlib.sha1()
+    with open(path.abs, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def parse_file(parsers:List[Py3Parser], job:ParseJob) -> ParseResult:
+    '''
+    Hash and, if its content changed, parse the given file.  Exceptions are
+    returned rather than raised, so that one bad file doesn't abort a batch.
+    '''
+    parser_inx, path, old = job
+    try:
+        # Stat before reading, so that a write racing with us leaves a stale
+        # mtime behind, rather than a fresh mtime for stale content.
+        st = os.stat(path.abs)
+        stamp = FileStamp(st.st_mtime_ns, st.st_size, hash_file(path))
+        if old and old.hash == stamp.hash:
+            return ParseResult(path, stamp, None, None)
+        return ParseResult(path, stamp, parsers[parser_inx].parse(path), None)
+    except Exception as e:
+        return ParseResult(path, None, None, str(e))
+
+# Parsers of a worker process in the parallel indexer's pool.
+_worker_parsers: List[Py3Parser] = []
+
+def _init_worker(parsers:List[Py3Parser]) -> None:
+    global _worker_parsers
+    _worker_parsers = parsers
+
+def _parse_in_worker(job:ParseJob) -> ParseResult:
+    return parse_file(_worker_parsers, job)
+
 class Indexer(object):
+    # Updates of at least this many files drop and rebuild the symbol indexes
+    REBUILD_INDEX_THRESHOLD = 5000
+
     def __init__(self,
             ws:Workspace,
             # XXX: generalize:
@@ -26,24 +88,167 @@ class Indexer(object):
         self.parsers = parsers
         self.db = db
 
-    def update(self) -> None:
-        for path in self.ws.files:
+    def update(self, jobs:int=1) -> IndexStats:
+        '''
+        Index all files in the workspace.  Files whose stamp matches the one
+        recorded in the index are not re-parsed.  Results are streamed into
+        the db in large transactions.
+        @param jobs if greater than 1, parse in a pool of this many processes.
+          This process remains the only writer to the db, and files are
+          written in the same order as a serial update.
+        '''
+        stamps = self.db.dump_stamps()
+        skipped = reparsed = failed = 0
+
+        todo: List[ParseJob] = []
+        for path in sorted(self.ws.files):
             if path.isdir:
                 continue
-
+            parser_inx = self._find_parser(path)
+            if parser_inx is None:
+                continue
+            old = stamps.get(path.abs)
             try:
-                self._update_one(path)
-            except Exception as e:
-                log.warning('Indexing failed: {}: {}'.format(path.abs), e)
+                st = os.stat(path.abs)
+            except OSError as e:
+                failed += 1
+                log.warning('Indexing failed: {}: {}'.format(path.abs, e))
+                continue
+            if old and (old.mtime, old.size) == (st.st_mtime_ns, st.st_size):
+                log.debug('Unchanged: {}'.format(path.abs))
+                skipped += 1
+                continue
+            todo.append((parser_inx, path, old))
+
+        pool = None
+        results: Iterator[ParseResult]
+        if jobs > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(
+                jobs, initializer=_init_worker, initargs=(self.parsers,))
+            chunksize = max(1, min(64, len(todo) // (jobs * 8)))
+            results = pool.imap(_parse_in_worker, todo, chunksize)
+        else:
+            results = (parse_file(self.parsers, job) for job in todo)
+
+        def updates() -> Iterator[FileUpdate]:
+            nonlocal skipped, reparsed, failed
+            for res in results:
+                if res.error is not None:
+                    failed += 1
+                    log.warning('Indexing failed: {}: {}'.format(
+                        res.path.abs, res.error))
+                elif res.parsed is None:
+                    # Touched, but not modified
+                    log.debug('Unchanged content: {}'.format(res.path.abs))
+                    skipped += 1
+                    yield FileUpdate(res.path, None, [], res.stamp)
+                else:
+                    syms, imports = res.parsed
+                    log.debug('Indexed: {}'.format(res.path.abs))
+                    reparsed += 1
+                    yield FileUpdate(res.path, syms, imports, res.stamp)
+
+        try:
+            self.db.bulk_update(updates(),
+                rebuild_indexes=len(todo) >= self.REBUILD_INDEX_THRESHOLD)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
-    def _update_one(self, path:Path) -> None:
-        candidates = [p for p in self.parsers if p.accept(path)]
+        return IndexStats(skipped, reparsed, failed)
+
+    def _find_parser(self, path:Path) -> Optional[int]:
+        candidates = [i for i, p in enumerate(self.parsers) if p.accept(path)]
         if not candidates:
             log.info('No parser for file: {}'.format(path.abs))
-            return
+            return None
         elif len(candidates) > 1:
             log.info('Multiple parsers for file: {}'.format(path.abs))
+        return candidates[0]
+
+import shutil
+import tempfile
+import unittest
+
+class IndexerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, '.workspace'))
+        self.ws = Workspace(os.path.join(self.dir, '.workspace'))
+        self.db = Sqlite(self.ws.symbol_index, create=True)
+        self.src = os.path.join(self.dir, 'foo.py')
+        self.write('def foo():\n  pass\n')
+
+    def tearDown(self) -> None:
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, content:str) -> None:
+        with open(self.src, 'w') as f:
+            f.write(content)
+
+    def update(self, jobs:int=1) -> IndexStats:
+        self.ws.reload_file_list()
+        return Indexer(self.ws, self.db, [Py3Parser()]).update(jobs)
+
+    def test_initial_update(self) -> None:
+        self.assertEqual(self.update(), IndexStats(0, 1, 0))
+        self.assertEqual(len(self.db.dump_file(Path(self.src, self.dir))), 1)
+
+    def test_unchanged_skipped(self) -> None:
+        self.update()
+        self.assertEqual(self.update(), IndexStats(1, 0, 0))
+
+    def test_modified_reparsed(self) -> None:
+        self.update()
+        self.write('def foo():\n  pass\ndef bar():\n  pass\n')
+        self.assertEqual(self.update(), IndexStats(0, 1, 0))
+        self.assertEqual(len(self.db.dump_file(Path(self.src, self.dir))), 2)
+
+    def test_touched_skipped(self) -> None:
+        self.update()
+        st = os.stat(self.src)
+        os.utime(self.src, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.update(), IndexStats(1, 0, 0))
+        self.assertEqual(
+            self.db.dump_stamps()[self.src].mtime, st.st_mtime_ns + 10**9)
+
+    def test_failed(self) -> None:
+        self.write('invalid python')
+        self.assertEqual(self.update(), IndexStats(0, 0, 1))
+        # Failures are retried
+        self.assertEqual(self.update(), IndexStats(0, 0, 1))
+
+    def test_non_python_ignored(self) -> None:
+        open(os.path.join(self.dir, 'README'), 'w').close()
+        self.assertEqual(self.update(), IndexStats(0, 1, 0))
+
+    def dump_db(self, db:Sqlite) -> List:
+        return [db.conn.execute('SELECT * FROM {}'.format(table)).fetchall()
+            for table in ['files', 'symbols', 'imports']]
+
+    def test_parallel_matches_serial(self) -> None:
+        for i in range(10):
+            with open(os.path.join(self.dir, 'mod{}.py'.format(i)), 'w') as f:
+                f.write('import os\nclass C{}(object):\n  def f(self):\n'
+                    '    os.getcwd()\n'.format(i))
+        with open(os.path.join(self.dir, 'bad.py'), 'w') as f:
+            f.write('invalid python')
+        self.assertEqual(self.update(jobs=3), IndexStats(0, 11, 1))
+
+        serial_db = Sqlite(Path('serial.db', self.dir), create=True)
+        try:
+            self.assertEqual(
+                Indexer(self.ws, serial_db, [Py3Parser()]).update(jobs=1),
+                IndexStats(0, 11, 1))
+            self.assertEqual(self.dump_db(serial_db), self.dump_db(self.db))
+        finally:
+            serial_db.close()
+
+    def test_parallel_skips_unchanged(self) -> None:
+        self.update(jobs=2)
+        self.assertEqual(self.update(jobs=2), IndexStats(1, 0, 0))
 
-        syms, imports = candidates[0].parse(path)
-        self.db.update_file(path, syms, imports)
-        log.debug('Indexed: {}'.format(path.abs))
+if __name__ == '__main__':
+    unittest.main()
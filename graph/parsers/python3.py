@@ -7,75 +7,20 @@
 # (at your option) any later version.
 
 import ast
+from graph.parsers.resolver import ImportResolver, default_resolver
 from graph.symbol import Symbol, SymbolType
-import imp
 import logging
 import os.path
-from typing import Any, Callable, Dict, IO, List, Optional, Tuple
+from typing import List, Optional, Set, Tuple
 from workspace.path import Path
 
 log = logging.getLogger(__name__)
 
-# The signature of imp.find_module
-# XXX: which is deprecated since 3.3...
-FoundDesc = Tuple[Optional[str], Optional[str], int]
-Finder = Callable[[str, List[str]], Tuple[IO, str, FoundDesc]]
-
-def resolve_import(name:str, finder:Finder, extra_search:List[str]
-        ) -> Tuple[Optional[str], List[str]]:
-    '''
-    Search for the given name using the given module finder, and optionally
-    search in the given additional search dirs.  Return the module's package
-    directory (if a package), and a list of paths to all of the module's
-    ancestors, ordered from most to least distant.
-    '''
-    if 'os.path' == name:
-        # paper over dynamic import hijinks
-        return None, [i.replace('.pyc', '.py') for i in [
-            os.__file__, os.path.__file__]]
-
-    if '.' in name:
-        pkg, mod = name.rsplit(".", 1)
-        parent, paths = resolve_import(pkg, finder, extra_search)
-    else:
-        mod = name
-        parent = None
-        paths = []
-
-    if parent:
-        f, pathname, desc = finder(mod, [parent])
-    else:
-        try:
-            f, pathname, desc = finder(mod, None)
-        except ImportError:
-            if not extra_search:
-                raise
-            f, pathname, desc = finder(mod, extra_search)
-
-    if f:
-        f.close()
-
-    if desc[2] == imp.PY_SOURCE:
-        assert pathname
-        paths.append(pathname)
-        return None, paths
-    elif desc[2] == imp.PKG_DIRECTORY:
-        assert pathname
-        paths.append(os.path.join(pathname, '__init__.py'))
-        return pathname, paths
-    elif desc[2] == imp.C_BUILTIN:
-        return None, paths
-    else:
-        raise ImportError('Unknown module type: {}'.format(desc[2]))
-
-# XXX: coerce imp.find_module to Finder, because the real type is batshit
-default_finder: Any = imp.find_module
-
 class Py3Parser(object):
     def __init__(self,
-            extra_search:List[str]=None, finder:Finder=default_finder) -> None:
+            extra_search:List[str]=None, resolver:ImportResolver=None) -> None:
         self.extra_search = extra_search if extra_search else []
-        self.finder = finder
+        self.resolver = resolver if resolver else default_resolver
 
     def accept(self, path:Path) -> bool:
         '''
@@ -129,14 +74,22 @@ class Py3Parser(object):
                     syms.append(s)
 
         resolved_imports: List[Tuple[str, Path]] = []
+        seen: Set[Tuple[str, Path]] = set()
         for s_name, definitely_module in imports:
             try:
-                pkg_dir, paths = resolve_import(
-                    s_name, self.finder, self.extra_search)
-                if not paths:
-                    continue
-                resolved_imports.append((s_name, Path(
-                    os.path.realpath(paths[-1]), path.ws_root)))
+                pkg_dir, paths = self.resolver.resolve(
+                    s_name, self.extra_search)
+                # Record the module's parent packages too, named by their
+                # prefix of the name, since they're imported along with it.
+                parts = s_name.split('.')
+                for i, p in enumerate(paths):
+                    p_name = '.'.join(parts[:i + 1]) \
+                        if len(paths) == len(parts) else s_name
+                    resolved = (p_name, Path.canonical(
+                        os.path.realpath(p), path.ws_root))
+                    if resolved not in seen:
+                        seen.add(resolved)
+                        resolved_imports.append(resolved)
             except ImportError as e:
                 if definitely_module:
                     log.info('Failed to resolve {}:{}: {}'.format(
@@ -157,61 +110,23 @@ class Py3Parser(object):
         else:
             return None
 
+from graph.parsers.resolver import (
+    MockModules, PKG_DIRECTORY, PY_SOURCE, make_finder)
 import shutil
 import tempfile
 import unittest
 
-ModuleMap = Dict[
-    Tuple[str, Optional[Tuple[str, ...]]], Tuple[str, int]]
-
-def make_finder(modules:ModuleMap) -> Finder:
-    def res(name:str, paths:List[str]) -> Tuple[Optional[IO], str, FoundDesc]:
-        path_tup:Tuple[str, ...] = tuple(paths) if paths else None
-        if (name, path_tup) in modules:
-            path, typ = modules[(name, path_tup)]
-            return (None, path, (None, None, typ))
-        else:
-            raise ImportError('Failed to find {} in {}'.format(
-                name, path_tup))
-    return res
-
-class ResolveImportTest(unittest.TestCase):
-    def test_resolve_top(self) -> None:
-        mock_finder = make_finder({
-            ('mod', None): ('mod.py', imp.PY_SOURCE)
-        })
-        parent, paths = resolve_import('mod', mock_finder, None)
-        self.assertIsNone(parent)
-        self.assertEqual(paths, ['mod.py'])
-
-    def test_resolve_pkg(self) -> None:
-        mock_finder = make_finder({
-            ('pkg', None): ('pkg/', imp.PKG_DIRECTORY)
-        })
-        parent, paths = resolve_import('pkg', mock_finder, None)
-        self.assertEqual(parent, 'pkg/')
-        self.assertEqual(paths, ['pkg/__init__.py'])
-
-    def test_resolve_in_pkg(self) -> None:
-        mock_finder = make_finder({
-            ('mod', ('pkg/',)): ('pkg/mod.py', imp.PY_SOURCE),
-            ('pkg', None): ('pkg/', imp.PKG_DIRECTORY)
-        })
-        parent, paths = resolve_import('pkg.mod', mock_finder, None)
-        self.assertIsNone(parent)
-        self.assertEqual(paths, ['pkg/__init__.py', 'pkg/mod.py'])
-
 class Py3ParserTest(unittest.TestCase):
     def setUp(self) -> None:
         self.dir = tempfile.mkdtemp()
         self.src = Path('src.py', self.dir)
-        self.modules: ModuleMap = {
-            ('mod', ('/root/pkg/',)): ('/root/pkg/mod.py', imp.PY_SOURCE),
-            ('pkg', ('/root/',)): ('/root/pkg/', imp.PKG_DIRECTORY),
-            ('root', None): ('/root/', imp.PKG_DIRECTORY)
+        self.modules: MockModules = {
+            ('mod', ('/root/pkg/',)): ('/root/pkg/mod.py', PY_SOURCE),
+            ('pkg', ('/root/',)): ('/root/pkg/', PKG_DIRECTORY),
+            ('root', None): ('/root/', PKG_DIRECTORY)
         }
         self.finder = make_finder(self.modules)
-        self.p = Py3Parser(finder=self.finder)
+        self.p = Py3Parser(resolver=ImportResolver(finder=self.finder))
 
     def tearDown(self) -> None:
         shutil.rmtree(self.dir)
@@ -282,18 +197,22 @@ class Py3ParserTest(unittest.TestCase):
             f.write('import root.pkg.mod')
         _, imports = self.p.parse(self.src)
         self.assertEqual(
-            set(path.abs for _, path in imports),
-            {'/root/pkg/mod.py'})
+            set((name, path.abs) for name, path in imports), {
+                ('root', '/root/__init__.py'),
+                ('root.pkg', '/root/pkg/__init__.py'),
+                ('root.pkg.mod', '/root/pkg/mod.py')})
 
     def test_load_multi_import_as(self) -> None:
         with open(self.src.abs, 'w') as f:
             f.write('import root.foo as f, root.pkg.mod as m')
         self.modules.update({
-            ('foo', ('/root/',)): ('/root/foo.py', imp.PY_SOURCE)
+            ('foo', ('/root/',)): ('/root/foo.py', PY_SOURCE)
         })
         _, imports = self.p.parse(self.src)
         self.assertEqual(set(path.abs for _, path in imports),  {
+            '/root/__init__.py',
             '/root/foo.py',
+            '/root/pkg/__init__.py',
             '/root/pkg/mod.py'
         })
 
@@ -302,14 +221,15 @@ class Py3ParserTest(unittest.TestCase):
             f.write('from root.pkg import Classy')
         _, imports = self.p.parse(self.src)
         self.assertEqual(set(path.abs for _, path in imports),
-            {'/root/pkg/__init__.py'})
+            {'/root/__init__.py', '/root/pkg/__init__.py'})
 
     def test_load_from_import_mod(self) -> None:
         with open(self.src.abs, 'w') as f:
             f.write('from root.pkg import mod')
         _, imports = self.p.parse(self.src)
         self.assertEqual(set(path.abs for _, path in imports),
-            {'/root/pkg/__init__.py', '/root/pkg/mod.py'})
+            {'/root/__init__.py', '/root/pkg/__init__.py',
+                '/root/pkg/mod.py'})
 
 if __name__ == '__main__':
     unittest.main()
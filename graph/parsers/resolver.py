@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+from importlib.machinery import EXTENSION_SUFFIXES
+import os
+import os.path
+import sys
+import threading
+import time
+from typing import (
+    Any, Callable, Dict, FrozenSet, IO, List, Optional, Tuple, Union)
+from workspace.module_map import ModuleMap
+
+# Module types, as found in the last element of a FoundDesc.  Values match the
+# constants of the deprecated imp module.
+PY_SOURCE = 1
+PY_COMPILED = 2
+C_EXTENSION = 3
+PKG_DIRECTORY = 5
+C_BUILTIN = 6
+
+# The signature of imp.find_module
+FoundDesc = Tuple[Optional[str], Optional[str], int]
+Finder = Callable[[str, Optional[List[str]]], Tuple[Optional[IO], str, FoundDesc]]
+
+# (package dir, paths of the module and its ancestors), see resolve_import
+Resolution = Tuple[Optional[str], List[str]]
+ParentResolver = Callable[[str, Finder, Optional[List[str]]], Resolution]
+
+def resolve_import(name:str, finder:Finder, extra_search:Optional[List[str]],
+        resolve_parent:ParentResolver=None) -> Resolution:
+    '''
+    Search for the given name using the given module finder, and optionally
+    search in the given additional search dirs.  Return the module's package
+    directory (if a package), and a list of paths to all of the module's
+    ancestors, ordered from most to least distant.
+    @param resolve_parent used to resolve the module's parent package.
+      Defaults to resolve_import.
+    '''
+    if not name:
+        # A relative import, eg "from . import foo"
+        raise ImportError('Relative imports are not supported')
+
+    if 'os.path' == name:
+        # paper over dynamic import hijinks
+        return None, [i.replace('.pyc', '.py') for i in [
+            os.__file__, os.path.__file__]]
+
+    if '.' in name:
+        pkg, mod = name.rsplit(".", 1)
+        parent, paths = (resolve_parent or resolve_import)(
+            pkg, finder, extra_search)
+        paths = list(paths)
+    else:
+        mod = name
+        parent = None
+        paths = []
+
+    if parent:
+        f, pathname, desc = finder(mod, [parent])
+    else:
+        try:
+            f, pathname, desc = finder(mod, None)
+        except ImportError:
+            if not extra_search:
+                raise
+            f, pathname, desc = finder(mod, extra_search)
+
+    if f:
+        f.close()
+
+    if desc[2] == PY_SOURCE:
+        assert pathname
+        paths.append(pathname)
+        return None, paths
+    elif desc[2] == PKG_DIRECTORY:
+        assert pathname
+        paths.append(os.path.join(pathname, '__init__.py'))
+        return pathname, paths
+    elif desc[2] == C_BUILTIN:
+        return None, paths
+    else:
+        raise ImportError('Unknown module type: {}'.format(desc[2]))
+
+# Directory -> mtime (ns), or -1 if the directory could not be read
+Deps = Dict[str, int]
+
+class _Memo(object):
+    def __init__(self,
+            result:Union[Resolution, ImportError], deps:Deps, checked:float
+            ) -> None:
+        self.result = result
+        self.deps = deps
+        self.checked = checked
+
+class ImportResolver(object):
+    '''
+    Resolves dotted module names like resolve_import, but memoizes the results
+    (including failures) for every name and parent package it resolves.
+
+    Names in the given module_map are resolved from it, without touching the
+    filesystem.  Otherwise, unless a finder is given, modules are found by
+    searching cached listings of the search path's directories.  A cached
+    listing or resolution is invalidated when the mtime of a directory it
+    depends on changes.  To keep lookups cheap, a memoized resolution is
+    re-validated at most once per check_interval seconds.
+    '''
+
+    def __init__(self,
+            search_path:List[str]=None,
+            finder:Finder=None,
+            check_interval:float=1.0,
+            module_map:ModuleMap=None) -> None:
+        self.search_path = list(search_path if search_path is not None
+            else sys.path)
+        self.check_interval = check_interval
+        self.module_map = module_map
+        self._custom_finder = finder
+        self._listings: Dict[str, Tuple[int, FrozenSet[str]]] = {}
+        self._memo: Dict[Tuple[str, Tuple[str, ...]], _Memo] = {}
+        # Stack of deps of the resolutions in progress on each thread
+        self._local = threading.local()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Caches are cheap to rebuild, and thread locals can't be pickled
+        return {
+            'search_path': self.search_path,
+            'finder': self._custom_finder,
+            'check_interval': self.check_interval,
+            'module_map': self.module_map
+        }
+
+    def __setstate__(self, state:Dict[str, Any]) -> None:
+        self.__init__(**state) # type: ignore
+
+    @property
+    def finder(self) -> Finder:
+        return self._custom_finder or self.find_module
+
+    def invalidate(self) -> None:
+        '''
+        Drop all cached listings and resolutions.
+        '''
+        self._listings.clear()
+        self._memo.clear()
+
+    def resolve(self, name:str, extra_search:List[str]=None) -> Resolution:
+        '''
+        As resolve_import, using this resolver's finder.
+        '''
+        if self.module_map is not None and name:
+            res = self._resolve_in_map(name, self.module_map)
+            if res is not None:
+                return res
+        return self._resolve(name, self.finder, extra_search)
+
+    def _resolve_in_map(self, name:str, module_map:ModuleMap
+            ) -> Optional[Resolution]:
+        '''
+        Resolve the given name from the module map.  Returns None if the name
+        isn't known to be inside the workspace.
+        '''
+        parts = name.split('.')
+        paths: List[str] = []
+        for i in range(len(parts)):
+            path = module_map.find('.'.join(parts[:i + 1]))
+            if path is None:
+                if paths and os.path.basename(paths[-1]) != '__init__.py':
+                    # Modules can't contain submodules
+                    raise ImportError('No module named {!r}'.format(name))
+                # Not in the workspace.  Or, a name or non-python module
+                # inside a workspace package; let the finder sort it out.
+                return None
+            paths.append(path)
+        if os.path.basename(paths[-1]) == '__init__.py':
+            return os.path.dirname(paths[-1]), paths
+        return None, paths
+
+    def _resolve(self, name:str, finder:Finder,
+            extra_search:Optional[List[str]]) -> Resolution:
+        key = (name, tuple(extra_search) if extra_search else ())
+        now = time.monotonic()
+        memo = self._memo.get(key)
+        if memo is not None and now - memo.checked >= self.check_interval:
+            if self._still_valid(memo.deps):
+                memo.checked = now
+            else:
+                memo = None
+
+        if memo is None:
+            stack = self._deps_stack()
+            stack.append({})
+            try:
+                result: Union[Resolution, ImportError] = resolve_import(
+                    name, finder, extra_search, self._resolve)
+            except ImportError as e:
+                result = ImportError(str(e))
+            finally:
+                deps = stack.pop()
+            memo = _Memo(result, deps, now)
+            self._memo[key] = memo
+
+        stack = self._deps_stack()
+        if stack:
+            # A parent's dependencies are also those of its children
+            stack[-1].update(memo.deps)
+
+        if isinstance(memo.result, ImportError):
+            raise ImportError(str(memo.result))
+        pkg_dir, paths = memo.result
+        return pkg_dir, list(paths)
+
+    def find_module(self, mod:str, paths:Optional[List[str]]
+            ) -> Tuple[Optional[IO], str, FoundDesc]:
+        '''
+        A Finder with the semantics of imp.find_module, except that no file is
+        ever opened.  Searches paths, or the search path if paths is None.
+        '''
+        if paths is None and mod in sys.builtin_module_names:
+            return None, mod, ('', '', C_BUILTIN)
+
+        for d in (paths if paths is not None else self.search_path):
+            d = d or os.curdir
+            entries = self._listdir(d)
+            if entries is None:
+                continue
+            if mod in entries:
+                pkg = os.path.join(d, mod)
+                pkg_entries = self._listdir(pkg)
+                if pkg_entries is not None and '__init__.py' in pkg_entries:
+                    return None, pkg, ('', '', PKG_DIRECTORY)
+            for suffix in EXTENSION_SUFFIXES:
+                if mod + suffix in entries:
+                    return None, os.path.join(d, mod + suffix), (
+                        suffix, 'rb', C_EXTENSION)
+            if mod + '.py' in entries:
+                return None, os.path.join(d, mod + '.py'), (
+                    '.py', 'r', PY_SOURCE)
+            if mod + '.pyc' in entries:
+                return None, os.path.join(d, mod + '.pyc'), (
+                    '.pyc', 'rb', PY_COMPILED)
+        raise ImportError('No module named {!r}'.format(mod))
+
+    def _deps_stack(self) -> List[Deps]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _mtime(self, d:str) -> int:
+        try:
+            return os.stat(d).st_mtime_ns
+        except OSError:
+            return -1
+
+    def _still_valid(self, deps:Deps) -> bool:
+        return all(self._mtime(d) == mtime for d, mtime in deps.items())
+
+    def _listdir(self, d:str) -> Optional[FrozenSet[str]]:
+        '''
+        Return the entries of the given directory, or None if it can't be
+        listed, recording it as a dependency of resolutions in progress.
+        '''
+        mtime = self._mtime(d)
+        stack = self._deps_stack()
+        if stack:
+            stack[-1][d] = mtime
+        if mtime < 0:
+            return None
+
+        cached = self._listings.get(d)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            entries = frozenset(os.listdir(d))
+        except OSError:
+            return None
+        self._listings[d] = (mtime, entries)
+        return entries
+
+# Shared by parsers and graph nodes, unless they are given their own
+default_resolver = ImportResolver()
+
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+from workspace.path import Path
+
+MockModules = Dict[
+    Tuple[str, Optional[Tuple[str, ...]]], Tuple[str, int]]
+
+def make_finder(modules:MockModules) -> Finder:
+    def res(name:str, paths:Optional[List[str]]
+            ) -> Tuple[Optional[IO], str, FoundDesc]:
+        path_tup:Optional[Tuple[str, ...]] = tuple(paths) if paths else None
+        if (name, path_tup) in modules:
+            path, typ = modules[(name, path_tup)]
+            return (None, path, (None, None, typ))
+        else:
+            raise ImportError('Failed to find {} in {}'.format(
+                name, path_tup))
+    return res
+
+class ResolveImportTest(unittest.TestCase):
+    def test_resolve_top(self) -> None:
+        mock_finder = make_finder({
+            ('mod', None): ('mod.py', PY_SOURCE)
+        })
+        parent, paths = resolve_import('mod', mock_finder, None)
+        self.assertIsNone(parent)
+        self.assertEqual(paths, ['mod.py'])
+
+    def test_resolve_pkg(self) -> None:
+        mock_finder = make_finder({
+            ('pkg', None): ('pkg/', PKG_DIRECTORY)
+        })
+        parent, paths = resolve_import('pkg', mock_finder, None)
+        self.assertEqual(parent, 'pkg/')
+        self.assertEqual(paths, ['pkg/__init__.py'])
+
+    def test_resolve_in_pkg(self) -> None:
+        mock_finder = make_finder({
+            ('mod', ('pkg/',)): ('pkg/mod.py', PY_SOURCE),
+            ('pkg', None): ('pkg/', PKG_DIRECTORY)
+        })
+        parent, paths = resolve_import('pkg.mod', mock_finder, None)
+        self.assertIsNone(parent)
+        self.assertEqual(paths, ['pkg/__init__.py', 'pkg/mod.py'])
+
+    def test_resolve_relative(self) -> None:
+        with self.assertRaises(ImportError):
+            resolve_import(None, make_finder({}), None) # type: ignore
+
+class ImportResolverTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'pkg', 'sub'))
+        for f in ['mod.py', 'pkg/__init__.py', 'pkg/a.py',
+                'pkg/sub/__init__.py', 'pkg/sub/b.py']:
+            open(os.path.join(self.dir, f), 'w').close()
+        self.r = ImportResolver(search_path=[self.dir], check_interval=0)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def j(self, *parts:str) -> str:
+        return os.path.join(self.dir, *parts)
+
+    def test_resolve_module(self) -> None:
+        self.assertEqual(self.r.resolve('mod'), (None, [self.j('mod.py')]))
+
+    def test_resolve_nested(self) -> None:
+        self.assertEqual(self.r.resolve('pkg.sub.b'), (None, [
+            self.j('pkg', '__init__.py'),
+            self.j('pkg', 'sub', '__init__.py'),
+            self.j('pkg', 'sub', 'b.py')]))
+        self.assertEqual(self.r.resolve('pkg.sub'), (self.j('pkg', 'sub'), [
+            self.j('pkg', '__init__.py'),
+            self.j('pkg', 'sub', '__init__.py')]))
+
+    def test_not_a_package(self) -> None:
+        os.mkdir(self.j('notpkg'))
+        open(self.j('notpkg', 'c.py'), 'w').close()
+        with self.assertRaises(ImportError):
+            self.r.resolve('notpkg.c')
+
+    def test_extra_search(self) -> None:
+        r = ImportResolver(search_path=[], check_interval=0)
+        with self.assertRaises(ImportError):
+            r.resolve('mod')
+        self.assertEqual(r.resolve('mod', [self.dir]),
+            (None, [self.j('mod.py')]))
+
+    def test_builtin(self) -> None:
+        self.assertEqual(self.r.resolve('sys'), (None, []))
+
+    def test_matches_imp(self) -> None:
+        r = ImportResolver()
+        try:
+            import imp
+        except ImportError:
+            self.skipTest('imp is not available')
+        for name in ['json', 'json.decoder', 'logging.handlers', 'unittest.mock']:
+            self.assertEqual(r.resolve(name), resolve_import(
+                name, imp.find_module, None), name)
+
+    def test_memoized(self) -> None:
+        self.r.check_interval = 60
+        self.r.resolve('pkg.sub.b')
+        with mock.patch('os.listdir') as listdir, \
+                mock.patch('os.stat') as stat:
+            self.r.resolve('pkg.sub.b')
+            self.r.resolve('pkg.sub')
+            listdir.assert_not_called()
+            stat.assert_not_called()
+
+    def test_failure_memoized(self) -> None:
+        self.r.check_interval = 60
+        with self.assertRaises(ImportError):
+            self.r.resolve('pkg.nope')
+        with mock.patch('os.listdir') as listdir:
+            with self.assertRaises(ImportError):
+                self.r.resolve('pkg.nope')
+            listdir.assert_not_called()
+
+    def test_revalidated_without_listing(self) -> None:
+        self.r.resolve('pkg.sub.b')
+        with mock.patch('os.listdir') as listdir:
+            self.r.resolve('pkg.sub.b')
+            listdir.assert_not_called()
+
+    def test_invalidated_by_mtime(self) -> None:
+        with self.assertRaises(ImportError):
+            self.r.resolve('pkg.sub.c')
+        open(self.j('pkg', 'sub', 'c.py'), 'w').close()
+        # Ensure the mtime moves, even on coarse-grained filesystems
+        st = os.stat(self.j('pkg', 'sub'))
+        os.utime(self.j('pkg', 'sub'),
+            ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.r.resolve('pkg.sub.c')[1][-1],
+            self.j('pkg', 'sub', 'c.py'))
+
+    def test_custom_finder(self) -> None:
+        finder = mock.MagicMock(wraps=make_finder({
+            ('mod', None): ('mod.py', PY_SOURCE)
+        }))
+        r = ImportResolver(finder=finder)
+        self.assertEqual(r.resolve('mod'), (None, ['mod.py']))
+        self.assertEqual(r.resolve('mod'), (None, ['mod.py']))
+        finder.assert_called_once_with('mod', None)
+
+    def test_module_map(self) -> None:
+        m = ModuleMap([self.dir])
+        m.files_changed(set(), set(Path(p, self.dir) for p in [
+            'mod.py', 'pkg/__init__.py', 'pkg/a.py']))
+        r = ImportResolver(search_path=[], module_map=m)
+        with mock.patch('os.listdir') as listdir, \
+                mock.patch('os.stat') as stat:
+            self.assertEqual(r.resolve('pkg.a'), (None, [
+                self.j('pkg', '__init__.py'), self.j('pkg', 'a.py')]))
+            self.assertEqual(r.resolve('pkg'), (self.j('pkg'), [
+                self.j('pkg', '__init__.py')]))
+            with self.assertRaises(ImportError):
+                r.resolve('mod.Classy')
+            listdir.assert_not_called()
+            stat.assert_not_called()
+
+    def test_module_map_falls_back(self) -> None:
+        m = ModuleMap([self.dir])
+        m.files_changed(set(), set(Path(p, self.dir) for p in ['mod.py']))
+        r = ImportResolver(search_path=[self.dir], module_map=m)
+        self.assertEqual(r.resolve('pkg.sub.b')[1][-1],
+            self.j('pkg', 'sub', 'b.py'))
+
+    def test_pickle(self) -> None:
+        import pickle
+        self.r.resolve('mod')
+        r = pickle.loads(pickle.dumps(self.r))
+        self.assertEqual(r.search_path, [self.dir])
+        self.assertEqual(r.resolve('mod'), (None, [self.j('mod.py')]))
+
+if __name__ == '__main__':
+    unittest.main()
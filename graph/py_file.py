@@ -10,16 +10,15 @@ import ast
 import logging
 import graph.edge as edge
 import graph.node as node
-from graph.parsers.python3 import resolve_import, make_finder
-import imp
+from graph.parsers.resolver import default_resolver
 import os.path
 from workspace.path import Path
 
 class PyFile(node.File):
-    def __init__(self, path, workspace, finder=imp.find_module, no_load=False):
+    def __init__(self, path, workspace, resolver=None, no_load=False):
         super(PyFile, self).__init__(path)
         self.workspace = workspace
-        self.finder = finder
+        self.resolver = resolver if resolver else default_resolver
         self.imports = set() # {'path'}
         self.functions = [] # [node.Function]
         self.classes = [] # [node.Class]
@@ -51,10 +50,10 @@ class PyFile(node.File):
         new_imports = set()
         for name, maybe_not_module in parsed_imports:
             try:
-                parent, paths = resolve_import(
-                    name, self.finder, self.workspace.python_path)
+                parent, paths = self.resolver.resolve(
+                    name, self.workspace.python_path)
                 new_imports.update(set(
-                    Path(os.path.realpath(p), self.workspace.root_dir)
+                    Path.canonical(os.path.realpath(p), self.workspace.root_dir)
                     for p in paths))
             except ImportError as e:
                 if not maybe_not_module:
@@ -77,17 +76,19 @@ class PyFile(node.File):
             self.outgoing.add(e)
             d.incoming.add(e)
 
-def new_file(path, workspace, external=False):
+def new_file(path, workspace, external=False, resolver=None):
     if not os.path.isfile(path.abs):
         return None
     if path.abs.endswith('.py'):
-        return PyFile(path, workspace, no_load=external)
+        return PyFile(path, workspace, resolver, no_load=external)
     elif path.abs.endswith('.pyc'):
         return None
     else:
         logging.debug('Unrecognized file type: {}'.format(path))
         return None
 
+from graph.parsers.resolver import (
+    ImportResolver, PKG_DIRECTORY, PY_SOURCE, make_finder)
 import tempfile
 import unittest
 import unittest.mock as mock
@@ -98,9 +99,9 @@ class PyFileTest(unittest.TestCase):
         self.dir = tempfile.mkdtemp()
         self.src = Path('src.py', self.dir)
         self.modules = {
-            ('mod', ('/root/pkg/',)): ('/root/pkg/mod.py', imp.PY_SOURCE),
-            ('pkg', ('/root/',)): ('/root/pkg/', imp.PKG_DIRECTORY),
-            ('root', None): ('/root/', imp.PKG_DIRECTORY)
+            ('mod', ('/root/pkg/',)): ('/root/pkg/mod.py', PY_SOURCE),
+            ('pkg', ('/root/',)): ('/root/pkg/', PKG_DIRECTORY),
+            ('root', None): ('/root/', PKG_DIRECTORY)
         }
         self.ws = mock.MagicMock()
 
@@ -115,14 +116,14 @@ class PyFileTest(unittest.TestCase):
     def test_load_malformed(self):
         with open(self.src.abs, 'w') as f:
             f.write('invalid python')
-        p = PyFile(self.src, self.ws, make_finder({}))
+        p = PyFile(self.src, self.ws, ImportResolver(finder=make_finder({})))
         self.assertEqual(p.imports, set())
 
     def test_load_import(self):
         with open(self.src.abs, 'w') as f:
             f.write('import root.pkg.mod')
         mock_finder = make_finder(self.modules)
-        p = PyFile(self.src, self.ws, mock_finder)
+        p = PyFile(self.src, self.ws, ImportResolver(finder=mock_finder))
         self.assertEqual(
             set(i.abs for i in p.imports),
             {'/root/__init__.py', '/root/pkg/__init__.py', '/root/pkg/mod.py'})
@@ -131,9 +132,10 @@ class PyFileTest(unittest.TestCase):
         with open(self.src.abs, 'w') as f:
             f.write('import root.foo as f, root.pkg.mod as m')
         self.modules.update({
-            ('foo', ('/root/',)): ('/root/foo.py', imp.PY_SOURCE)
+            ('foo', ('/root/',)): ('/root/foo.py', PY_SOURCE)
         })
-        p = PyFile(self.src, self.ws, make_finder(self.modules))
+        p = PyFile(self.src, self.ws,
+            ImportResolver(finder=make_finder(self.modules)))
         self.assertEqual(set(i.abs for i in p.imports),  {
             '/root/__init__.py',
             '/root/foo.py',
@@ -144,14 +146,16 @@ class PyFileTest(unittest.TestCase):
     def test_load_from_import_nonmod(self):
         with open(self.src.abs, 'w') as f:
             f.write('from root.pkg import Classy')
-        p = PyFile(self.src, self.ws, make_finder(self.modules))
+        p = PyFile(self.src, self.ws,
+            ImportResolver(finder=make_finder(self.modules)))
         self.assertEqual(set(i.abs for i in p.imports),
             {'/root/__init__.py', '/root/pkg/__init__.py'})
 
     def test_load_from_import_mod(self):
         with open(self.src.abs, 'w') as f:
             f.write('from root.pkg import mod')
-        p = PyFile(self.src, self.ws, make_finder(self.modules))
+        p = PyFile(self.src, self.ws,
+            ImportResolver(finder=make_finder(self.modules)))
         self.assertEqual(set(i.abs for i in p.imports),
             {'/root/__init__.py', '/root/pkg/__init__.py', '/root/pkg/mod.py'})
 
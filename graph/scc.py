@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+import logging
+import sys
+from typing import (
+    Callable, Dict, FrozenSet, Generic, Hashable, Iterable, Iterator, List,
+    Set, Tuple, TypeVar)
+
+log = logging.getLogger(__name__)
+
+N = TypeVar('N', bound=Hashable)
+
+DONE = sys.maxsize
+
+def strongly_connected(nodes:Iterable[N], successors:Callable[[N], Iterable[N]]
+        ) -> Iterator[List[N]]:
+    '''
+    Find the strongly connected components of a graph, with an iterative
+    Tarjan's algorithm.  Linear in nodes and edges.
+
+    Components are yielded in reverse topological order: each comes after all
+    of the components it has edges to.  Nodes reached only as successors are
+    included too.
+    '''
+    # Visit number, lowered to the lowlink while on the stack, and DONE once
+    # in a component, so that one lookup per edge does.
+    num: Dict[N, int] = {}
+    stack: List[N] = []
+    counter = 0
+
+    for root in nodes:
+        if root in num:
+            continue
+        num[root] = counter
+        # (node, its visit number, its stack position, remaining successors)
+        work: List[Tuple[N, int, int, Iterator[N]]] = [
+            (root, counter, len(stack), iter(successors(root)))]
+        stack.append(root)
+        counter += 1
+        while work:
+            v, index_v, pos, it = work[-1]
+            low_v = num[v]
+            for w in it:
+                x = num.get(w)
+                if x is None:
+                    num[v] = low_v
+                    num[w] = counter
+                    work.append((w, counter, len(stack), iter(successors(w))))
+                    stack.append(w)
+                    counter += 1
+                    break
+                elif x < low_v:
+                    low_v = x
+            else:
+                # All of v's successors are done
+                work.pop()
+                if low_v == index_v:
+                    component = stack[pos:]
+                    del stack[pos:]
+                    for w in component:
+                        num[w] = DONE
+                    yield component
+                else:
+                    num[v] = low_v
+                    u = work[-1][0]
+                    if low_v < num[u]:
+                        num[u] = low_v
+
+class Condensation(Generic[N]):
+    '''
+    Answers transitive reachability queries on a changing graph, via its
+    condensation: the DAG of its strongly connected components.
+
+    The closures of the most recently queried components are memoized, and
+    reused by queries which reach them.  Edge changes which don't change the components only
+    invalidate the closures which could include them.  Changes which merge or
+    may split components cause a rebuild at the next query.
+    '''
+    # Memoized closures kept in each direction
+    MAX_CLOSURES = 256
+
+    def __init__(self,
+            nodes:Callable[[], Iterable[N]],
+            successors:Callable[[N], Iterable[N]]) -> None:
+        self._nodes = nodes
+        self._successors = successors
+        self._dirty = True
+        self._comp_of: Dict[N, int] = {}
+        self._members: List[List[N]] = []
+        # component -> {successor component -> number of edges to it}
+        self._succ: List[Dict[int, int]] = []
+        self._pred: List[Set[int]] = []
+        # Components with internal edges, including self-loops
+        self._cyclic: Set[int] = set()
+        # component -> nodes reachable from it, in each direction
+        self._down: Dict[int, FrozenSet[N]] = {}
+        self._up: Dict[int, FrozenSet[N]] = {}
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def _build(self) -> None:
+        self._comp_of = {}
+        self._members = []
+        for comp in strongly_connected(self._nodes(), self._successors):
+            for n in comp:
+                self._comp_of[n] = len(self._members)
+            self._members.append(comp)
+        self._succ = [{} for _ in self._members]
+        self._pred = [set() for _ in self._members]
+        self._cyclic = set()
+        for u, cu in self._comp_of.items():
+            for v in self._successors(u):
+                cv = self._comp_of[v]
+                if cv != cu:
+                    self._succ[cu][cv] = self._succ[cu].get(cv, 0) + 1
+                    self._pred[cv].add(cu)
+                else:
+                    self._cyclic.add(cu)
+        self._down = {}
+        self._up = {}
+        self._dirty = False
+        log.debug('Condensed {} nodes to {} components'.format(
+            len(self._comp_of), len(self._members)))
+
+    def _component(self, n:N) -> int:
+        c = self._comp_of.get(n)
+        if c is None:
+            # A node new since the build, with no edges yet
+            c = self._comp_of[n] = len(self._members)
+            self._members.append([n])
+            self._succ.append({})
+            self._pred.append(set())
+        return c
+
+    def _closure(self, c:int, down:bool) -> FrozenSet[N]:
+        '''
+        Find the nodes reachable from component c by one or more edges.
+        '''
+        memo = self._down if down else self._up
+        res = memo.get(c)
+        if res is not None:
+            return res
+        edges = self._succ if down else self._pred
+        members = self._members
+        seen: Set[int] = set()
+        found: Set[N] = set()
+        if c in self._cyclic:
+            found.update(members[c])
+        todo = list(edges[c])
+        while todo:
+            x = todo.pop()
+            if x in seen:
+                continue
+            seen.add(x)
+            known = memo.get(x)
+            if known is not None:
+                # Covers everything below x
+                found.update(members[x])
+                found.update(known)
+            else:
+                found.update(members[x])
+                todo.extend(edges[x])
+        if len(memo) >= self.MAX_CLOSURES:
+            # Evict the oldest
+            del memo[next(iter(memo))]
+        res = memo[c] = frozenset(found)
+        return res
+
+    def _reaches(self, c:int, target:int) -> bool:
+        '''
+        Whether component target is reachable from component c, by a search
+        which stops once it's found and memoizes nothing.
+        '''
+        t = self._members[target][0]
+        seen: Set[int] = set()
+        todo = [c]
+        while todo:
+            x = todo.pop()
+            if x == target:
+                return True
+            if x in seen:
+                continue
+            seen.add(x)
+            known = self._down.get(x)
+            if known is not None:
+                if t in known:
+                    return True
+                continue
+            todo.extend(self._succ[x])
+        return False
+
+    def reachable(self, n:N, reverse:bool=False) -> FrozenSet[N]:
+        '''
+        Find all the nodes reachable from n by one or more edges (or, if
+        reverse, which reach n).  n itself is only included via a cycle.
+        '''
+        if self._dirty:
+            self._build()
+        return self._closure(self._component(n), not reverse)
+
+    def edge_added(self, u:N, v:N) -> None:
+        if self._dirty:
+            return
+        cu, cv = self._component(u), self._component(v)
+        if cu == cv:
+            if cu not in self._cyclic:
+                # A new self-import
+                self._dirty = True
+            return
+        if self._reaches(cv, cu):
+            # New cycle: components merge
+            self._dirty = True
+            return
+        count = self._succ[cu].get(cv, 0)
+        self._succ[cu][cv] = count + 1
+        if count == 0:
+            self._pred[cv].add(cu)
+            self._forget(cu, cv)
+
+    def edge_removed(self, u:N, v:N) -> None:
+        if self._dirty:
+            return
+        cu, cv = self._component(u), self._component(v)
+        if cu == cv:
+            # Component may split
+            self._dirty = True
+            return
+        count = self._succ[cu].get(cv, 0)
+        if count > 1:
+            self._succ[cu][cv] = count - 1
+        elif count == 1:
+            del self._succ[cu][cv]
+            self._pred[cv].discard(cu)
+            self._forget(cu, cv)
+
+    def _forget(self, cu:int, cv:int) -> None:
+        '''
+        Drop the memoized closures which an edge cu->cv could be part of.
+        '''
+        u, v = self._members[cu][0], self._members[cv][0]
+        for c in [c for c, r in self._down.items() if c == cu or u in r]:
+            del self._down[c]
+        for c in [c for c, r in self._up.items() if c == cv or v in r]:
+            del self._up[c]
+
+def bounded_reachable(n:N, successors:Callable[[N], Iterable[N]],
+        max_depth:int) -> Set[N]:
+    '''
+    Find the nodes reachable from n by between 1 and max_depth edges.
+    '''
+    res: Set[N] = set()
+    frontier = [n]
+    for _ in range(max_depth):
+        next_frontier = []
+        for x in frontier:
+            for y in successors(x):
+                if y not in res:
+                    res.add(y)
+                    next_frontier.append(y)
+        if not next_frontier:
+            break
+        frontier = next_frontier
+    return res
+
+import random
+import unittest
+
+class StronglyConnectedTest(unittest.TestCase):
+    def test_components(self) -> None:
+        g = {1: [2], 2: [3], 3: [1, 4], 4: [5], 5: [4], 6: [6], 7: []}
+        comps = list(strongly_connected(g, lambda n: g.get(n, [])))
+        self.assertEqual(sorted(sorted(c) for c in comps),
+            [[1, 2, 3], [4, 5], [6], [7]])
+        # Reverse topological order
+        order = [min(c) for c in comps]
+        self.assertLess(order.index(4), order.index(1))
+
+    def test_deep_chain(self) -> None:
+        # No recursion limit
+        n = 100000
+        comps = list(strongly_connected(
+            [0], lambda i: [i + 1] if i < n else [0]))
+        self.assertEqual(len(comps), 1)
+        self.assertEqual(len(comps[0]), n + 1)
+
+class CondensationTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.g: Dict[int, Set[int]] = {}
+        self.c = Condensation(lambda: list(self.g),
+            lambda n: self.g.get(n, set()))
+
+    def add(self, u:int, v:int) -> None:
+        self.g.setdefault(u, set()).add(v)
+        self.c.edge_added(u, v)
+
+    def remove(self, u:int, v:int) -> None:
+        self.g[u].discard(v)
+        self.c.edge_removed(u, v)
+
+    def brute(self, n:int, reverse:bool) -> Set[int]:
+        succ: Callable[[int], Iterable[int]] = lambda x: self.g.get(x, ())
+        if reverse:
+            succ = lambda x: [u for u, vs in self.g.items() if x in vs]
+        return bounded_reachable(n, succ, len(self.g) + 1)
+
+    def test_reachable(self) -> None:
+        for u, v in [(1, 2), (2, 3), (3, 1), (3, 4), (5, 4)]:
+            self.add(u, v)
+        self.assertEqual(self.c.reachable(4), set())
+        self.assertEqual(self.c.reachable(1), set([1, 2, 3, 4]))
+        self.assertEqual(self.c.reachable(4, reverse=True),
+            set([1, 2, 3, 5]))
+        self.assertEqual(self.c.reachable(5), set([4]))
+
+    def test_incremental_matches_brute_force(self) -> None:
+        rand = random.Random(3)
+        for _ in range(500):
+            u, v = rand.randrange(20), rand.randrange(20)
+            if rand.random() < 0.6:
+                self.add(u, v)
+            elif v in self.g.get(u, ()):
+                self.remove(u, v)
+            n = rand.randrange(20)
+            self.assertEqual(self.c.reachable(n), self.brute(n, False))
+            self.assertEqual(self.c.reachable(n, reverse=True),
+                self.brute(n, True))
+
+    def test_closures_bounded(self) -> None:
+        self.c.MAX_CLOSURES = 4
+        for i in range(10):
+            self.add(i, i + 1)
+        for i in range(10):
+            self.assertEqual(self.c.reachable(i), set(range(i + 1, 11)))
+        self.assertEqual(len(self.c._down), 4)
+        # Cycle checks of new edges don't memoize
+        for i in range(10):
+            self.add(i + 20, i)
+        self.assertLessEqual(len(self.c._down), 4)
+        self.add(10, 3)
+        self.assertEqual(self.c.reachable(5), set(range(3, 11)))
+
+    def test_bounded(self) -> None:
+        g = {1: [2], 2: [3], 3: [4]}
+        self.assertEqual(bounded_reachable(1, lambda n: g.get(n, []), 2),
+            set([2, 3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,64 +6,494 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
+from graph.adjacency import AdjacencyStore, NodeView
+from graph.db import DBException, FileStamp, Sqlite
 from graph.edge import Edge, EdgeType
 from graph.py_file import PyFile, new_file
 from graph.node import Node
+from graph.parsers.resolver import ImportResolver
+from graph.scc import Condensation, bounded_reachable
+import functools
+import itertools
 import logging
-from typing import Dict, List, Tuple
+import os
+import os.path
+import sqlite3
+import threading
+from typing import (
+    AbstractSet, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple,
+    Union)
+from workspace.dispatch import Dispatch
 from workspace.workspace import Workspace
 from workspace.path import Path
 
 log = logging.getLogger(__name__)
 
+# A PyFile, or a NodeView of a compact graph
+GraphNode = Union[PyFile, NodeView]
+
+def import_paths(imports:Iterable[Tuple[str, str]], ws_root:str) -> Set[Path]:
+    '''
+    Convert imports as recorded in the symbol index, (name, resolved path), to
+    the paths a PyFile imports.  The index records the __init__.py of each of
+    a module's parent packages as an import of its own, as importing does.
+    '''
+    return set(Path.canonical(resolved, ws_root) for _, resolved in imports)
+
 class SourceGraph(object):
-    def __init__(self, workspace:Workspace) -> None:
+    '''
+    The graph of imports between the python files of a workspace.
+
+    Normally all of the workspace is loaded up front.  In lazy mode, files are
+    only loaded when first found, at which point their import edges are
+    connected.  Their incoming edges come from an index of importers, which
+    is built with start_importer_index().
+
+    Files' imports are read from the workspace's symbol index where its entry
+    is up to date, and otherwise parsed.  The graph follows the workspace's
+    file changes, and should be told of saved files with file_saved().
+
+    In compact mode, edges are kept in an AdjacencyStore rather than on the
+    nodes, and nodes are NodeViews rather than PyFiles.
+
+    In background mode, the graph starts empty, and is filled by
+    start_build().
+    '''
+
+    # Files per batch of a background build
+    BUILD_BATCH = 200
+
+    def __init__(self, workspace:Workspace, lazy:bool=False,
+            compact:bool=False, background:bool=False) -> None:
         self.workspace = workspace
-        self.files, self.ext_files = self._load_files()
+        self.lazy = lazy
+        self.background = background and not lazy
+        # Whether a background build hasn't finished
+        self.building = self.background
+        self.store = AdjacencyStore() if compact else None
+        self.resolver = ImportResolver(module_map=workspace.module_map)
+        # Called with the nodes whose edges changed
+        self.node_listeners: List[Callable[[Set[GraphNode]], None]] = []
+        self.files: Dict[Path, GraphNode] = {}
+        self.ext_files: Dict[Path, GraphNode] = {}
+        # Paths of the nodes whose edges are connected
+        self._connected: Set[Path] = set()
+        # The imports of each workspace file known so far, and the reverse
+        self._imports: Dict[Path, Set[Path]] = {}
+        self._importers: Dict[Path, Set[Path]] = {}
+        # For transitive queries over the above
+        self._closure: Condensation[Path] = Condensation(
+            lambda: list(self._imports), lambda p: self._imports.get(p, ()))
+        # abs path -> (stamp, imports) of files in the symbol index
+        self._index: Dict[str, Tuple[FileStamp, List[Tuple[str, str]]]] = {}
+        self._read_index()
 
-        # connect all workspace files
-        for f in self.files.values():
-            f.visit(self)
+        if not lazy and not self.background:
+            self._load_files()
+        self.workspace.file_listeners.append(self.files_changed)
 
-    def _load_files(self) -> Tuple[Dict[Path, PyFile], Dict[Path, PyFile]]:
+    def _load_files(self) -> None:
         # First, load all the files in the workspace
-        files = {}
         for p in self.workspace.files:
-            f = new_file(p, self.workspace)
-            if f:
+            imports = self._read_imports(p)
+            if imports is not None:
                 log.debug('Loaded file: {}'.format(p))
-                files[p] = f
+                self.files[p] = self._new_node(p)
+                self._set_imports(p, imports)
+
+        # Then connect them, creating nodes for external imports
+        pairs = []
+        for f in list(self.files.values()):
+            self._connected.add(f.path)
+            f.imports = self._imports[f.path]
+            for i in f.imports:
+                d = self._stub(i)
+                if not d:
+                    continue
+                if isinstance(f, NodeView):
+                    assert isinstance(d, NodeView)
+                    pairs.append((f.id, d.id))
+                else:
+                    self._add_edge(f, d)
+        if self.store is not None:
+            self.store.add_edges(EdgeType.IMPORT, pairs)
+
+    def _read_index(self) -> None:
+        index_path = self.workspace.symbol_index
+        if not os.path.exists(index_path.abs):
+            return
+        try:
+            db = Sqlite(index_path)
+        except (DBException, sqlite3.Error) as e:
+            log.warning("Can't read symbol index: {}".format(e))
+            return
+        try:
+            stamps = db.dump_stamps()
+            imports = db.dump_all_imports()
+        finally:
+            db.close()
+        self._index = {p: (s, imports.get(p, [])) for p, s in stamps.items()}
+        log.info('Read imports of {} files from the symbol index'.format(
+            len(self._index)))
+
+    def _indexed_imports(self, path:Path) -> Optional[Set[Path]]:
+        '''
+        Get the imports of a workspace file from the symbol index, or None if
+        the index doesn't have them up to date.
+        '''
+        entry = self._index.get(path.abs)
+        if entry is None:
+            return None
+        stamp, imports = entry
+        try:
+            st = os.stat(path.abs)
+        except OSError:
+            return None
+        if (st.st_mtime_ns, st.st_size) != (stamp.mtime, stamp.size):
+            return None
+        return import_paths(imports, self.workspace.root_dir)
+
+    def _read_imports(self, path:Path) -> Optional[Set[Path]]:
+        '''
+        Get the imports of a workspace file, or None if it isn't a python
+        file.
+        '''
+        imports = self._indexed_imports(path)
+        if imports is not None:
+            return imports
+        f = new_file(path, self.workspace, resolver=self.resolver)
+        return f.imports if f else None
+
+    def _set_imports(self, path:Path, imports:Optional[Set[Path]]
+            ) -> Tuple[Set[Path], Set[Path]]:
+        '''
+        Record the imports of a workspace file, or forget them if None.
+        @return (imports removed, imports added)
+        '''
+        old = self._imports.pop(path, set())
+        new = imports if imports is not None else set()
+        if self.building:
+            # Not worth keeping closures up to date edge by edge
+            self._closure.invalidate()
+        if imports is not None:
+            self._imports[path] = imports
+        for i in old - new:
+            importers = self._importers[i]
+            importers.discard(path)
+            if not importers:
+                del self._importers[i]
+            self._closure.edge_removed(path, i)
+        for i in new - old:
+            self._importers.setdefault(i, set()).add(path)
+            self._closure.edge_added(path, i)
+        return old - new, new - old
+
+    @property
+    def import_map(self) -> Mapping[Path, AbstractSet[Path]]:
+        '''
+        The imports of each workspace file known so far.  Not to be modified.
+        '''
+        return self._imports
 
-        # Now, check each files for imports external to the workspace
-        ext_files:Dict = {}
-        for f in files.values():
-            ext = [i for i in f.imports if not i in files]
-            ext_files.update({e: None for e in ext})
+    def dependencies(self, path:Path, max_depth:Optional[int]=None
+            ) -> AbstractSet[Path]:
+        '''
+        Find the files path imports, directly or indirectly, up to max_depth
+        imports away.  path itself is included if it's part of a cycle.
 
-        # Load all the external files
-        for p in ext_files.keys():
-            ext_files[p] = new_file(p, self.workspace, external=True)
-            if not ext_files[p]:
-                del ext_files[p]
+        In lazy mode, this only follows the files loaded so far until the
+        importer index is built.
+        '''
+        if max_depth is not None:
+            return bounded_reachable(path,
+                lambda p: self._imports.get(p, ()), max_depth)
+        return self._closure.reachable(path)
 
-        return files, ext_files
+    def dependents(self, path:Path, max_depth:Optional[int]=None
+            ) -> AbstractSet[Path]:
+        '''
+        Find the files which import path, directly or indirectly, up to
+        max_depth imports away.  As for dependencies().
+        '''
+        if max_depth is not None:
+            return bounded_reachable(path,
+                lambda p: self._importers.get(p, ()), max_depth)
+        return self._closure.reachable(path, reverse=True)
 
-    def find_file(self, path:Path) -> PyFile:
+    def find_file(self, path:Path) -> GraphNode:
         assert isinstance(path, Path), str(path)
         if path in self.files:
-            return self.files[path]
+            f = self.files[path]
         elif path in self.ext_files:
-            return self.ext_files[path]
+            f = self.ext_files[path]
         else:
+            stub = self._stub(path) if self.lazy else None
+            if stub is None:
+                return None
+            f = stub
+        if path not in self._connected:
+            self._connect(f)
+        return f
+
+    def _node(self, path:Path) -> Optional[GraphNode]:
+        return self.files.get(path) or self.ext_files.get(path)
+
+    def _new_node(self, path:Path) -> GraphNode:
+        '''
+        Create an unconnected node for a python file.
+        '''
+        if self.store is not None:
+            return self.store.node(path)
+        return PyFile(path, self.workspace, no_load=True)
+
+    def _stub(self, path:Path) -> Optional[GraphNode]:
+        '''
+        Get the node for the given path, creating it unparsed and unconnected
+        if need be.
+        '''
+        f = self._node(path)
+        if f:
+            return f
+        if not path.abs.endswith('.py') or not os.path.isfile(path.abs):
             return None
+        f = self._new_node(path)
+        if path in self.workspace.files:
+            self.files[path] = f
+        else:
+            self.ext_files[path] = f
+        return f
+
+    def _connect(self, f:GraphNode) -> None:
+        '''
+        Load a lazily created node, and connect its edges.
+        '''
+        self._connected.add(f.path)
+        if f.path in self.files:
+            if f.path not in self._imports:
+                self._set_imports(f.path, self._read_imports(f.path) or set())
+            f.imports = self._imports[f.path]
+        for i in f.imports:
+            d = self._stub(i)
+            if d:
+                self._add_edge(f, d)
+        for i in self._importers.get(f.path, ()):
+            s = self._stub(i)
+            if s:
+                self._add_edge(s, f)
+
+    def _add_edge(self, source:GraphNode, dest:GraphNode) -> bool:
+        '''
+        @return whether the edge is new
+        '''
+        if isinstance(source, NodeView):
+            assert isinstance(dest, NodeView)
+            return source.store.add_edge(EdgeType.IMPORT, source.id, dest.id)
+        e = Edge(EdgeType.IMPORT, source, dest)
+        if e in source.outgoing:
+            return False
+        source.outgoing.add(e)
+        dest.incoming.add(e)
+        return True
+
+    def _remove_edge(self, source:GraphNode, dest:GraphNode) -> bool:
+        '''
+        @return whether the edge existed
+        '''
+        if isinstance(source, NodeView):
+            assert isinstance(dest, NodeView)
+            return source.store.remove_edge(
+                EdgeType.IMPORT, source.id, dest.id)
+        e = Edge(EdgeType.IMPORT, source, dest)
+        if e not in source.outgoing:
+            return False
+        source.outgoing.discard(e)
+        dest.incoming.discard(e)
+        return True
+
+    def files_changed(self, removed:Set[Path], added:Set[Path]) -> None:
+        '''
+        A Workspace file listener.
+        '''
+        changed: Set[GraphNode] = set()
+        for p in removed:
+            changed.update(self._remove(p))
+        for p in added:
+            changed.update(self._reload(p, appeared=True))
+        self._notify(changed)
+
+    def file_saved(self, path:Path) -> None:
+        '''
+        Update the graph for new content in the given file.
+        '''
+        if path in self.workspace.files:
+            self._notify(self._reload(path, appeared=False))
+
+    def _reload(self, path:Path, appeared:bool) -> Set[GraphNode]:
+        '''
+        Re-read the imports of a workspace file, and patch the edges which
+        changed.
+        @param appeared whether the file is new to the workspace
+        @return the nodes whose edges changed
+        '''
+        imports = self._read_imports(path)
+        if imports is None:
+            return self._remove(path)
+        removed, added = self._set_imports(path, imports)
+
+        changed: Set[GraphNode] = set()
+        f = self._node(path)
+        if f is None and not self.lazy:
+            f = self._stub(path)
+            self._connected.add(path)
+            appeared = True
+        if path in self._connected:
+            # All of the file's imports are connected
+            assert f is not None
+            f.imports = self._imports[path]
+            for i in removed:
+                d = self._node(i)
+                if d and self._remove_edge(f, d):
+                    changed.update([f, d])
+            for i in added:
+                d = self._stub(i)
+                if d and self._add_edge(f, d):
+                    changed.update([f, d])
+        else:
+            # Only its imports of connected files are
+            for i in removed:
+                d = self._node(i)
+                if f and d and i in self._connected and self._remove_edge(f, d):
+                    changed.update([f, d])
+            for i in added:
+                if i in self._connected:
+                    s = self._stub(path)
+                    d = self._node(i)
+                    if s and d and self._add_edge(s, d):
+                        changed.update([s, d])
+        if appeared:
+            for i in self._importers.get(path, ()):
+                if i in self._connected:
+                    s = self._node(i)
+                    d = self._stub(path)
+                    if s and d and self._add_edge(s, d):
+                        changed.update([s, d])
+        return changed
+
+    def _remove(self, path:Path) -> Set[GraphNode]:
+        '''
+        Drop a workspace file from the graph.  Its importers still import it,
+        so it is reconnected if it comes back.
+        @return the nodes whose edges changed
+        '''
+        self._set_imports(path, None)
+        self._connected.discard(path)
+        f = self.files.pop(path, None)
+        changed: Set[GraphNode] = set()
+        if f:
+            for e in f.outgoing | f.incoming:
+                self._remove_edge(e.source, e.dest)
+                changed.update([e.source, e.dest])
+            changed.discard(f)
+        return changed
+
+    def _notify(self, changed:Set[GraphNode]) -> None:
+        if changed:
+            for listener in self.node_listeners:
+                listener(changed)
+
+    def start_importer_index(self, dispatch:Dispatch) -> threading.Thread:
+        '''
+        Load all the workspace files on a background thread, to find what
+        imports each file.  The result is then applied to the graph via
+        dispatch, and node listeners are told of any new incoming edges.
+        '''
+        paths = list(self.workspace.files)
+        def run() -> None:
+            imports = self._index_imports(paths)
+            dispatch(functools.partial(self._apply_imports, imports))
+        t = threading.Thread(target=run, name='importer-index', daemon=True)
+        t.start()
+        return t
+
+    def start_build(self, dispatch:Dispatch) -> threading.Thread:
+        '''
+        Build a background mode graph: read the imports of the workspace files
+        on a background thread, and add them to the graph via dispatch, in
+        batches.  Node listeners are told of each batch's new nodes and
+        edges.
+        '''
+        assert self.background
+        paths = list(self.workspace.files)
+        def run() -> None:
+            for start in range(0, len(paths), self.BUILD_BATCH):
+                imports = self._index_imports(
+                    paths[start:start + self.BUILD_BATCH])
+                dispatch(functools.partial(self._load_batch, imports))
+            dispatch(self._build_done)
+        t = threading.Thread(target=run, name='graph-build', daemon=True)
+        t.start()
+        return t
+
+    def _load_batch(self, imports:Dict[Path, Set[Path]]) -> None:
+        changed: Set[GraphNode] = set()
+        for path, path_imports in imports.items():
+            if path in self._connected or path not in self.workspace.files:
+                # Loaded since by a save, or since removed
+                continue
+            self._set_imports(path, path_imports)
+            f = self._node(path)
+            if f is None:
+                f = self.files[path] = self._new_node(path)
+            self._connect(f)
+            changed.add(f)
+            for i in itertools.chain(
+                    path_imports, self._importers.get(path, ())):
+                n = self._node(i)
+                if n:
+                    changed.add(n)
+        self._notify(changed)
+
+    def _build_done(self) -> None:
+        self.building = False
+        log.info('Loaded {} files into the source graph'.format(
+            len(self.files)))
+
+    def _index_imports(self, paths:Iterable[Path]) -> Dict[Path, Set[Path]]:
+        res = {}
+        for p in paths:
+            imports = self._read_imports(p)
+            if imports is not None:
+                res[p] = imports
+        return res
+
+    def _apply_imports(self, imports:Dict[Path, Set[Path]]) -> None:
+        changed: Set[GraphNode] = set()
+        for path, path_imports in imports.items():
+            if path in self._imports or path not in self.workspace.files:
+                # Already known (at least as recently), or since removed
+                continue
+            self._set_imports(path, path_imports)
+            for i in path_imports:
+                if i in self._connected:
+                    s = self._stub(path)
+                    d = self._node(i)
+                    if s and d and self._add_edge(s, d):
+                        changed.update([s, d])
+        self._notify(changed)
 
 import os.path
 import shutil
 import sys
 import tempfile
 import unittest
+import unittest.mock as mock
 
 class SourceGraphTest(unittest.TestCase):
+    compact = False
+
+    def graph(self, w:Workspace, lazy:bool=False) -> SourceGraph:
+        return SourceGraph(w, lazy=lazy, compact=self.compact)
+
     def setUp(self) -> None:
         self.dir = tempfile.mkdtemp()
         self.ws = os.path.join(self.dir, '.workspace')
@@ -82,7 +512,7 @@ class SourceGraphTest(unittest.TestCase):
         with open(os.path.join(self.dir, 'baz.py'), 'w') as f:
             f.write('import shutil')
         w = Workspace(self.ws)
-        sg = SourceGraph(w)
+        sg = self.graph(w)
 
         self.assertEqual(set(sg.files.keys()),
             set(Path(f, self.dir) for f in ['foo.py', 'bar.py', 'baz.py']))
@@ -114,6 +544,277 @@ class SourceGraphTest(unittest.TestCase):
             Edge(EdgeType.IMPORT, foon, bazn),
             Edge(EdgeType.IMPORT, barn, bazn)]))
 
+    def test_lazy(self) -> None:
+        with open(os.path.join(self.dir, 'foo.py'), 'w') as f:
+            f.write('import bar')
+        with open(os.path.join(self.dir, 'bar.py'), 'w') as f:
+            f.write('import shutil')
+        with open(os.path.join(self.dir, 'baz.py'), 'w') as f:
+            f.write('import bar')
+        w = Workspace(self.ws)
+        sg = self.graph(w, lazy=True)
+        self.assertEqual(sg.files, {})
+
+        barn = sg.find_file(Path('bar.py', self.dir))
+        self.assertEqual(set(sg.files.keys()), set([Path('bar.py', self.dir)]))
+        shutiln = sg.find_file(Path(
+            shutil.__file__.replace('.pyc', '.py'), self.dir))
+        self.assertEqual(barn.outgoing, set([
+            Edge(EdgeType.IMPORT, barn, shutiln)]))
+        self.assertEqual(barn.incoming, set())
+
+        changed: List[Set[GraphNode]] = []
+        sg.node_listeners.append(changed.append)
+        sg.start_importer_index(lambda fn: fn()).join()
+        foon = sg.files[Path('foo.py', self.dir)]
+        bazn = sg.files[Path('baz.py', self.dir)]
+        self.assertEqual(barn.incoming, set([
+            Edge(EdgeType.IMPORT, foon, barn),
+            Edge(EdgeType.IMPORT, bazn, barn)]))
+        self.assertEqual(changed, [set([foon, bazn, barn])])
+
+        # Connecting the importer doesn't duplicate edges
+        self.assertIs(sg.find_file(Path('foo.py', self.dir)), foon)
+        self.assertEqual(foon.outgoing, set([
+            Edge(EdgeType.IMPORT, foon, barn)]))
+        self.assertEqual(len(barn.incoming), 2)
+
+    def write_sources(self) -> None:
+        os.mkdir(os.path.join(self.dir, 'pkg'))
+        for name, src in [
+                ('pkg/__init__.py', ''),
+                ('pkg/mod.py', ''),
+                ('foo.py', 'import pkg.mod'),
+                ('bar.py', 'import foo')]:
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(src)
+
+    def index(self, w:Workspace) -> None:
+        from graph.indexer import Indexer
+        from graph.parsers.python3 import Py3Parser
+        db = Sqlite(w.symbol_index, create=True)
+        parser = Py3Parser(w.python_path,
+            ImportResolver(module_map=w.module_map))
+        try:
+            Indexer(w, db, [parser]).update()
+        finally:
+            db.close()
+
+    def test_from_index(self) -> None:
+        self.write_sources()
+        w = Workspace(self.ws)
+        self.index(w)
+        parsed = self.graph(w)
+        with mock.patch.object(PyFile, '_load') as load:
+            sg = self.graph(w)
+            load.assert_not_called()
+        self.assertEqual(
+            {p: set(e.dest.path for e in f.outgoing)
+                for p, f in sg.files.items()},
+            {p: set(e.dest.path for e in f.outgoing)
+                for p, f in parsed.files.items()})
+        self.assertEqual(sg.files[Path('foo.py', self.dir)].imports, set([
+            Path('pkg/__init__.py', self.dir), Path('pkg/mod.py', self.dir)]))
+
+    def test_from_index_aliased_module(self) -> None:
+        # os.path resolves to posixpath.py (or ntpath.py), beside os.py rather
+        # than in an os package
+        with open(os.path.join(self.dir, 'foo.py'), 'w') as f:
+            f.write('import os.path')
+        w = Workspace(self.ws)
+        self.index(w)
+        parsed = self.graph(w)
+        with mock.patch.object(PyFile, '_load') as load:
+            sg = self.graph(w)
+            load.assert_not_called()
+        foo = Path('foo.py', self.dir)
+        self.assertEqual(sg.files[foo].imports, parsed.files[foo].imports)
+        self.assertIn(Path(os.path.realpath(os.__file__), self.dir),
+            sg.files[foo].imports)
+        self.assertEqual(set(e.dest.path for e in sg.files[foo].outgoing),
+            set(e.dest.path for e in parsed.files[foo].outgoing))
+
+    def test_stale_index(self) -> None:
+        self.write_sources()
+        w = Workspace(self.ws)
+        self.index(w)
+        with open(os.path.join(self.dir, 'bar.py'), 'w') as f:
+            f.write('import pkg')
+        for lazy in [False, True]:
+            sg = self.graph(w, lazy=lazy)
+            barn = sg.find_file(Path('bar.py', self.dir))
+            self.assertEqual(set(e.dest.path for e in barn.outgoing),
+                set([Path('pkg/__init__.py', self.dir)]))
+
+    def test_import_paths(self) -> None:
+        self.assertEqual(import_paths([
+                ('a', '/r/a/__init__.py'),
+                ('a.b', '/r/a/b.py'),
+                ('z', '/r/z.py'),
+                ('z', '/r/z.py')], '/r'),
+            set(Path(p, '/r') for p in ['a/__init__.py', 'a/b.py', 'z.py']))
+
+    def write(self, name:str, src:str) -> Path:
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(src)
+        return Path(name, self.dir)
+
+    def dests(self, n:GraphNode) -> Set[str]:
+        return set(e.dest.path.rel for e in n.outgoing)
+
+    def sources(self, n:GraphNode) -> Set[str]:
+        return set(e.source.path.rel for e in n.incoming)
+
+    def test_file_saved(self) -> None:
+        foo = self.write('foo.py', 'import bar')
+        self.write('bar.py', '')
+        self.write('baz.py', '')
+        w = Workspace(self.ws)
+        for lazy in [False, True]:
+            self.write('foo.py', 'import bar')
+            sg = self.graph(w, lazy=lazy)
+            changed: List[Set[GraphNode]] = []
+            sg.node_listeners.append(changed.append)
+            foon = sg.find_file(foo)
+            barn = sg.find_file(Path('bar.py', self.dir))
+            bazn = sg.find_file(Path('baz.py', self.dir))
+
+            self.write('foo.py', 'import baz')
+            sg.file_saved(foo)
+            self.assertEqual(self.dests(foon), set(['baz.py']))
+            self.assertEqual(self.sources(barn), set())
+            self.assertEqual(self.sources(bazn), set(['foo.py']))
+            self.assertEqual(changed, [set([foon, barn, bazn])])
+            w.file_listeners.remove(sg.files_changed)
+
+    def test_save_unconnected_lazy(self) -> None:
+        foo = self.write('foo.py', '')
+        self.write('bar.py', '')
+        w = Workspace(self.ws)
+        sg = self.graph(w, lazy=True)
+        barn = sg.find_file(Path('bar.py', self.dir))
+        self.write('foo.py', 'import bar')
+        sg.file_saved(foo)
+        self.assertEqual(self.sources(barn), set(['foo.py']))
+        self.assertNotIn(foo, sg._connected)
+        # Connecting it later finds the same edge
+        foon = sg.find_file(foo)
+        self.assertEqual(self.dests(foon), set(['bar.py']))
+        self.assertEqual(len(barn.incoming), 1)
+
+    def test_files_changed(self) -> None:
+        self.write('foo.py', 'import bar')
+        bar = self.write('bar.py', '')
+        w = Workspace(self.ws)
+        for lazy in [False, True]:
+            sg = self.graph(w, lazy=lazy)
+            foon = sg.find_file(Path('foo.py', self.dir))
+
+            os.unlink(bar.abs)
+            w.apply_file_changes(set([bar]), set())
+            self.assertEqual(self.dests(foon), set())
+            self.assertIsNone(sg.find_file(bar))
+
+            qux = self.write('qux.py', 'import foo')
+            self.write('bar.py', '')
+            w.apply_file_changes(set(), set([bar, qux]))
+            self.assertEqual(self.dests(foon), set(['bar.py']))
+            self.assertEqual(self.sources(sg.find_file(bar)), set(['foo.py']))
+            self.assertEqual(self.sources(foon), set(['qux.py']))
+
+            os.unlink(qux.abs)
+            w.apply_file_changes(set([qux]), set())
+            w.file_listeners.remove(sg.files_changed)
+
+    def test_transitive(self) -> None:
+        foo = self.write('foo.py', 'import bar')
+        bar = self.write('bar.py', 'import baz')
+        baz = self.write('baz.py', 'import bar')
+        qux = self.write('qux.py', '')
+        w = Workspace(self.ws)
+        sg = self.graph(w)
+        names = lambda ps: set(p.rel for p in ps)
+        self.assertEqual(names(sg.dependencies(foo)),
+            set(['bar.py', 'baz.py']))
+        self.assertEqual(names(sg.dependencies(bar)),
+            set(['bar.py', 'baz.py']))
+        self.assertEqual(names(sg.dependencies(foo, max_depth=1)),
+            set(['bar.py']))
+        self.assertEqual(names(sg.dependents(baz)),
+            set(['foo.py', 'bar.py', 'baz.py']))
+
+        # Follows saves, including ones that break cycles
+        self.write('baz.py', 'import qux')
+        sg.file_saved(baz)
+        self.assertEqual(names(sg.dependencies(foo)),
+            set(['bar.py', 'baz.py', 'qux.py']))
+        self.assertEqual(names(sg.dependencies(bar)),
+            set(['baz.py', 'qux.py']))
+        self.assertEqual(names(sg.dependents(qux)),
+            set(['foo.py', 'bar.py', 'baz.py']))
+        self.assertEqual(names(sg.dependents(qux, max_depth=2)),
+            set(['bar.py', 'baz.py']))
+        w.file_listeners.remove(sg.files_changed)
+
+    def test_background(self) -> None:
+        self.write_sources()
+        w = Workspace(self.ws)
+        eager = self.graph(w)
+        sg = SourceGraph(w, compact=self.compact, background=True)
+        self.assertEqual(sg.files, {})
+        self.assertIsNone(sg.find_file(Path('foo.py', self.dir)))
+
+        changed: List[Set[GraphNode]] = []
+        sg.node_listeners.append(changed.append)
+        batches: List[Callable[[], None]] = []
+        sg.BUILD_BATCH = 1
+        sg.start_build(batches.append).join()
+        # Nothing happens until the batches are dispatched
+        self.assertEqual(sg.files, {})
+        for b in batches:
+            b()
+        self.assertFalse(sg.building)
+        self.assertEqual(len(changed), len(eager.files))
+        self.assertEqual(set(sg.files), set(eager.files))
+        for p, f in eager.files.items():
+            self.assertEqual(self.dests(sg.files[p]), self.dests(f))
+            self.assertEqual(self.sources(sg.files[p]), self.sources(f))
+        w.file_listeners.remove(sg.files_changed)
+
+    def test_background_after_save(self) -> None:
+        self.write_sources()
+        w = Workspace(self.ws)
+        sg = SourceGraph(w, compact=self.compact, background=True)
+        batches: List[Callable[[], None]] = []
+        sg.start_build(batches.append).join()
+        foo = Path('foo.py', self.dir)
+        self.write('foo.py', 'import bar')
+        sg.file_saved(foo)
+        for b in batches:
+            b()
+        # The stale imports read by the build don't replace the saved ones
+        self.assertEqual(self.dests(sg.find_file(foo)), set(['bar.py']))
+        self.assertEqual(self.sources(sg.find_file(foo)), set(['bar.py']))
+        w.file_listeners.remove(sg.files_changed)
+
+    def test_lazy_unknown(self) -> None:
+        w = Workspace(self.ws)
+        sg = self.graph(w, lazy=True)
+        self.assertIsNone(sg.find_file(Path('nope.py', self.dir)))
+
+class CompactSourceGraphTest(SourceGraphTest):
+    compact = True
+
+    def test_compact_store(self) -> None:
+        self.write_sources()
+        w = Workspace(self.ws)
+        sg = self.graph(w)
+        self.assertTrue(sg.files)
+        for f in sg.files.values():
+            self.assertIsInstance(f, NodeView)
+        assert sg.store is not None
+        self.assertNotEqual(len(sg.store), 0)
+        w.file_listeners.remove(sg.files_changed)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -26,14 +26,27 @@ class EdgeView(Gtk.VBox):
         'location-selected': (GObject.SignalFlags.ACTION, None, (UILocation,))
     }
     
-    def __init__(self, edge_type):
+    def __init__(self, edge_type, transitive=None):
+        '''
+        @param transitive: optional function from a path to the paths it
+          reaches transitively in this view's direction.  If given, the view
+          has a toggle to show those instead of direct edges.
+        '''
         super(EdgeView, self).__init__()
         self.edge_type = edge_type
+        self.transitive = transitive
         self.cur_node = None
-        self.edges = []
+        self.paths = []
         
+        self.header = Gtk.HBox()
         self.label = Gtk.Label(label='Edges: '+edge_type)
-        self.pack_start(self.label, expand=False, fill=False, padding=0)
+        self.header.pack_start(self.label, expand=True, fill=True, padding=0)
+        self.transitive_toggle = Gtk.CheckButton(label='Transitive')
+        self.transitive_toggle.set_sensitive(transitive is not None)
+        self.transitive_toggle.connect('toggled', lambda _w: self.refresh())
+        self.header.pack_start(
+            self.transitive_toggle, expand=False, fill=False, padding=0)
+        self.pack_start(self.header, expand=False, fill=False, padding=0)
         
         self.tree_view = Gtk.TreeView(headers_visible=False)
         self.list_store = Gtk.ListStore(str)
@@ -42,41 +55,47 @@ class EdgeView(Gtk.VBox):
             'Reference', Gtk.CellRendererText(), text=0))
         self.tree_view.connect('row-activated', self.on_activate_row)
         self.pack_start(self.tree_view, expand=True, fill=True, padding=0)
+
+    @property
+    def is_transitive(self):
+        return self.transitive is not None and \
+            self.transitive_toggle.get_active()
         
     def set_current_node(self, node):
         self.list_store.clear()
         self.cur_node = node
-        self.edges = []
+        self.paths = []
         if not node:
             # There may not be a node for the current loc
             return
             
-        # Construct a list of (path, edge) tuples for sorting by path
-        elements = []
-        for e in getattr(self.cur_node, self.edge_type):
-            # XXX cheesy assumption edge is an import:
-            if self.edge_type is self.OUTGOING:
-                elements.append((e.dest.path, e))
-            elif self.edge_type is self.INCOMING:
-                elements.append((e.source.path, e))
-            else:
-                raise NotImplementedError()
+        if self.is_transitive:
+            paths = self.transitive(node.path)
+        else:
+            paths = []
+            for e in getattr(self.cur_node, self.edge_type):
+                # XXX cheesy assumption edge is an import:
+                if self.edge_type is self.OUTGOING:
+                    paths.append(e.dest.path)
+                elif self.edge_type is self.INCOMING:
+                    paths.append(e.source.path)
+                else:
+                    raise NotImplementedError()
         
-        for p, e in sorted(elements):
+        for p in sorted(paths, key=lambda p: p.abs):
             self.list_store.append([p.abbreviate(48)])
-            self.edges.append(e)
+            self.paths.append(p)
         
+    def refresh(self):
+        '''
+        Reload the edges of the current node.
+        '''
+        self.set_current_node(self.cur_node)
+
     def on_activate_row(self, widget, path, column):
         inx, = path.get_indices()
-        # XXX cheesy assumption edge is an import
-        if self.edge_type is self.OUTGOING:
-            path = self.edges[inx].dest.path
-        elif self.edge_type is self.INCOMING:
-            path = self.edges[inx].source.path
-        else:
-            raise NotImplementedError()
-            
-        self.emit('location-selected', UILocation(node.Location(path, 0, 0)))
+        self.emit('location-selected',
+            UILocation(node.Location(self.paths[inx], 0, 0)))
 
 def sandbox():        
     import unittest.mock as mock
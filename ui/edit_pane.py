@@ -8,10 +8,14 @@
 
 import collections
 from graph.source_graph import SourceGraph
-from gi.repository import Gtk, GObject, GtkSource
+from gi.repository import Gio, GLib, Gtk, GObject, GtkSource
 import logging
 import os.path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from ui.file_loader import FileLoader
+from ui.large_file import LargeFile
+from ui.large_file_view import LargeFileView
+from ui.save_queue import SaveQueue
 from ui.wrappers import UIPath
 from workspace.path import Path
 from workspace.workspace import Workspace
@@ -19,21 +23,72 @@ from workspace.workspace import Workspace
 log = logging.getLogger(__name__)
 
 class Tab(object):
+    '''
+    A notebook page.  Its view and buffer are only created when it's first
+    shown; until then, its scroll window is an empty placeholder.
+    '''
     def __init__(self,
-            src_view:GtkSource.View, 
-            buffer:GtkSource.Buffer,
+            page:Gtk.VBox,
+            scroll:Gtk.ScrolledWindow,
             path:Path, 
+            src_view:GtkSource.View=None, 
+            buffer:GtkSource.Buffer=None,
             search_ctx:GtkSource.SearchContext=None,
-            search_pos:Tuple[int, int]=None) -> None:
-        self.src_view = src_view
-        self.buffer = buffer
+            search_cancel:Gio.Cancellable=None) -> None:
+        self.page = page
+        self.scroll = scroll
+        self.src_view: Optional[GtkSource.View] = src_view
+        self.buffer: Optional[GtkSource.Buffer] = buffer
         self.path = path
-        self.search_ctx = search_ctx
-        self.search_pos = search_pos
+        self.search_ctx: Optional[GtkSource.SearchContext] = search_ctx
+        # Cancels the search for the next/previous match in progress
+        self.search_cancel: Optional[Gio.Cancellable] = search_cancel
+        # While the file is loading in the background
+        self.loader: Optional[FileLoader] = None
+        # Whether the buffer holds only part of the file, after a cancelled
+        # or failed load.  Such tabs can't be edited or saved.
+        self.partial = False
+        # For files too big to load, a view of part of them
+        self.large: Optional[LargeFileView] = None
+        # A line to go to once the file has loaded, counting from 1
+        self.pending_line: Optional[int] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.src_view is not None
+
+    @property
+    def view(self) -> GtkSource.View:
+        '''
+        The source view of a loaded tab.
+        '''
+        assert self.src_view is not None, 'Tab not loaded'
+        return self.src_view
+
+    @property
+    def buf(self) -> GtkSource.Buffer:
+        '''
+        The buffer of a loaded tab.
+        '''
+        assert self.buffer is not None, 'Tab not loaded'
+        return self.buffer
+
+    @property
+    def read_only(self) -> bool:
+        return self.loader is not None or self.partial or self.large is not None
 
 class EditPane(Gtk.Notebook):
+    # Bigger files are loaded in the background
+    SYNC_LOAD_SIZE = 1024 * 1024
+
     __gsignals__ = {
-        'switch-file': (GObject.SignalFlags.ACTION, None, (UIPath,))
+        'switch-file': (GObject.SignalFlags.ACTION, None, (UIPath,)),
+        'file-saved': (GObject.SignalFlags.ACTION, None, (UIPath,)),
+        # The selected match, counting from 1 (0 if none is), and the total
+        # (-1 while still counting)
+        'search-count': (GObject.SignalFlags.ACTION, None, (int, int)),
+        # Why there's no count, e.g. a bad regex
+        'search-status': (GObject.SignalFlags.ACTION, None, (str,)),
     }
 
     def __init__(self, 
@@ -48,16 +103,20 @@ class EditPane(Gtk.Notebook):
         self.src_graph = src_graph
         self.language_manager = GtkSource.LanguageManager()
         self.tabs:List[Tab] = []
+        self.save_queue = SaveQueue(lambda fn: GLib.idle_add(fn))
         self.connect('switch-page', self.change_page_handler)
 
         style_manager = GtkSource.StyleSchemeManager.get_default()
         self.style_scheme = style_manager.get_scheme(
             workspace.editor_options.get('style', 'classic'))
 
+        # Restored tabs are only loaded when they're shown
         for path in self.workspace.open_files:
-            self._open_file(path)
+            self._open_file(path, lazy=True)
         if not self.workspace.open_files:
             self._open_file(None)
+        if self.tabs:
+            self._load_tab(self.current_tab)
 
     def _to_display_path(self, path:Path)->str:
         if not path:
@@ -66,6 +125,8 @@ class EditPane(Gtk.Notebook):
 
     def open_file(self, path:Path=None)->None:
         assert (path is None) or isinstance(path, Path)
+        if path:
+            self.workspace.frecency.record(path)
         for i, t in enumerate(self.tabs):
             if path == t.path:
                 self.set_current_page(i)
@@ -83,48 +144,146 @@ class EditPane(Gtk.Notebook):
     def _update_open_files(self)->None:
         self.workspace.open_files = [i.path for i in self.tabs if i.path]
 
-    def _open_file(self, path:Path)->None:
+    def _open_file(self, path:Path, lazy:bool=False)->None:
+        scroll = Gtk.ScrolledWindow()
+        page = Gtk.VBox()
+        page.pack_start(scroll, expand=True, fill=True, padding=0)
+        tab = Tab(page, scroll, path)
+        self.tabs.append(tab)
+        if not lazy:
+            self._load_tab(tab)
+
+        display_path = self._to_display_path(path)
+        self.append_page(tab.page, Gtk.Label(label=display_path))
+        self.show_all()
+        if not lazy:
+            self.set_current_page(len(self.tabs) - 1)
+
+    def _load_tab(self, tab:Tab)->None:
+        '''
+        Read a tab's file, and create its view.
+        '''
+        if tab.loaded:
+            return
+        # XXX make this less of a hack
+        view_opts = self.workspace.editor_options
+        view_opts.pop('style', None)
+        large_size = view_opts.pop('large-file-size')
+
+        path = tab.path
+        size = 0
         if path:
+            try:
+                size = os.stat(path.abs).st_size
+            except OSError:
+                pass
+        if size > large_size:
+            try:
+                self._load_large(tab, view_opts)
+                return
+            except IOError as e:
+                log.info("Couldn't map {}: {}".format(path, e))
+        background = size > self.SYNC_LOAD_SIZE
+        content = ''
+        if path and not background:
             try:
                 with open(path.abs) as f:
                     content = f.read()
             except IOError as e:
-                content = ''
                 log.info("Couldn't open {}: {}".format(path, e))
-                
-        # XXX make this less of a hack
-        view_opts = self.workspace.editor_options
-        view_opts.pop('style', None)
+
         view = GtkSource.View(**view_opts)
 
         buf = GtkSource.Buffer()
-        if path:
-            buf.set_text(content)
+        buf.set_text(content)
         buf.set_language(self.language_manager.get_language("python"))
         buf.set_style_scheme(self.style_scheme)
-        buf.connect("changed", self.changed_handler)
         view.set_buffer(buf)
 
-        scroll = Gtk.ScrolledWindow()
-        scroll.add(view)
+        tab.src_view = view
+        tab.buffer = buf
+        tab.scroll.add(view)
+        view.show()
+        if background:
+            self._start_loading(tab)
+        else:
+            buf.connect("changed", self.changed_handler)
+
+    def _load_large(self, tab:Tab, view_opts:Dict)->None:
+        '''
+        Show a file too big for a buffer, read only, a window at a time.
+        '''
+        view = LargeFileView(LargeFile(tab.path.abs, index=False), view_opts,
+            self.style_scheme)
+        view.start_indexing(lambda fn: GLib.idle_add(fn))
+        tab.large = view
+        tab.src_view = view.src_view
+        tab.buffer = view.buffer
+        tab.page.remove(tab.scroll)
+        tab.page.pack_start(view, expand=True, fill=True, padding=0)
+        view.show_all()
 
-        self.tabs.append(Tab(view, buf, path))
+    def _start_loading(self, tab:Tab)->None:
+        '''
+        Stream a tab's file into its buffer from a worker thread, showing
+        progress and a cancel button above it.
+        '''
+        progress = Gtk.ProgressBar(show_text=True,
+            text='Loading {}'.format(tab.path.abbreviate(48)))
+        cancel = Gtk.Button(label='Cancel')
+        bar = Gtk.HBox()
+        bar.pack_start(progress, expand=True, fill=True, padding=0)
+        bar.pack_start(cancel, expand=False, fill=False, padding=0)
+        tab.page.pack_start(bar, expand=False, fill=False, padding=0)
+        tab.page.reorder_child(bar, 0)
+        bar.show_all()
 
-        display_path = self._to_display_path(path)
-        self.append_page(scroll, Gtk.Label(label=display_path))
-        self.show_all()
-        self.set_current_page(len(self.tabs) - 1)
+        # Until it's all there, the buffer mustn't be edited
+        tab.view.set_editable(False)
+        tab.buf.begin_not_undoable_action()
+
+        def on_chunk(text:str, fraction:float)->None:
+            tab.buf.insert(tab.buf.get_end_iter(), text)
+            progress.set_fraction(fraction)
+
+        def on_done(error:Optional[Exception])->None:
+            tab.buf.end_not_undoable_action()
+            tab.page.remove(bar)
+            if tab not in self.tabs:
+                # Closed while loading
+                pass
+            elif error is not None or loader.cancelled:
+                tab.partial = True
+                self.set_tab_label_text(tab.page,
+                    "(partial) "+self._to_display_path(tab.path))
+            else:
+                tab.view.set_editable(True)
+                tab.buf.connect("changed", self.changed_handler)
+            tab.loader = None
+            if tab.pending_line is not None and tab in self.tabs:
+                self._goto_line(tab, tab.pending_line)
+                if tab is self.current_tab:
+                    tab.view.grab_focus()
+            tab.pending_line = None
+
+        loader = tab.loader = FileLoader(tab.path.abs,
+            lambda fn: GLib.idle_add(fn), on_chunk, on_done)
+        cancel.connect('clicked', lambda _b: loader.cancel())
+        loader.start()
 
     def new_file_handler(self, widget:Gtk.Widget)->None:
         self.open_file()
 
     def changed_handler(self, widget:Gtk.Widget)->None:
         self.set_tab_label_text(
-            self.current_tab.src_view.get_parent(),
+            self.current_tab.page,
             "* "+self._to_display_path(self.current_tab.path))
 
     def save_handler(self, widget:Gtk.Widget)->None:
         tab = self.tabs[self.get_current_page()]
+        if tab.read_only:
+            log.warning("Not saving {}: it's read only".format(tab.path))
+            return
 
         if not tab.path:
             # XXX: deprecated use of positional args:
@@ -145,74 +304,170 @@ class EditPane(Gtk.Notebook):
                 dialog.destroy()
                 return
 
-        with open(tab.path.abs, "w") as f:
-            f.write(tab.buffer.get_text(
-                tab.buffer.get_start_iter(),
-                tab.buffer.get_end_iter(),
-                False))
+        # Only the snapshot is taken here; the write happens in the background
+        tab.buf.set_modified(False)
+        text = tab.buf.get_text(
+            tab.buf.get_start_iter(),
+            tab.buf.get_end_iter(),
+            False)
+        path = tab.path
+        self.save_queue.save(path.abs, text,
+            lambda error: self._saved(tab, path, error))
 
-        self.set_tab_label_text(
-            tab.src_view.get_parent(), self._to_display_path(tab.path))
+    def _saved(self, tab:Tab, path:Path, error:Optional[Exception])->None:
+        if error is not None:
+            # Still unsaved
+            tab.buf.set_modified(True)
+        elif tab in self.tabs and not tab.buf.get_modified():
+            # Not edited since the snapshot
+            self.set_tab_label_text(tab.page, self._to_display_path(tab.path))
+        if error is None:
+            self.emit('file-saved', UIPath(path))
 
     def close_tab_handler(self, widget:Gtk.Widget)->None:
         if not self.tabs:
             return
 
         current = self.get_current_page()
-        self.remove_page(current)
+        tab = self.tabs[current]
+        if tab.loader:
+            tab.loader.cancel()
+        if tab.large:
+            tab.large.close()
+        # Removing the page switches to another, so the tab must go first
         del self.tabs[current]
+        self.remove_page(current)
         self._update_open_files()
 
     def change_page_handler(
             self, _widget:Gtk.Widget, _page:Any, index:int)->None:
+        self._load_tab(self.tabs[index])
         if self.tabs[index].path is not None:
             self.emit('switch-file', UIPath(self.tabs[index].path))
             
-    def find_handler(self, pattern:str, move:int=0)->None:
+    def find_handler(self, pattern:str, move:int=0, regex:bool=False)->None:
         '''
         Update the current buffer to highlight the given pattern.
-        If move is nonzero, move that many matches forward (neg for back)
-        '''
-        if self.current_tab.search_ctx:
-            # Already have a  search context; update it / move
-            ctx = self.current_tab.search_ctx
-            settings = ctx.get_settings()
-            if settings.get_search_text() != pattern:
-                ctx.get_settings().set_search_text(pattern)
-            if move == 0:
-                return
-            # If a a move was requested, search for the next match
-            found = False
-            # Get an iterator, clamping to end of file / end of line if the buffer
-            # has been modified.
-            search_iter = self.current_tab.buffer.get_iter_at_line(min(
-                self.current_tab.search_pos[0], 
-                self.current_tab.buffer.get_line_count() - 1))
-            search_iter.forward_chars(min(
-                self.current_tab.search_pos[1], search_iter.get_chars_in_line()-1))
-            if move > 0:
-                (found, start, end) = ctx.forward(search_iter)
-            elif move < 0:
-                # Reverse start/end, mostly so that the logic choosing "end" as 
-                # search_pos below is straightforward
-                (found, end, start) = ctx.backward(search_iter)
-            # If a match was found, scroll to it and select it.
-            if found:
-                # Use the end of the match, so that we will move past on the next
-                # search.
-                self.current_tab.search_pos = (end.get_line(), end.get_line_offset())
-                self.current_tab.src_view.scroll_to_iter(end,
-                    within_margin=0.0, use_align=True, xalign=0.0, yalign=0.5)
-                self.current_tab.buffer.select_range(start, end)
-                # XXX: jump focus + hotkeys?
-        else:
+        If move is nonzero, select the next match forward (neg for back).
+
+        Matches are counted, and the next one found, in the background by
+        the search context, a slice at a time.  Changing the pattern cancels
+        the search for the next match, if it's still running.
+        '''
+        tab = self.current_tab
+        if not tab.search_ctx:
             # First search in this buffer; create a context.
-            settings = GtkSource.SearchSettings(
-                search_text=pattern, wrap_around=True)
-            self.current_tab.search_ctx = GtkSource.SearchContext(
-                buffer=self.current_tab.buffer, 
-                settings=settings)
-            self.current_tab.search_pos = (0, 0)
+            settings = GtkSource.SearchSettings(wrap_around=True)
+            tab.search_ctx = GtkSource.SearchContext(
+                buffer=tab.buf, settings=settings)
+            tab.search_ctx.connect('notify::occurrences-count',
+                lambda *_: self._update_count(tab))
+        ctx = tab.search_ctx
+        settings = ctx.get_settings()
+        if ((settings.get_search_text() or '') != pattern or
+                settings.get_regex_enabled() != regex):
+            self._cancel_search(tab)
+            settings.set_regex_enabled(regex)
+            settings.set_search_text(pattern)
+        error = ctx.get_regex_error()
+        if error is not None:
+            self.emit('search-status', error.message)
+            return
+        if tab.large:
+            if move:
+                # Only a window of the file is in the buffer
+                tab.large.find(pattern, move, regex=regex)
+            self.emit('search-status', 'Not counted in large files')
+            return
+        if move == 0 or not pattern:
+            self._update_count(tab)
+            return
+
+        self._cancel_search(tab)
+        cancel = tab.search_cancel = Gio.Cancellable()
+        # Search on from the current match, or the cursor
+        bounds = tab.buf.get_selection_bounds()
+        if bounds:
+            start, end = bounds
+        else:
+            start = end = tab.buf.get_iter_at_mark(tab.buf.get_insert())
+        if move > 0:
+            ctx.forward_async(end, cancel, self._found,
+                (tab, cancel, ctx.forward_finish))
+        else:
+            ctx.backward_async(start, cancel, self._found,
+                (tab, cancel, ctx.backward_finish))
+
+    def _cancel_search(self, tab:Tab)->None:
+        if tab.search_cancel:
+            tab.search_cancel.cancel()
+            tab.search_cancel = None
+
+    def _found(self, _ctx:GtkSource.SearchContext, result:Gio.AsyncResult,
+            data:Tuple[Tab, Gio.Cancellable, Callable])->None:
+        tab, cancel, finish = data
+        try:
+            res = finish(result)
+        except GLib.Error:
+            # Cancelled
+            return
+        if cancel.is_cancelled() or tab not in self.tabs:
+            return
+        tab.search_cancel = None
+        found, start, end = res[:3]
+        if found:
+            tab.buf.select_range(start, end)
+            tab.view.scroll_to_iter(end,
+                within_margin=0.0, use_align=True, xalign=0.0, yalign=0.5)
+        self._update_count(tab)
+
+    def _update_count(self, tab:Tab)->None:
+        if not self.tabs or tab is not self.current_tab:
+            return
+        ctx = tab.search_ctx
+        assert ctx is not None
+        index = 0
+        bounds = tab.buf.get_selection_bounds()
+        if bounds:
+            # -1 if not yet known
+            index = max(0, ctx.get_occurrence_position(*bounds))
+        self.emit('search-count', index, ctx.get_occurrences_count())
+
+    def goto_line(self, line:int)->None:
+        '''
+        Move the cursor to line, counting from 1, and scroll to it.  If the
+        file is still loading, this happens once it has loaded.
+        '''
+        tab = self.current_tab
+        if tab.loader:
+            tab.pending_line = line
+            return
+        self._goto_line(tab, line)
+        tab.view.grab_focus()
+
+    def _goto_line(self, tab:Tab, line:int)->None:
+        if tab.large:
+            tab.large.goto_line(line - 1)
+            return
+        it = tab.buf.get_iter_at_line(line - 1)
+        tab.buf.place_cursor(it)
+        tab.view.scroll_to_iter(it,
+            within_margin=0.0, use_align=True, xalign=0.0, yalign=0.5)
+
+    @property
+    def line_count(self)->Optional[int]:
+        '''
+        The number of lines in the current file, or None while it's still
+        loading and the count isn't known yet.
+        '''
+        tab = self.current_tab
+        if tab.large:
+            if not tab.large.file.complete:
+                return None
+            return tab.large.file.line_count
+        if tab.loader:
+            return None
+        return tab.buf.get_line_count()
 
 def sandbox()->None:
     import unittest.mock as mock
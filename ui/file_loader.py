@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Reads files for the editor on a worker thread, so that opening a big file
+doesn't block the main loop.
+'''
+
+import codecs
+import functools
+import io
+import locale
+import logging
+import os
+import threading
+from typing import Callable, Optional
+from workspace.dispatch import Dispatch, DispatchQueue
+
+log = logging.getLogger(__name__)
+
+class FileLoader(object):
+    '''
+    Reads a text file on a worker thread, and hands it to the main thread
+    in decoded chunks, via dispatch.
+
+    Decoding is as for open() in text mode: the locale's encoding, strictly,
+    with universal newlines.  At most max_pending chunks are read ahead of
+    the main thread, so a slow consumer doesn't end up with the whole file
+    queued in memory.
+    '''
+    CHUNK_SIZE = 256 * 1024
+    MAX_PENDING = 4
+
+    def __init__(self,
+            path:str,
+            dispatch:Dispatch,
+            on_chunk:Callable[[str, float], None],
+            on_done:Callable[[Optional[Exception]], None],
+            encoding:str=None,
+            chunk_size:int=CHUNK_SIZE,
+            max_pending:int=MAX_PENDING) -> None:
+        '''
+        @param on_chunk: called with each chunk of text, and the fraction of
+          the file read so far
+        @param on_done: called once with the error which stopped the read,
+          or None.  Also called after a cancel.
+        '''
+        self.path = path
+        self.dispatch = dispatch
+        self.on_chunk = on_chunk
+        self.on_done = on_done
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.chunk_size = chunk_size
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self._run, name='file-loader', daemon=True)
+        t.start()
+        return t
+
+    def cancel(self) -> None:
+        '''
+        Stop reading.  No more chunks are delivered, but on_done still is.
+        '''
+        self._cancelled.set()
+
+    def _run(self) -> None:
+        error: Optional[Exception] = None
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(self.encoding)(), translate=True)
+        try:
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                read = 0
+                while not self.cancelled:
+                    data = f.read(self.chunk_size)
+                    read += len(data)
+                    text = decoder.decode(data, final=not data)
+                    if text:
+                        self._pending.acquire()
+                        fraction = min(read / size, 1.0) if size else 1.0
+                        self.dispatch(functools.partial(
+                            self._deliver, text, fraction))
+                    if not data:
+                        break
+        except (IOError, ValueError) as e:
+            # ValueError covers decoding errors
+            log.info("Couldn't load {}: {}".format(self.path, e))
+            error = e
+        self.dispatch(lambda: self.on_done(error))
+
+    def _deliver(self, text:str, fraction:float) -> None:
+        self._pending.release()
+        if not self.cancelled:
+            self.on_chunk(text, fraction)
+
+import shutil
+import tempfile
+import unittest
+
+class FileLoaderTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'f.txt')
+        self.main = DispatchQueue()
+        self.chunks: list = []
+        self.done: list = []
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def loader(self, **kwargs) -> FileLoader:
+        return FileLoader(self.path, self.main.dispatch,
+            lambda text, fraction: self.chunks.append((text, fraction)),
+            self.done.append, encoding='utf-8', **kwargs)
+
+    def run_main(self) -> None:
+        self.main.run_until(lambda: bool(self.done))
+
+    def test_chunks(self) -> None:
+        # Multi-byte characters and \r\n straddle chunk boundaries
+        text = 'héllo\r\nwörld\r\n' * 100
+        with open(self.path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        self.loader(chunk_size=7, max_pending=2).start()
+        self.run_main()
+        self.assertEqual(''.join(c for c, _ in self.chunks),
+            text.replace('\r\n', '\n'))
+        self.assertEqual(self.chunks[-1][1], 1.0)
+        self.assertEqual(self.done, [None])
+
+    def test_cancel(self) -> None:
+        with open(self.path, 'w') as f:
+            f.write('x' * 1000)
+        loader = self.loader(chunk_size=10, max_pending=1)
+        loader.start()
+        self.main.run_one()
+        loader.cancel()
+        self.run_main()
+        self.assertLess(len(self.chunks), 3)
+        self.assertEqual(self.done, [None])
+
+    def test_errors(self) -> None:
+        with open(self.path, 'wb') as f:
+            f.write(b'ok\xff')
+        self.loader().start()
+        self.run_main()
+        self.assertIsInstance(self.done[0], UnicodeDecodeError)
+        self.done = []
+        os.unlink(self.path)
+        self.loader().start()
+        self.run_main()
+        self.assertIsInstance(self.done[0], IOError)
+
+if __name__ == '__main__':
+    unittest.main()
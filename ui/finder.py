@@ -6,37 +6,100 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
-from gi.repository import Gdk, Gtk, GObject
+from gi.repository import Gdk, GLib, Gtk, GObject
+from typing import Optional
 
 class Finder(Gtk.HBox):
+    '''
+    The search bar.  'search-changed' is only emitted once typing pauses, so
+    that a search doesn't restart on every keystroke.
+    '''
     __gsignals__ = {
         'search-changed': (GObject.SignalFlags.ACTION, None, (str,)),
         'next': (GObject.SignalFlags.ACTION, None, (str,)),
         'prev': (GObject.SignalFlags.ACTION, None, (str,)),
         'dismiss': (GObject.SignalFlags.ACTION, None, tuple()),
     }
+    # Milliseconds to wait for more typing
+    DEBOUNCE_MS = 150
     
     def __init__(self)->None:
         super(Finder, self).__init__(spacing=5)
+        self._timeout: Optional[int] = None
         
         self.entry = Gtk.Entry(placeholder_text="Find")
-        self.entry.connect('changed', lambda _: 
-            self.emit('search-changed', self.entry.get_text()))
+        self.entry.connect('changed', lambda _: self._changed())
         self.entry.connect('key-release-event', self.on_key_release)
         self.pack_start(self.entry, expand=True, fill=True, padding=0)
+
+        self.regex_toggle = Gtk.CheckButton(label="Regex")
+        self.regex_toggle.connect('toggled', lambda _: self._changed())
+        self.pack_start(self.regex_toggle, expand=False, fill=False, padding=0)
         
         self.next = Gtk.Button(label="Next")
-        self.next.connect('clicked', lambda _:  self.emit('next', self.entry.get_text()))
+        self.next.connect('clicked', lambda _: self._move('next'))
         self.pack_start(self.next, expand=False, fill=False, padding=0)
         
         self.prev = Gtk.Button(label="Prev")
-        self.prev.connect('clicked', lambda _: self.emit('prev', self.entry.get_text()))
+        self.prev.connect('clicked', lambda _: self._move('prev'))
         self.pack_start(self.prev, expand=False, fill=False, padding=0)
+
+        self.count = Gtk.Label()
+        self.pack_start(self.count, expand=False, fill=False, padding=0)
+
+    @property
+    def regex(self)->bool:
+        return self.regex_toggle.get_active()
+
+    def _changed(self)->None:
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+        self._timeout = GLib.timeout_add(self.DEBOUNCE_MS, self._flush)
+
+    def _flush(self)->bool:
+        '''
+        Emit any pending 'search-changed' now.
+        '''
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+            self.emit('search-changed', self.entry.get_text())
+        return False
+
+    def _move(self, signal:str)->None:
+        # Search for what's been typed, not what was last searched for
+        self._flush()
+        self.emit(signal, self.entry.get_text())
+
+    def set_count(self, index:int, total:int)->None:
+        '''
+        Show which match is selected, out of how many.
+
+        @param index: the selected match, counting from 1, or 0 if none is
+        @param total: the number of matches, or -1 if still counting
+        '''
+        if not self.entry.get_text():
+            text = ""
+        elif total < 0:
+            text = "{} of …".format(index) if index > 0 else "Counting…"
+        elif total == 0:
+            text = "No matches"
+        elif index > 0:
+            text = "{} of {}".format(index, total)
+        else:
+            text = "{} matches".format(total)
+        self.count.set_text(text)
+
+    def set_status(self, message:str)->None:
+        self.count.set_text(message)
         
     def on_key_release(self, widget:Gtk.Widget, ev:Gdk.Event)->None:
         if ev.keyval == Gdk.KEY_Escape:
             self.emit('dismiss')
+        elif ev.keyval == Gdk.KEY_Return:
+            self._move('next')
     
+import time
 import unittest
 from unittest.mock import MagicMock
 
@@ -51,11 +114,33 @@ class FinderTest(unittest.TestCase):
         
     def test_emits_on_change(self)->None:
         f = Finder()
+        f.DEBOUNCE_MS = 10
         on_change = MagicMock()
         f.connect('search-changed', on_change)
+        f.entry.set_text("foo")
         f.entry.set_text("foof")
-        self.dispatch_events()
-        on_change.assert_called_with(f, "foof")
+        end = time.time() + 1
+        while not on_change.called and time.time() < end:
+            Gtk.main_iteration_do(blocking=False)
+        on_change.assert_called_once_with(f, "foof")
+
+    def test_next_flushes_change(self)->None:
+        f = Finder()
+        on_change = MagicMock()
+        f.connect('search-changed', on_change)
+        f.entry.set_text("foof")
+        f.next.clicked()
+        on_change.assert_called_once_with(f, "foof")
+
+    def test_count(self)->None:
+        f = Finder()
+        f.entry.set_text("foof")
+        f.set_count(2, 5)
+        self.assertEqual(f.count.get_text(), "2 of 5")
+        f.set_count(0, -1)
+        self.assertEqual(f.count.get_text(), "Counting…")
+        f.set_count(0, 0)
+        self.assertEqual(f.count.get_text(), "No matches")
         
     def test_click_next(self)->None:
         f = Finder()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+from gi.repository import Gdk, GLib, Gtk, GObject
+from graph.node import Location
+import logging
+import re
+from typing import List, Optional
+from ui.wrappers import UILocation
+from workspace.grep import Grep, GrepMatch, workspace_files
+from workspace.workspace import Workspace
+
+log = logging.getLogger(__name__)
+
+class GrepView(Gtk.VBox):
+    '''
+    Find in files: searches the workspace in the background, listing
+    matches as they're found.
+    '''
+    __gsignals__ = {
+        'location-selected': (GObject.SignalFlags.ACTION, None, (UILocation,)),
+        'dismiss': (GObject.SignalFlags.ACTION, None, tuple()),
+    }
+    # Matches listed before the search is stopped
+    MAX_RESULTS = 10000
+
+    def __init__(self, workspace:Workspace) -> None:
+        super(GrepView, self).__init__(spacing=5)
+        self.workspace = workspace
+        self.grep: Optional[Grep] = None
+        self.matches: List[GrepMatch] = []
+        self.files = 0
+
+        header = Gtk.HBox(spacing=5)
+        self.entry = Gtk.Entry(placeholder_text="Find in files")
+        self.entry.connect('activate', lambda _: self.search())
+        self.entry.connect('key-release-event', self.on_key_release)
+        header.pack_start(self.entry, expand=True, fill=True, padding=0)
+        self.regex_toggle = Gtk.CheckButton(label="Regex")
+        header.pack_start(self.regex_toggle, expand=False, fill=False, padding=0)
+        self.case_toggle = Gtk.CheckButton(label="Ignore case")
+        header.pack_start(self.case_toggle, expand=False, fill=False, padding=0)
+        self.search_button = Gtk.Button(label="Search")
+        self.search_button.connect('clicked', lambda _: self.search())
+        header.pack_start(self.search_button, expand=False, fill=False,
+            padding=0)
+        self.cancel_button = Gtk.Button(label="Cancel", sensitive=False)
+        self.cancel_button.connect('clicked', lambda _: self.cancel())
+        header.pack_start(self.cancel_button, expand=False, fill=False,
+            padding=0)
+        self.pack_start(header, expand=False, fill=False, padding=0)
+
+        self.list_store = Gtk.ListStore(str, str)
+        self.tree_view = Gtk.TreeView(headers_visible=False)
+        self.tree_view.set_model(self.list_store)
+        self.tree_view.append_column(Gtk.TreeViewColumn(
+            'Location', Gtk.CellRendererText(), text=0))
+        self.tree_view.append_column(Gtk.TreeViewColumn(
+            'Line', Gtk.CellRendererText(), text=1))
+        self.tree_view.connect('row-activated', self.on_activate_row)
+        scroll = Gtk.ScrolledWindow(height_request=200)
+        scroll.add(self.tree_view)
+        self.pack_start(scroll, expand=True, fill=True, padding=0)
+
+        self.status = Gtk.Label(xalign=0.0)
+        self.pack_start(self.status, expand=False, fill=False, padding=0)
+
+    def search(self) -> None:
+        '''
+        Start a search for the entry's text, cancelling any still running.
+        '''
+        self.cancel()
+        self.list_store.clear()
+        self.matches = []
+        self.files = 0
+        try:
+            grep = Grep(self.entry.get_text(),
+                regex=self.regex_toggle.get_active(),
+                ignore_case=self.case_toggle.get_active())
+        except (re.error, ValueError) as e:
+            self.status.set_text(str(e))
+            return
+        self.grep = grep
+        self.cancel_button.set_sensitive(True)
+        self.status.set_text("Searching…")
+        grep.start(workspace_files(self.workspace),
+            lambda fn: GLib.idle_add(fn),
+            self._add_matches,
+            lambda: self._done(grep))
+
+    def cancel(self) -> None:
+        if self.grep:
+            self.grep.cancel()
+            self._done(self.grep)
+
+    def _add_matches(self, matches:List[GrepMatch]) -> None:
+        self.files += 1
+        for m in matches:
+            self.list_store.append(['{}:{}'.format(m.path.rel, m.line),
+                m.text.strip()])
+        self.matches.extend(matches)
+        self.status.set_text("Searching… {} matches in {} files".format(
+            len(self.matches), self.files))
+        if len(self.matches) >= self.MAX_RESULTS:
+            self.cancel()
+            self.status.set_text("Stopped at {} matches in {} files".format(
+                len(self.matches), self.files))
+
+    def _done(self, grep:Grep) -> None:
+        if grep is not self.grep:
+            # A stale search
+            return
+        self.grep = None
+        self.cancel_button.set_sensitive(False)
+        self.status.set_text("{}{} matches in {} files".format(
+            "Cancelled: " if grep.cancelled else "",
+            len(self.matches), self.files))
+
+    def on_activate_row(self, _widget:Gtk.Widget, path:Gtk.TreePath,
+            _column:Gtk.TreeViewColumn) -> None:
+        m = self.matches[path.get_indices()[0]]
+        self.emit('location-selected',
+            UILocation(Location(m.path, m.line, m.column)))
+
+    def on_key_release(self, widget:Gtk.Widget, ev:Gdk.Event) -> None:
+        if ev.keyval == Gdk.KEY_Escape:
+            self.emit('dismiss')
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Line-addressed access to files too big to hold in a buffer, read through
+a memory map.
+'''
+
+from array import array
+import bisect
+import functools
+import locale
+import logging
+import mmap
+import os
+import re
+import threading
+from typing import Callable, List, Optional, Tuple, Union
+from workspace.dispatch import Dispatch
+
+log = logging.getLogger(__name__)
+
+class LargeFile(object):
+    '''
+    A read-only, memory mapped text file, indexed by line.
+
+    Rather than the offset of every line, the index holds the number of
+    newlines before each block of the file, so it stays small however many
+    lines there are.  Lines within a block are found by scanning it.  Offsets
+    are in bytes; lines are numbered from 0.
+
+    Only \n ends a line.  A \r before it is dropped from the text, and a lone
+    \r is shown as U+240D, so that the text has the same lines as the index.
+
+    The index can be built in the background with start_indexing().  Until
+    it's done, only the lines of the indexed part of the file can be
+    addressed.
+
+    The file mustn't be truncated while it's mapped.
+    '''
+    BLOCK_SIZE = 64 * 1024
+    # Blocks indexed in the background between updates of the main thread
+    INDEX_BATCH = 256
+    # Bytes searched at a time, backwards
+    SEARCH_CHUNK = 1024 * 1024
+    # Longest regex match which can be found searching backwards
+    MAX_REGEX_SPAN = 4096
+
+    def __init__(self, path:str, encoding:str=None,
+            block_size:int=BLOCK_SIZE, index:bool=True) -> None:
+        '''
+        @param index: if False, the index is left empty, for
+          start_indexing() to build
+        @raise IOError: if the file can't be opened or mapped
+        '''
+        self.path = path
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.block_size = block_size
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # Empty files can't be mapped
+            self._data: Union[mmap.mmap, bytes] = b''
+            if self.size:
+                self._data = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+        # block -> newlines before it
+        self._index = array('q')
+        self._newlines = 0
+        self._closed = threading.Event()
+        if index:
+            self._add_blocks(self._count_blocks(0, self.size))
+
+    def close(self) -> None:
+        self._closed.set()
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b''
+
+    @property
+    def indexed(self) -> int:
+        '''
+        The number of bytes of the file indexed so far.
+        '''
+        return min(len(self._index) * self.block_size, self.size)
+
+    @property
+    def complete(self) -> bool:
+        return self.indexed == self.size
+
+    @property
+    def line_count(self) -> int:
+        '''
+        The number of lines, or while indexing, of lines indexed so far.
+        '''
+        # The last line has no newline, and may be empty
+        return self._newlines + 1
+
+    def _count_blocks(self, start:int, end:int) -> List[int]:
+        '''
+        Count the newlines in each block from offset start to end.
+        '''
+        bs = self.block_size
+        data = self._data
+        return [data[i:i + bs].count(b'\n') for i in range(start, end, bs)]
+
+    def _add_blocks(self, counts:List[int]) -> None:
+        newlines = self._newlines
+        for c in counts:
+            self._index.append(newlines)
+            newlines += c
+        self._newlines = newlines
+        if self.complete:
+            log.debug('Indexed {} lines of {}'.format(newlines + 1, self.path))
+
+    def start_indexing(self, dispatch:Dispatch,
+            on_progress:Callable[[], None]) -> threading.Thread:
+        '''
+        Build the index on a worker thread.  It's extended on the main thread
+        via dispatch, a batch of blocks at a time, calling on_progress after
+        each.  Stops if the file is closed.
+        '''
+        def add(counts:List[int]) -> None:
+            if not self._closed.is_set():
+                self._add_blocks(counts)
+                on_progress()
+
+        def run() -> None:
+            step = self.INDEX_BATCH * self.block_size
+            try:
+                for start in range(self.indexed, self.size, step):
+                    if self._closed.is_set():
+                        return
+                    dispatch(functools.partial(add, self._count_blocks(
+                        start, min(start + step, self.size))))
+            except (IOError, ValueError) as e:
+                # ValueError if the map was closed under us
+                log.info("Couldn't index {}: {}".format(self.path, e))
+        t = threading.Thread(target=run, name='large-file-index', daemon=True)
+        t.start()
+        return t
+
+    def line_offset(self, line:int) -> int:
+        '''
+        @return the offset of the start of line, or the end of the indexed
+          part of the file if it's past the end
+        '''
+        if line <= 0:
+            return 0
+        if line >= self.line_count:
+            return self.indexed
+        # Find the newline ending the previous line
+        k = line - 1
+        block = bisect.bisect_right(self._index, k) - 1
+        pos = block * self.block_size
+        for _ in range(k - self._index[block]):
+            pos = self._data.find(b'\n', pos) + 1
+        return self._data.find(b'\n', pos) + 1
+
+    def line_at(self, offset:int) -> int:
+        '''
+        @return the line containing offset, or the last line indexed if
+          offset is past it
+        '''
+        offset = max(0, min(offset, self.indexed))
+        if not self._index:
+            return 0
+        block = min(offset // self.block_size, len(self._index) - 1)
+        start = block * self.block_size
+        return self._index[block] + self._data[start:offset].count(b'\n')
+
+    def position(self, offset:int) -> Tuple[int, int]:
+        '''
+        @return the line and character column of offset
+        '''
+        line = self.line_at(offset)
+        prefix = self._data[self.line_offset(line):offset]
+        return line, len(prefix.decode(self.encoding, errors='replace'))
+
+    def text(self, start:int, end:int, max_bytes:int=None) -> str:
+        '''
+        @return the text of lines start to end (exclusive), with \r\n as
+          \n, and lone \r as U+240D.  Undecodable bytes are replaced.
+        @param max_bytes: read no more than this, cutting the text short
+        '''
+        lo, hi = self.line_offset(start), self.line_offset(end)
+        if max_bytes is not None:
+            hi = min(hi, lo + max_bytes)
+        data = self._data[lo:hi]
+        return data.decode(self.encoding, errors='replace').replace(
+            '\r\n', '\n').replace('\r', '\u240d')
+
+    def find(self, pattern:str, offset:int, backward:bool=False,
+            case_sensitive:bool=False, regex:bool=False
+            ) -> Optional[Tuple[int, int]]:
+        '''
+        Find a pattern, wrapping around at the ends of the file.  Regexes
+        are matched against the raw bytes, and case insensitivity only folds
+        ASCII letters.  Searching backwards, regex matches longer than
+        MAX_REGEX_SPAN may be missed.
+
+        @return the start and end offsets of the first match starting at or
+          after offset (if backward, the last match ending at or before it),
+          or None if there are none.
+        @raise re.error: if regex and pattern isn't a valid one
+        '''
+        needle = pattern.encode(self.encoding, errors='replace')
+        if not needle:
+            return None
+        flags = 0 if case_sensitive else re.I
+        if regex:
+            compiled = re.compile(needle, flags | re.M)
+            span = self.MAX_REGEX_SPAN
+        else:
+            compiled = re.compile(re.escape(needle), flags)
+            span = len(needle)
+        if backward:
+            return self._rsearch(compiled, span, offset) or \
+                self._rsearch(compiled, span, self.size)
+        match = compiled.search(self._data, offset) or \
+            compiled.search(self._data)
+        return match.span() if match else None
+
+    def _rsearch(self, regex:'re.Pattern[bytes]', length:int, end:int
+            ) -> Optional[Tuple[int, int]]:
+        # Chunks overlap by length - 1, so that no match is split; a match
+        # starting in the overlap was already a candidate in the later chunk.
+        limit = end
+        while limit > 0:
+            start = max(0, limit - self.SEARCH_CHUNK)
+            last = None
+            for m in regex.finditer(self._data, start,
+                    min(end, limit + length - 1)):
+                if m.start() < limit:
+                    last = m
+            if last is not None:
+                return last.span()
+            limit = start
+        return None
+
+import shutil
+import tempfile
+import unittest
+from workspace.dispatch import DispatchQueue
+
+class LargeFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'f.txt')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def open(self, content:bytes, **kwargs) -> LargeFile:
+        with open(self.path, 'wb') as f:
+            f.write(content)
+        lf = LargeFile(self.path, encoding='utf-8', **kwargs)
+        self.addCleanup(lf.close)
+        return lf
+
+    def test_lines(self) -> None:
+        lines = ['line {}{}\n'.format(i, 'x' * (i % 7)) for i in range(500)]
+        content = ''.join(lines).encode('utf-8')
+        lf = self.open(content, block_size=16)
+        self.assertEqual(lf.line_count, 501)
+        offset = 0
+        for i, line in enumerate(lines):
+            self.assertEqual(lf.line_offset(i), offset)
+            self.assertEqual(lf.line_at(offset), i)
+            self.assertEqual(lf.line_at(offset + len(line) - 1), i)
+            offset += len(line)
+        self.assertEqual(lf.line_offset(500), len(content))
+        self.assertEqual(lf.line_offset(1000), len(content))
+        self.assertEqual(lf.text(10, 13), ''.join(lines[10:13]))
+        self.assertEqual(lf.text(10, 13, max_bytes=3), lines[10][:3])
+
+    def test_text(self) -> None:
+        lf = self.open('héllo\r\nwörld\xff'.encode('utf-8') + b'\xff')
+        self.assertEqual(lf.line_count, 2)
+        self.assertEqual(lf.text(0, 2), 'héllo\nwörld\xff�')
+        self.assertEqual(lf.position(len('héllo\r\nwö'.encode('utf-8'))),
+            (1, 2))
+
+    def test_lone_cr(self) -> None:
+        lf = self.open(b'a\rb\r\nc\r')
+        self.assertEqual(lf.line_count, 2)
+        self.assertEqual(lf.text(0, 2), 'a\u240db\nc\u240d')
+
+    def test_background_index(self) -> None:
+        lines = ''.join('line {}\n'.format(i) for i in range(500))
+        with open(self.path, 'w') as f:
+            f.write(lines)
+        lf = LargeFile(self.path, encoding='utf-8', block_size=16,
+            index=False)
+        self.addCleanup(lf.close)
+        self.assertEqual(lf.line_count, 1)
+        self.assertEqual(lf.text(0, 1), '')
+        lf.INDEX_BATCH = 4
+        main = DispatchQueue()
+        counts: List[int] = []
+        lf.start_indexing(main.dispatch, lambda: counts.append(lf.line_count))
+        main.run_until(lambda: lf.complete)
+        self.assertEqual(lf.line_count, 501)
+        self.assertEqual(counts, sorted(counts))
+        self.assertGreater(len(counts), 1)
+        self.assertEqual(lf.text(10, 12), 'line 10\nline 11\n')
+
+    def test_empty(self) -> None:
+        lf = self.open(b'')
+        self.assertEqual(lf.line_count, 1)
+        self.assertEqual(lf.line_offset(0), 0)
+        self.assertEqual(lf.line_at(0), 0)
+        self.assertEqual(lf.text(0, 1), '')
+        self.assertIsNone(lf.find('x', 0))
+
+    def test_find(self) -> None:
+        content = b'abc Foo\n' + b'x' * 100 + b'foo\nfo'
+        lf = self.open(content)
+        lf.SEARCH_CHUNK = 7
+        first, second = 4, content.rindex(b'foo')
+        self.assertEqual(lf.find('foo', 0), (first, first + 3))
+        self.assertEqual(lf.find('foo', first + 1), (second, second + 3))
+        # Wraps around
+        self.assertEqual(lf.find('foo', second + 1), (first, first + 3))
+        self.assertEqual(lf.find('foo', len(content), backward=True),
+            (second, second + 3))
+        self.assertEqual(lf.find('foo', second + 2, backward=True),
+            (first, first + 3))
+        self.assertEqual(lf.find('foo', first + 2, backward=True),
+            (second, second + 3))
+        self.assertEqual(lf.find('Foo', 5, case_sensitive=True),
+            (first, first + 3))
+        self.assertIsNone(lf.find('bar', 0))
+        self.assertEqual(lf.find('^f.$', 0, regex=True),
+            (second + 4, second + 6))
+        self.assertEqual(lf.find('a.c', len(content), backward=True,
+            regex=True), (0, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+from gi.repository import Gtk, GtkSource
+import logging
+import re
+from typing import Dict, Optional
+from ui.large_file import LargeFile
+from workspace.dispatch import Dispatch
+
+log = logging.getLogger(__name__)
+
+class LargeFileView(Gtk.VBox):
+    '''
+    A read-only view of a LargeFile.  Only a window of lines around the
+    visible ones is in the buffer; it's moved as the view scrolls, so memory
+    use doesn't grow with the file.
+
+    The scrollbar covers the whole file, by line.  The buffer has no syntax
+    highlighting or undo, and the gutter's line numbers would be relative to
+    the window, so the current line is shown below instead.
+
+    The view can be shown while the file is still being indexed, by
+    start_indexing(); the scrollbar grows as the index does.
+    '''
+    # Lines kept in the buffer either side of the visible ones
+    MARGIN = 500
+    # Lines assumed visible until the view is allocated
+    DEFAULT_PAGE = 50
+    # Most of a window read, in case of very long lines
+    MAX_WINDOW_BYTES = 4 * 1024 * 1024
+
+    def __init__(self,
+            large_file:LargeFile,
+            view_opts:Dict,
+            style_scheme:GtkSource.StyleScheme) -> None:
+        super(LargeFileView, self).__init__()
+        self.file = large_file
+        # Lines first to last (exclusive) are in the buffer
+        self.first = 0
+        self.last = 0
+        self._syncing = False
+        # A line to go to once it's indexed
+        self._pending_line: Optional[int] = None
+
+        self.buffer = GtkSource.Buffer(highlight_syntax=False)
+        self.buffer.set_max_undo_levels(0)
+        self.buffer.set_style_scheme(style_scheme)
+        self._top = self.buffer.create_mark(
+            None, self.buffer.get_start_iter(), True)
+        view_opts = dict(view_opts, **{'show-line-numbers': False})
+        self.src_view = GtkSource.View(**view_opts)
+        self.src_view.set_buffer(self.buffer)
+        self.src_view.set_editable(False)
+
+        self.scroll = Gtk.ScrolledWindow()
+        # Scrolled by our own scrollbar instead
+        self.scroll.set_policy(
+            Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.EXTERNAL)
+        self.scroll.add(self.src_view)
+        self.adjustment = Gtk.Adjustment(value=0, lower=0,
+            upper=large_file.line_count, step_increment=1,
+            page_increment=self.DEFAULT_PAGE, page_size=self.DEFAULT_PAGE)
+        scrollbar = Gtk.Scrollbar(
+            orientation=Gtk.Orientation.VERTICAL, adjustment=self.adjustment)
+        self.status = Gtk.Label(xalign=0.0)
+
+        hbox = Gtk.HBox()
+        hbox.pack_start(self.scroll, expand=True, fill=True, padding=0)
+        hbox.pack_start(scrollbar, expand=False, fill=False, padding=0)
+        self.pack_start(hbox, expand=True, fill=True, padding=0)
+        self.pack_start(self.status, expand=False, fill=False, padding=0)
+
+        self.adjustment.connect('value-changed', self._scrollbar_moved)
+        self.scroll.get_vadjustment().connect(
+            'value-changed', self._view_scrolled)
+        self.scroll.connect('size-allocate', self._resized)
+        self.buffer.connect('notify::cursor-position',
+            lambda *_: self._update_status())
+        self.show_line(0)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def start_indexing(self, dispatch:Dispatch) -> None:
+        '''
+        Index the file in the background, if it isn't already.
+        '''
+        if not self.file.complete:
+            self.file.start_indexing(dispatch, self._index_grew)
+
+    def _index_grew(self) -> None:
+        at_end = self.last >= int(self.adjustment.get_upper())
+        self.adjustment.set_upper(self.file.line_count)
+        if at_end:
+            # The window's last line was cut short at the end of the index
+            top = int(self.adjustment.get_value())
+            self._load_window(top)
+            self.show_line(top)
+        pending = self._pending_line
+        if pending is not None and (
+                pending < self.file.line_count or self.file.complete):
+            self._pending_line = None
+            self.goto_line(pending)
+        self._update_status()
+
+    @property
+    def page(self) -> int:
+        return int(self.adjustment.get_page_size())
+
+    def _resized(self, _widget:Gtk.Widget, alloc:Gtk.Allocation) -> None:
+        _y, height = self.src_view.get_line_yrange(
+            self.buffer.get_start_iter())
+        if height > 0:
+            page = max(1, alloc.height // height)
+            self.adjustment.set_page_size(page)
+            self.adjustment.set_page_increment(page)
+
+    def _load_window(self, line:int) -> None:
+        self.first = max(0, line - self.MARGIN)
+        self.last = min(self.file.line_count, line + self.page + self.MARGIN)
+        self.buffer.set_text(self.file.text(self.first, self.last,
+            max_bytes=self.MAX_WINDOW_BYTES))
+        log.debug('Showing lines {}-{} of {}'.format(
+            self.first, self.last, self.file.path))
+
+    def show_line(self, line:int) -> None:
+        '''
+        Scroll so that line is at the top, moving the window if it's near
+        its edge.
+        '''
+        line = max(0, min(line, self.file.line_count - 1))
+        page = self.page
+        if (line < self.first + page and self.first > 0) or (
+                line + 2 * page > self.last and
+                self.last < self.file.line_count) or (
+                not self.first <= line < self.last):
+            self._load_window(line)
+        self._syncing = True
+        try:
+            self.buffer.move_mark(self._top,
+                self.buffer.get_iter_at_line(line - self.first))
+            self.src_view.scroll_to_mark(self._top, 0.0, True, 0.0, 0.0)
+            self.adjustment.set_value(line)
+        finally:
+            self._syncing = False
+        self._update_status()
+
+    def _scrollbar_moved(self, adj:Gtk.Adjustment) -> None:
+        if not self._syncing:
+            self.show_line(int(adj.get_value()))
+
+    def _view_scrolled(self, vadj:Gtk.Adjustment) -> None:
+        # Scrolled by the mouse wheel or cursor, within the window
+        if self._syncing:
+            return
+        top, _y = self.src_view.get_line_at_y(int(vadj.get_value()))
+        self.show_line(self.first + top.get_line())
+
+    def _update_status(self) -> None:
+        cursor = self.buffer.get_iter_at_mark(self.buffer.get_insert())
+        if self.file.complete:
+            self.status.set_text('Line {} of {} (read only)'.format(
+                self.first + cursor.get_line() + 1, self.file.line_count))
+        else:
+            self.status.set_text('Line {} of {}+ (read only, indexing {}%)'
+                .format(self.first + cursor.get_line() + 1,
+                    self.file.line_count,
+                    100 * self.file.indexed // self.file.size))
+
+    def _iter_at(self, offset:int) -> Gtk.TextIter:
+        line, column = self.file.position(offset)
+        return self.buffer.get_iter_at_line_offset(line - self.first, column)
+
+    def _offset_of(self, it:Gtk.TextIter) -> int:
+        start = self.buffer.get_iter_at_line(it.get_line())
+        prefix = self.buffer.get_text(start, it, False)
+        # Undo LargeFile.text()'s substitution for lone \r
+        prefix = prefix.replace('\u240d', '\r')
+        return (self.file.line_offset(self.first + it.get_line()) +
+            len(prefix.encode(self.file.encoding, errors='replace')))
+
+    def goto_line(self, line:int) -> None:
+        '''
+        Move the cursor to the start of line, counting from 0, and show it.
+        If line isn't indexed yet, this happens once it is.
+        '''
+        if line >= self.file.line_count and not self.file.complete:
+            self._pending_line = line
+            return
+        self.show_line(line - self.page // 2)
+        line = max(0, min(line, self.file.line_count - 1))
+        self.buffer.place_cursor(self.buffer.get_iter_at_line(line - self.first))
+
+    def find(self, pattern:str, move:int, regex:bool=False) -> None:
+        '''
+        Select the next match of pattern in the whole file after the
+        selection (or, if move < 0, the previous one before it).
+        '''
+        bounds = self.buffer.get_selection_bounds()
+        if bounds:
+            start, end = bounds
+        else:
+            start = end = self.buffer.get_iter_at_mark(
+                self.buffer.get_insert())
+        backward = move < 0
+        try:
+            found = self.file.find(pattern,
+                self._offset_of(start if backward else end),
+                backward=backward, regex=regex)
+        except re.error as e:
+            log.info("Bad regex {!r}: {}".format(pattern, e))
+            return
+        if found is None:
+            return
+        line = self.file.line_at(found[0])
+        self.show_line(line - self.page // 2)
+        # The cursor goes at the end, so the next search moves past it
+        self.buffer.select_range(
+            self._iter_at(found[1]), self._iter_at(found[0]))
@@ -6,11 +6,12 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
-from gi.repository import Gdk, GObject, Gtk
+from gi.repository import Gdk, GLib, GObject, Gtk
 import logging
 from ui.edge_view import EdgeView
 from ui.edit_pane import EditPane
 from ui.finder import Finder
+from ui.grep_view import GrepView
 from ui.quick_open import QuickOpen
 from workspace.path import Path
 
@@ -24,9 +25,12 @@ class MainWindow(Gtk.Window):
         self.src_graph = src_graph
         self.edit_pane = EditPane(self, self.workspace, self.src_graph)
         self.finder = None
+        self.grep_view = None
         self.quick_open = QuickOpen(self.workspace)
-        self.outgoing_edges = EdgeView(EdgeView.OUTGOING)
-        self.incoming_edges = EdgeView(EdgeView.INCOMING)
+        self.outgoing_edges = EdgeView(EdgeView.OUTGOING,
+            transitive=self.src_graph.dependencies)
+        self.incoming_edges = EdgeView(EdgeView.INCOMING,
+            transitive=self.src_graph.dependents)
 
         self.accelerators = Gtk.AccelGroup()
         self.add_accel_group(self.accelerators)
@@ -46,7 +50,8 @@ class MainWindow(Gtk.Window):
             self.incoming_edges, expand=True, fill=True, padding=0)
 
         # edit box initially contains the edit pane, and later may add a Finder
-        # (creation of Finder is deferred to avoid it being shown by initial show_all())
+        # and GrepView (creation of which is deferred to avoid them being shown
+        # by initial show_all())
         self.edit_box = Gtk.VBox()
         self.edit_box.pack_start(self.edit_pane, True, True, 0)
 
@@ -82,6 +87,21 @@ class MainWindow(Gtk.Window):
         self.edit_pane.connect('switch-file',
             lambda _w, p: self.incoming_edges.set_current_node(
                 self.src_graph.find_file(p.path)))
+        self.edit_pane.connect('file-saved',
+            lambda _w, p: self.src_graph.file_saved(p.path))
+        self.src_graph.node_listeners.append(self._nodes_changed)
+
+    def _nodes_changed(self, nodes):
+        path = self.edit_pane.get_current_path()
+        for view in [self.outgoing_edges, self.incoming_edges]:
+            if view.cur_node is None and path is not None:
+                # The current file's node may have just been built
+                node = self.src_graph.find_file(path)
+                if node is not None:
+                    view.set_current_node(node)
+            # Any change may affect a transitive view
+            elif view.cur_node in nodes or view.is_transitive:
+                view.refresh()
 
     def _build_menus(self):
         self._build_file_menu()
@@ -98,6 +118,20 @@ class MainWindow(Gtk.Window):
             "activate", self.accelerators, key, mod, Gtk.AccelFlags.VISIBLE)
         find.connect("activate", self.find_handler)
         edit_menu.add(find)
+
+        goto_line = Gtk.MenuItem(label="Go to Line")
+        key, mod = Gtk.accelerator_parse("<Control>l")
+        goto_line.add_accelerator(
+            "activate", self.accelerators, key, mod, Gtk.AccelFlags.VISIBLE)
+        goto_line.connect("activate", self.goto_line_handler)
+        edit_menu.add(goto_line)
+
+        find_in_files = Gtk.MenuItem(label="Find in Files")
+        key, mod = Gtk.accelerator_parse("<Control><Shift>f")
+        find_in_files.add_accelerator(
+            "activate", self.accelerators, key, mod, Gtk.AccelFlags.VISIBLE)
+        find_in_files.connect("activate", self.find_in_files_handler)
+        edit_menu.add(find_in_files)
         
         self.menu_bar.add(edit_menu_item)
     
@@ -164,8 +198,44 @@ class MainWindow(Gtk.Window):
             self.edit_box.pack_start(self.finder, False, False, 0)
             self.finder.connect('dismiss', lambda _: self.finder.hide())
             self.finder.connect('search-changed', 
-                lambda _, s: self.edit_pane.find_handler(s))
-            self.finder.connect('next', lambda _, s: self.edit_pane.find_handler(s, 1))
-            self.finder.connect('prev', lambda _, s: self.edit_pane.find_handler(s, -1))
+                lambda _, s: self.edit_pane.find_handler(
+                    s, regex=self.finder.regex))
+            self.finder.connect('next', lambda _, s:
+                self.edit_pane.find_handler(s, 1, regex=self.finder.regex))
+            self.finder.connect('prev', lambda _, s:
+                self.edit_pane.find_handler(s, -1, regex=self.finder.regex))
+            self.edit_pane.connect('search-count',
+                lambda _, i, n: self.finder.set_count(i, n))
+            self.edit_pane.connect('search-status',
+                lambda _, m: self.finder.set_status(m))
         self.finder.show_all()
         self.finder.entry.grab_focus()
+
+    def goto_line_handler(self, widget:Gtk.Widget)->None:
+        dialog = Gtk.Dialog(title="Go to Line", transient_for=self, modal=True)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        # While the file loads, any line is allowed; it's gone to once loaded
+        count = self.edit_pane.line_count
+        line = Gtk.SpinButton.new_with_range(
+            1, count if count is not None else GLib.MAXINT32, 1)
+        line.set_activates_default(True)
+        dialog.get_content_area().pack_start(line, True, True, 0)
+        dialog.show_all()
+        if dialog.run() == Gtk.ResponseType.OK:
+            self.edit_pane.goto_line(line.get_value_as_int())
+        dialog.destroy()
+
+    def find_in_files_handler(self, widget:Gtk.Widget)->None:
+        if not self.grep_view:
+            self.grep_view = GrepView(self.workspace)
+            self.edit_box.pack_start(self.grep_view, False, False, 0)
+            self.grep_view.connect('dismiss', lambda _: self.grep_view.hide())
+            self.grep_view.connect('location-selected', self._open_location)
+        self.grep_view.show_all()
+        self.grep_view.entry.grab_focus()
+
+    def _open_location(self, _widget:Gtk.Widget, location)->None:
+        self.edit_pane.open_file(location.path)
+        self.edit_pane.goto_line(location.line)
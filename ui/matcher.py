@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Fuzzy matching and ranking of paths, for QuickOpen.
+'''
+
+import heapq
+import math
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+from workspace.path import Path
+
+# Score bonuses for each query character, by where it matched
+BOUNDARY_BONUS = 8
+CONSECUTIVE_BONUS = 6
+BASENAME_BONUS = 4
+# Score bonus for a file's usage, per doubling of its frecency score
+FRECENCY_BONUS = 8
+
+SEPARATORS = frozenset('/_-. ')
+
+def score(query:str, text:str, lower:str, base:int) -> Optional[int]:
+    '''
+    Score a fuzzy match of a lower case query against text, or return None if
+    the query isn't a subsequence of it.
+
+    Matches at the start of path segments, words and camelCase humps score
+    higher, as do runs of consecutive characters and matches in the
+    basename.  Gaps between matched characters, and long paths, score lower.
+
+    @param lower: text.lower()
+    @param base: the index of the start of text's basename
+    '''
+    # Match from the right, to favour the basename
+    positions = []
+    end = len(lower)
+    for c in reversed(query):
+        end = lower.rfind(c, 0, end)
+        if end < 0:
+            return None
+        positions.append(end)
+    res = 0
+    prev = -2
+    for i in reversed(positions):
+        if i == 0 or text[i - 1] in SEPARATORS or (
+                text[i].isupper() and text[i - 1].islower()):
+            res += BOUNDARY_BONUS
+        if i == prev + 1:
+            res += CONSECUTIVE_BONUS
+        if i >= base:
+            res += BASENAME_BONUS
+        prev = i
+    gaps = positions[0] - positions[-1] + 1 - len(query)
+    return res - gaps - len(text) // 16
+
+class Matcher(object):
+    '''
+    Finds the best fuzzy matches for a query among a set of paths, by their
+    Path.shortest.
+
+    Each character maps to a bitmask of the paths containing it, so the
+    candidates for a query are found by and-ing the masks of its
+    characters.  When a query extends the previous one, only the previous
+    matches are candidates.
+    '''
+
+    def __init__(self, paths:Iterable[Path], limit:int=100) -> None:
+        self.limit = limit
+        # id -> (path, text, lower case text, basename start), or None once
+        # removed
+        self._entries: List[Optional[Tuple[Path, str, str, int]]] = []
+        self._ids: Dict[Path, int] = {}
+        self._masks: Dict[str, int] = {}
+        # id -> score bonus
+        self._boosts: Dict[int, float] = {}
+        self._last_query = ''
+        self._last_ids: List[int] = []
+        self.add(paths)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, paths:Iterable[Path]) -> None:
+        '''
+        Add paths to match.  Costs O(n / 64) per character of each new path,
+        for the masks.
+        '''
+        new = sorted((p for p in paths if p not in self._ids),
+            key=lambda p: p.abs)
+        if new:
+            self._add_all(new)
+
+    def remove(self, paths:Iterable[Path]) -> None:
+        '''
+        Stop matching paths.  Their ids aren't reused; once they're half of
+        all ids, the index is rebuilt.
+        '''
+        masks = self._masks
+        for p in paths:
+            id = self._ids.pop(p, None)
+            if id is None:
+                continue
+            entry = self._entries[id]
+            assert entry is not None
+            self._entries[id] = None
+            self._boosts.pop(id, None)
+            keep = ~(1 << id)
+            for c in set(entry[2]):
+                masks[c] &= keep
+        self._last_query = ''
+        if len(self._entries) > 2 * len(self._ids) + 64:
+            live = [e[0] for e in self._entries if e is not None]
+            boosts = {e[0]: self._boosts[id]
+                for id, e in enumerate(self._entries)
+                if e is not None and id in self._boosts}
+            self._entries = []
+            self._ids = {}
+            self._masks = {}
+            self._add_all(live)
+            self._boosts = {self._ids[p]: b for p, b in boosts.items()}
+
+    def _add_all(self, paths:List[Path]) -> None:
+        first = len(self._entries)
+        lowers = []
+        for path in paths:
+            text = path.shortest
+            lower = text.lower()
+            lowers.append(lower)
+            self._ids[path] = len(self._entries)
+            self._entries.append((path, text, lower, text.rfind('/') + 1))
+        # Or-ing bits into big ints one at a time is quadratic, so build each
+        # mask from a string of its bits, highest id first.
+        lowers.reverse()
+        masks = self._masks
+        for c in set().union(*lowers):
+            bits = ''.join(['1' if c in l else '0' for l in lowers])
+            masks[c] = masks.get(c, 0) | (int(bits, 2) << first)
+        self._last_query = ''
+
+    def __contains__(self, path:object) -> bool:
+        return path in self._ids
+
+    def set_usage(self, scores:Dict[Path, float]) -> None:
+        '''
+        Rank files by usage as well, e.g. by Frecency.scores().  A file with
+        usage score s gets a bonus of FRECENCY_BONUS * log2(1 + s).
+        '''
+        self._boosts = {self._ids[p]: FRECENCY_BONUS * math.log2(1 + s)
+            for p, s in scores.items() if p in self._ids}
+
+    def _candidates(self, query:str) -> List[int]:
+        if self._last_query and query.startswith(self._last_query):
+            return self._last_ids
+        mask = -1
+        for c in set(query):
+            mask &= self._masks.get(c, 0)
+            if not mask:
+                return []
+        # Bit i of the mask is char i of the reversed binary string
+        bits = bin(mask)[:1:-1]
+        return [m.start() for m in re.finditer('1', bits)]
+
+    def match(self, query:str) -> List[Path]:
+        '''
+        @return the best matches for query, best first, at most limit
+        '''
+        query = query.lower()
+        if not query:
+            return []
+        entries = self._entries
+        boosts = self._boosts
+        scored = []
+        for id in self._candidates(query):
+            _path, text, lower, base = entries[id] # type: ignore
+            s = score(query, text, lower, base)
+            if s is not None:
+                scored.append((s + boosts.get(id, 0), -id))
+        self._last_query = query
+        self._last_ids = sorted(-id for _s, id in scored)
+        best = heapq.nlargest(self.limit, scored)
+        return [entries[-id][0] for _s, id in best] # type: ignore
+
+import random
+import unittest
+
+class MatcherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.paths = [Path(p, '/ws') for p in [
+            'graph/source_graph.py',
+            'graph/scc.py',
+            'ui/quick_open.py',
+            'ui/edit_pane.py',
+            'workspace/path.py',
+            'docs/SourceGraph.md',
+        ]]
+
+    def names(self, m:Matcher, query:str) -> List[str]:
+        return [p.rel for p in m.match(query)]
+
+    def test_subsequence(self) -> None:
+        m = Matcher(self.paths)
+        self.assertEqual(set(self.names(m, 'qop')), set(['ui/quick_open.py']))
+        self.assertEqual(self.names(m, 'xyz'), [])
+        self.assertEqual(self.names(m, 'POQ'), [])
+
+    def test_ranking(self) -> None:
+        m = Matcher(self.paths)
+        # Boundaries and the basename beat scattered matches
+        self.assertEqual(set(self.names(m, 'sg')[:2]),
+            set(['graph/source_graph.py', 'docs/SourceGraph.md']))
+        self.assertEqual(self.names(m, 'gscc')[0], 'graph/scc.py')
+        self.assertEqual(self.names(m, 'path')[0], 'workspace/path.py')
+        self.assertEqual(self.names(m, 'ep')[0], 'ui/edit_pane.py')
+
+    def test_usage(self) -> None:
+        m = Matcher(self.paths)
+        self.assertNotEqual(self.names(m, 'p')[0], 'ui/edit_pane.py')
+        m.set_usage({self.paths[3]: 3.0, Path('/elsewhere.py', '/ws'): 9.0})
+        self.assertEqual(self.names(m, 'p')[0], 'ui/edit_pane.py')
+        self.assertIn(self.paths[3], m)
+        self.assertNotIn(Path('/elsewhere.py', '/ws'), m)
+
+    def test_limit(self) -> None:
+        m = Matcher(self.paths, limit=2)
+        self.assertEqual(len(m.match('p')), 2)
+
+    def test_add_remove(self) -> None:
+        m = Matcher(self.paths[:3])
+        m.match('s')
+        m.add(self.paths[3:])
+        self.assertEqual(self.names(m, 'sg'),
+            self.names(Matcher(self.paths), 'sg'))
+        m.remove(self.paths[:1] + self.paths[4:])
+        self.assertEqual(len(m), 3)
+        self.assertNotIn(self.paths[0], m)
+        self.assertEqual(self.names(m, 'p'),
+            self.names(Matcher(self.paths[1:4]), 'p'))
+
+    def test_remove_rebuilds(self) -> None:
+        paths = [Path('dir/file{}.py'.format(i), '/ws') for i in range(200)]
+        m = Matcher(paths, limit=1000)
+        m.set_usage({paths[199]: 1.0})
+        m.remove(paths[:150])
+        self.assertEqual(len(m._entries), 50)
+        self.assertEqual(m.match('f'), [paths[199]] + paths[150:199])
+
+    def test_narrowing_matches_fresh(self) -> None:
+        rand = random.Random(5)
+        words = ['graph', 'ui', 'node', 'path', 'scc', 'edit', 'Pane', 'x']
+        paths = [Path('/'.join(rand.choice(words) for _ in range(3)) +
+            '{}.py'.format(i), '/ws') for i in range(300)]
+        m = Matcher(paths, limit=1000)
+        for query in ['', 'g', 'gr', 'grp', 'grpn', 'gr', 'e', 'ep', 'epx']:
+            self.assertEqual(m.match(query), Matcher(paths, 1000).match(query))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,8 @@
 
 from gi.repository import Gtk, GObject
 
-import os.path
+import heapq
+from ui.matcher import Matcher
 from ui.wrappers import UIPath
 from workspace.path import Path
 
@@ -17,6 +18,8 @@ class QuickOpen(Gtk.VBox):
         'path-selected': (GObject.SignalFlags.ACTION, None, (UIPath,))
     }
     
+    MAX_RESULTS = 100
+    
     def __init__(self, workspace):
         super(QuickOpen, self).__init__()
         self.workspace = workspace
@@ -26,30 +29,44 @@ class QuickOpen(Gtk.VBox):
         self.pack_start(self.entry, expand=False, fill=False, padding=0)
         
         self.tree_view = Gtk.TreeView(headers_visible=False)
+        # Only the best matches are shown
         self.list_store = Gtk.ListStore(str)
-        self._add_files_to_store()
-        self.filter = self.list_store.filter_new()
-        self.filter.set_visible_func(self.file_filter)
-        self.tree_view.set_model(self.filter)
+        self.results = []
+        self._add_files_to_matcher()
+        self.tree_view.set_model(self.list_store)
         self.tree_view.append_column(Gtk.TreeViewColumn(
             'Filename', Gtk.CellRendererText(), text=0))
         self.tree_view.connect('row-activated', self.on_activate_row)
         self.pack_start(self.tree_view, expand=True, fill=True, padding=0)
+        self.on_entry_changed(self.entry)
     
-    def _add_files_to_store(self):
-        self.paths = sorted([p for p in self.workspace.files if
-            not os.path.isdir(p.abs)])
-        for i, p in enumerate(self.paths):
-            list_iter = self.list_store.append([p.abbreviate(48)])
+    def _add_files_to_matcher(self):
+        # Dirs can't be opened
+        self.paths = sorted(self.workspace.files - self.workspace.dirs)
+        self.matcher = Matcher(self.paths, limit=self.MAX_RESULTS)
+        self.workspace.file_listeners.append(self.files_changed)
         
-    def file_filter(self, model, iterator, data):
-        search = self.entry.get_text()
-        if not search:
-            return False
-        if search == '*':
-            return True
-        inx, = model.get_path(iterator).get_indices()
-        return search in self.paths[inx].shortest
+    def files_changed(self, removed, added):
+        '''
+        A Workspace file listener.  Keeps the sorted paths and the matcher up
+        to date.
+        '''
+        # One pass over the paths for each, however big the change
+        if removed:
+            self.paths = [p for p in self.paths if p not in removed]
+        added = sorted(p for p in added if p not in self.workspace.dirs)
+        if added:
+            self.paths = list(heapq.merge(self.paths, added))
+        self.matcher.remove(removed)
+        self.matcher.add(added)
+        if self.entry.get_text():
+            self.on_entry_changed(self.entry)
+        
+    def _show_results(self, results):
+        self.results = results
+        self.list_store.clear()
+        for p in results:
+            self.list_store.append([p.abbreviate(48)])
         
     def register_accelerators(self, accel_group):
         key, mod = Gtk.accelerator_parse("<Control>p")
@@ -57,31 +74,44 @@ class QuickOpen(Gtk.VBox):
             "grab-focus", accel_group, key, mod, Gtk.AccelFlags.VISIBLE)
         
     def on_entry_changed(self, widget):
-        self.filter.refilter()
+        search = self.entry.get_text()
+        frecency = self.workspace.frecency
+        if search == '*':
+            self._show_results(self.paths)
+        elif not search:
+            # The most used files
+            self._show_results([p for p in frecency.top(self.MAX_RESULTS)
+                if p in self.matcher])
+        else:
+            self.matcher.set_usage(frecency.scores())
+            self._show_results(self.matcher.match(search))
         
     def on_activate_entry(self, widget):
         self.emit('path-selected', UIPath(Path(
             self.entry.get_text(), self.workspace.root_dir)))
         
     def on_activate_row(self, widget, path, column):
-        inx, = self.filter.convert_path_to_child_path(path).get_indices()
-        self.emit('path-selected', UIPath(self.paths[inx]))
+        inx, = path.get_indices()
+        self.emit('path-selected', UIPath(self.results[inx]))
         
 def sandbox():
     import unittest.mock as mock
+    from workspace.frecency import Frecency
     from workspace.path import Path
     
     win = Gtk.Window()
     ws = mock.MagicMock()
     ws.root_dir = ''
-    ws.files = [Path(p, '.') for p in [
+    ws.frecency = Frecency('/nonexistent/frecency', ws.root_dir)
+    ws.dirs = set()
+    ws.files = set([Path(p, '.') for p in [
         'foo.py', 
         'bar.py', 
         'baz.py', 
         'dir/foobar.py', 
         'dir/inner/coffee.py', 
         'other/bat.py'
-    ]]
+    ]])
     quick_open = QuickOpen(ws)
     quick_open.connect('path-selected', 
         lambda w, f: print('select '+str(f)))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Saves files for the editor on a worker thread, replacing each file
+atomically so that a failed write never leaves it half written.
+'''
+
+import collections
+import functools
+import locale
+import logging
+import os
+import os.path
+import stat
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from workspace.dispatch import Dispatch, DispatchQueue
+
+log = logging.getLogger(__name__)
+
+# Called with the error which stopped a save, or None
+SaveCallback = Callable[[Optional[Exception]], None]
+
+def _get_umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# Read once: it can't be read without setting it, which isn't thread safe
+UMASK = _get_umask()
+
+def write_atomic(path:str, text:str, encoding:str=None) -> None:
+    '''
+    Replace the file at path with text, so that after a crash it holds either
+    the old or the new text.  The text is written to a temporary file beside
+    it, synced, and renamed over it, keeping its permissions.  Symlinks are
+    followed.
+
+    @raise IOError: if it can't be written; the file is then untouched
+    '''
+    encoding = encoding or locale.getpreferredencoding(False)
+    path = os.path.realpath(path)
+    dir_name, base_name = os.path.split(path)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.' + base_name + '.', suffix='.tmp', dir=dir_name)
+    try:
+        with open(fd, 'w', encoding=encoding) as f:
+            f.write(text)
+            f.flush()
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    # Make the rename itself durable, where directories can be synced
+    try:
+        dir_fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+class SaveQueue(object):
+    '''
+    Writes files with write_atomic on a worker thread, in the order they're
+    saved, reporting back via dispatch.
+
+    Saves of a file which is still waiting to be written are coalesced: only
+    the latest text is written, and all of their callbacks get its result.
+    '''
+
+    def __init__(self, dispatch:Dispatch, encoding:str=None) -> None:
+        self.dispatch = dispatch
+        self.encoding = encoding
+        self._lock = threading.Condition()
+        # path -> (latest text, callbacks), in order of first save
+        self._pending: Dict[str, Tuple[str, List[SaveCallback]]] = \
+            collections.OrderedDict()
+        self._writing = False
+        self._thread: Optional[threading.Thread] = None
+
+    def save(self, path:str, text:str, on_done:SaveCallback=None) -> None:
+        '''
+        Queue text to be written to path.  on_done is dispatched once it has
+        been, or has failed to be.
+        '''
+        with self._lock:
+            callbacks = []
+            if path in self._pending:
+                log.debug('Coalescing saves of {}'.format(path))
+                callbacks = self._pending[path][1]
+            if on_done:
+                callbacks.append(on_done)
+            self._pending[path] = (text, callbacks)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='save-queue', daemon=True)
+                self._thread.start()
+            self._lock.notify()
+
+    @property
+    def busy(self) -> bool:
+        with self._lock:
+            return bool(self._pending) or self._writing
+
+    def wait(self, timeout:float=None) -> bool:
+        '''
+        Wait for all queued saves to be written, e.g. before exiting.
+
+        @return whether they were, before the timeout
+        '''
+        with self._lock:
+            return self._lock.wait_for(
+                lambda: not self._pending and not self._writing, timeout)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._pending)
+                path, (text, callbacks) = \
+                    self._pending.popitem(last=False) # type: ignore
+                self._writing = True
+            error: Optional[Exception] = None
+            try:
+                write_atomic(path, text, self.encoding)
+            except (IOError, ValueError) as e:
+                # ValueError covers encoding errors
+                log.warning("Couldn't save {}: {}".format(path, e))
+                error = e
+            for callback in callbacks:
+                self.dispatch(functools.partial(callback, error))
+            with self._lock:
+                self._writing = False
+                self._lock.notify_all()
+
+import shutil
+import unittest
+
+class WriteAtomicTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'f.txt')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def test_replaces(self) -> None:
+        with open(self.path, 'w') as f:
+            f.write('old text, longer than the new')
+        os.chmod(self.path, 0o640)
+        write_atomic(self.path, 'néw', encoding='utf-8')
+        with open(self.path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'néw')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.dir), ['f.txt'])
+
+    def test_follows_symlinks(self) -> None:
+        link = os.path.join(self.dir, 'link')
+        os.symlink(self.path, link)
+        write_atomic(link, 'text')
+        self.assertTrue(os.path.islink(link))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'text')
+
+    def test_failure_leaves_file(self) -> None:
+        with open(self.path, 'w') as f:
+            f.write('old')
+        with self.assertRaises(ValueError):
+            write_atomic(self.path, 'ünïcode', encoding='ascii')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.dir), ['f.txt'])
+
+class SaveQueueTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.main = DispatchQueue()
+        self.saves = SaveQueue(self.main.dispatch, encoding='utf-8')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def run_main(self) -> None:
+        self.assertTrue(self.saves.wait(timeout=5))
+        self.main.run_pending()
+
+    def read(self, name:str) -> str:
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    def test_saves(self) -> None:
+        done: list = []
+        self.saves.save(os.path.join(self.dir, 'a'), 'A', done.append)
+        self.saves.save(os.path.join(self.dir, 'b'), 'B', done.append)
+        self.saves.save(os.path.join(self.dir, 'no', 'c'), 'C', done.append)
+        self.run_main()
+        self.assertEqual(self.read('a'), 'A')
+        self.assertEqual(self.read('b'), 'B')
+        self.assertEqual(done[:2], [None, None])
+        self.assertIsInstance(done[2], IOError)
+        self.assertFalse(self.saves.busy)
+
+    def test_coalesces(self) -> None:
+        path = os.path.join(self.dir, 'a')
+        done: list = []
+        # Hold the worker up, so the saves queue behind it
+        with self.saves._lock:
+            self.saves._writing = True
+            for i in range(5):
+                self.saves.save(path, str(i), done.append)
+            self.assertEqual(len(self.saves._pending), 1)
+            self.saves._writing = False
+        self.run_main()
+        self.assertEqual(self.read('a'), '4')
+        self.assertEqual(done, [None] * 5)
+
+if __name__ == '__main__':
+    unittest.main()
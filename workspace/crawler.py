@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import logging
+import os
+import os.path
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+# Kinds of directory entries
+FILE = 0
+DIR = 1
+LINK_FILE = 2
+LINK_DIR = 3
+
+# Listings modified less than this long (in ns) before they were taken can't
+# be trusted; another change within the mtime granularity would go unnoticed.
+RACY_NS = 2 * 10**9
+
+class DirListing(NamedTuple):
+    mtime: int
+    listed: int
+    entries: List[Tuple[str, int]]
+
+# dir abs path -> listing
+Snapshot = Dict[str, DirListing]
+
+class Crawler(object):
+    '''
+    Lists a directory tree with os.scandir, listing sibling directories in
+    parallel on a thread pool.  Like os.walk, symlinked dirs are not entered.
+    Nor are dirs for which is_excluded(parent dir, name, True) is true.
+
+    Given a snapshot of a previous crawl, directories whose mtime hasn't
+    changed are not re-listed; their snapshot listing is reused.
+    '''
+
+    def __init__(self,
+            is_excluded:Callable[[str, str, bool], bool],
+            snapshot:Snapshot=None,
+            jobs:int=8) -> None:
+        self.is_excluded = is_excluded
+        self.snapshot = snapshot if snapshot is not None else {}
+        self.jobs = jobs
+        # Count of directories actually listed by the last crawl
+        self.listed = 0
+
+    def crawl(self, top:str) -> Snapshot:
+        '''
+        Crawl the tree under top, which should be a real path.  Return the
+        listings of all of the (non-excluded) dirs found.
+        '''
+        res: Snapshot = {}
+        self.listed = 0
+        with ThreadPoolExecutor(self.jobs) as pool:
+            pending: Set[Future] = set([pool.submit(self._list, top)])
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    d, listing, listed = f.result()
+                    if listing is None:
+                        continue
+                    self.listed += listed
+                    res[d] = listing
+                    for name, kind in listing.entries:
+                        if kind == DIR and not self.is_excluded(d, name, True):
+                            pending.add(pool.submit(
+                                self._list, os.path.join(d, name)))
+        return res
+
+    def _list(self, d:str) -> Tuple[str, Optional[DirListing], bool]:
+        try:
+            mtime = os.stat(d).st_mtime_ns
+        except OSError as e:
+            log.info("Couldn't stat {}: {}".format(d, e))
+            return d, None, False
+
+        old = self.snapshot.get(d)
+        if old and old.mtime == mtime and old.listed - mtime > RACY_NS:
+            return d, old, False
+
+        listed = int(time.time() * 1e9)
+        entries = []
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                        is_link = entry.is_symlink()
+                    except OSError:
+                        is_dir = is_link = False
+                    entries.append((entry.name,
+                        (LINK_DIR if is_dir else LINK_FILE) if is_link else
+                        (DIR if is_dir else FILE)))
+        except OSError as e:
+            log.info("Couldn't list {}: {}".format(d, e))
+            return d, None, False
+        return d, DirListing(mtime, listed, entries), True
+
+def load_snapshot(path:str, root:str) -> Snapshot:
+    '''
+    Load a snapshot saved by save_snapshot.  Returns an empty snapshot if none
+    exists, or if it is of a different root.
+    '''
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError) as e:
+        if os.path.exists(path):
+            log.warning("Couldn't load snapshot {}: {}".format(path, e))
+        return {}
+    if data.get('version') != 1 or data.get('root') != root:
+        return {}
+    return {d: DirListing(m, l, [(n, k) for n, k in entries])
+        for d, (m, l, entries) in data['dirs'].items()}
+
+def save_snapshot(path:str, root:str, snapshot:Snapshot) -> None:
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'root': root, 'dirs': snapshot}, f,
+                separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except IOError as e:
+        log.warning("Couldn't save snapshot {}: {}".format(path, e))
+
+import shutil
+import tempfile
+import unittest
+
+class CrawlerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(self.j('a', 'b'))
+        os.makedirs(self.j('.hidden'))
+        os.makedirs(self.j('c'))
+        for f in ['foo', 'a/bar', 'a/b/baz', '.hidden/nope']:
+            open(self.j(f), 'w').close()
+        os.symlink(self.j('a'), self.j('link'))
+        self.age()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def j(self, *parts:str) -> str:
+        return os.path.join(self.dir, *parts)
+
+    def age(self) -> None:
+        'Backdate all dirs so their snapshots are not considered racy'
+        for d, _, _ in os.walk(self.dir):
+            st = os.stat(d)
+            os.utime(d, ns=(st.st_atime_ns, st.st_mtime_ns - 10 * RACY_NS))
+
+    def crawler(self, snapshot:Snapshot=None) -> Crawler:
+        return Crawler(lambda d, n, is_dir: n.startswith('.'), snapshot, jobs=2)
+
+    def test_crawl(self) -> None:
+        res = self.crawler().crawl(self.dir)
+        self.assertEqual(set(res.keys()),
+            {self.dir, self.j('a'), self.j('a', 'b'), self.j('c')})
+        self.assertEqual(sorted(res[self.dir].entries), [
+            ('.hidden', DIR), ('a', DIR), ('c', DIR), ('foo', FILE),
+            ('link', LINK_DIR)])
+        self.assertEqual(res[self.j('a', 'b')].entries, [('baz', FILE)])
+
+    def test_snapshot_reused(self) -> None:
+        c = self.crawler()
+        first = c.crawl(self.dir)
+        self.assertEqual(c.listed, 4)
+        c = self.crawler(first)
+        self.assertEqual(c.crawl(self.dir), first)
+        self.assertEqual(c.listed, 0)
+
+    def test_changed_dir_relisted(self) -> None:
+        first = self.crawler().crawl(self.dir)
+        open(self.j('a', 'new'), 'w').close()
+        st = os.stat(self.j('a'))
+        os.utime(self.j('a'), ns=(st.st_atime_ns, st.st_mtime_ns - 3 * RACY_NS))
+        c = self.crawler(first)
+        res = c.crawl(self.dir)
+        self.assertEqual(c.listed, 1)
+        self.assertIn(('new', FILE), res[self.j('a')].entries)
+
+    def test_racy_dir_relisted(self) -> None:
+        open(self.j('c', 'new'), 'w').close()
+        first = self.crawler().crawl(self.dir)
+        c = self.crawler(first)
+        c.crawl(self.dir)
+        self.assertEqual(c.listed, 1)
+
+    def test_removed_dir(self) -> None:
+        first = self.crawler().crawl(self.dir)
+        shutil.rmtree(self.j('a', 'b'))
+        res = self.crawler(first).crawl(self.dir)
+        self.assertNotIn(self.j('a', 'b'), res)
+
+    def test_save_load(self) -> None:
+        snap = self.crawler().crawl(self.dir)
+        path = self.j('.hidden', 'snap')
+        save_snapshot(path, self.dir, snap)
+        self.assertEqual(load_snapshot(path, self.dir), snap)
+        self.assertEqual(load_snapshot(path, '/elsewhere'), {})
+        self.assertEqual(load_snapshot(self.j('nope'), self.dir), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Handing work from background threads back to the main thread.
+'''
+
+import queue
+from typing import Callable
+
+# Runs a callable on the main thread, eg GLib.idle_add
+Dispatch = Callable[[Callable[[], None]], None]
+
+class DispatchQueue(object):
+    '''
+    Stands in for the main loop in tests: dispatched callables are queued,
+    and run on whichever thread calls run_*.
+    '''
+    def __init__(self) -> None:
+        self._work: queue.Queue = queue.Queue()
+
+    def dispatch(self, fn:Callable[[], None]) -> None:
+        self._work.put(fn)
+
+    def run_one(self, timeout:float=5.0) -> None:
+        '''
+        Wait for the next callable, and run it.
+        '''
+        self._work.get(timeout=timeout)()
+
+    def run_until(self, done:Callable[[], bool], timeout:float=5.0) -> None:
+        '''
+        Run callables as they come, until done() is true.
+        '''
+        while not done():
+            self.run_one(timeout)
+
+    def run_pending(self) -> None:
+        '''
+        Run the callables queued so far, without waiting for more.
+        '''
+        while True:
+            try:
+                fn = self._work.get_nowait()
+            except queue.Empty:
+                return
+            fn()
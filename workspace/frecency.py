@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+import heapq
+import logging
+import math
+import os
+import os.path
+import time
+from typing import Callable, Dict, List
+from workspace.path import Path
+
+log = logging.getLogger(__name__)
+
+# Seconds for an open's weight to halve
+HALF_LIFE = 7 * 24 * 3600
+# Files remembered
+MAX_ENTRIES = 2000
+
+class Frecency(object):
+    '''
+    Scores files by how often and how recently they were opened.  Each open
+    is worth 1 when it happens, halving every half_life seconds.
+
+    Each file's score is kept as its log2 at time 0, which only changes when
+    it's opened, so ranking by it needs no decaying.  Opens are appended to
+    a log file, which is compacted to one line per file (the time of a
+    single open worth its whole score) once it holds twice as many lines as
+    files, keeping only the max_entries best files.
+    '''
+
+    def __init__(self, log_path:str, ws_root:str,
+            half_life:float=HALF_LIFE, max_entries:int=MAX_ENTRIES,
+            clock:Callable[[], float]=time.time) -> None:
+        self.log_path = log_path
+        self.ws_root = ws_root
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self.clock = clock
+        # abs path -> log2 of the score at time 0
+        self._ranks: Dict[str, float] = {}
+        self._log_lines = 0
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.log_path, errors='replace') as f:
+                for line in f:
+                    self._log_lines += 1
+                    try:
+                        t, path = line.rstrip('\n').split('\t', 1)
+                        self._add(path, float(t))
+                    except ValueError:
+                        log.warning('Bad line in {}: {!r}'.format(
+                            self.log_path, line))
+        except FileNotFoundError:
+            pass
+        except IOError as e:
+            log.warning("Couldn't read {}: {}".format(self.log_path, e))
+        if len(self._ranks) > self.max_entries:
+            self.compact()
+
+    def _add(self, abs_path:str, t:float) -> None:
+        rank = t / self.half_life
+        old = self._ranks.get(abs_path)
+        if old is not None:
+            # log2(2^old + 2^rank), without overflowing
+            hi, lo = max(old, rank), min(old, rank)
+            rank = hi + math.log2(1 + 2 ** (lo - hi))
+        self._ranks[abs_path] = rank
+
+    def record(self, path:Path) -> None:
+        '''
+        Record an open of path.
+        '''
+        t = self.clock()
+        self._add(path.abs, t)
+        if not os.path.isdir(os.path.dirname(self.log_path)):
+            # No workspace dir, no saving
+            return
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write('{:.3f}\t{}\n'.format(t, path.abs))
+            self._log_lines += 1
+        except IOError as e:
+            log.warning("Couldn't write {}: {}".format(self.log_path, e))
+        if self._log_lines > 2 * max(len(self._ranks), 100):
+            self.compact()
+
+    def score(self, path:Path) -> float:
+        '''
+        The current score of path: the sum of its opens' decayed weights.
+        '''
+        rank = self._ranks.get(path.abs)
+        if rank is None:
+            return 0.0
+        return 2 ** (rank - self.clock() / self.half_life)
+
+    def scores(self) -> Dict[Path, float]:
+        '''
+        The current scores of all remembered files.
+        '''
+        now = self.clock() / self.half_life
+        return {Path.canonical(p, self.ws_root): 2 ** (r - now)
+            for p, r in self._ranks.items()}
+
+    def top(self, n:int) -> List[Path]:
+        '''
+        @return the n highest scoring files, best first
+        '''
+        best = heapq.nlargest(n, self._ranks.items(), key=lambda i: i[1])
+        return [Path.canonical(p, self.ws_root) for p, _r in best]
+
+    def compact(self) -> None:
+        '''
+        Drop all but the best max_entries files, and rewrite the log with one
+        line for each.
+        '''
+        best = heapq.nlargest(self.max_entries, self._ranks.items(),
+            key=lambda i: i[1])
+        self._ranks = dict(best)
+        if not os.path.isdir(os.path.dirname(self.log_path)):
+            return
+        tmp_path = self.log_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                for p, rank in best:
+                    f.write('{!r}\t{}\n'.format(rank * self.half_life, p))
+            os.replace(tmp_path, self.log_path)
+            self._log_lines = len(best)
+        except IOError as e:
+            log.warning("Couldn't write {}: {}".format(self.log_path, e))
+
+import shutil
+import tempfile
+import unittest
+
+class FrecencyTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.dir, 'frecency')
+        self.now = 1.5e9
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def frecency(self, **kwargs) -> Frecency:
+        return Frecency(self.log_path, '/ws', half_life=100,
+            clock=lambda: self.now, **kwargs)
+
+    def path(self, name:str) -> Path:
+        return Path.canonical('/ws/' + name, '/ws')
+
+    def test_decay(self) -> None:
+        f = self.frecency()
+        f.record(self.path('a'))
+        self.assertAlmostEqual(f.score(self.path('a')), 1)
+        self.now += 100
+        self.assertAlmostEqual(f.score(self.path('a')), 0.5)
+        f.record(self.path('b'))
+        self.assertEqual(f.top(2), [self.path('b'), self.path('a')])
+        f.record(self.path('a'))
+        self.assertEqual(f.top(2), [self.path('a'), self.path('b')])
+        self.assertEqual(f.score(self.path('c')), 0)
+
+    def test_persisted(self) -> None:
+        f = self.frecency()
+        for name in ['a', 'b', 'a']:
+            f.record(self.path(name))
+            self.now += 10
+        g = self.frecency()
+        self.assertEqual(g.scores(), f.scores())
+
+    def test_compaction(self) -> None:
+        f = self.frecency(max_entries=3)
+        for i in range(250):
+            f.record(self.path(str(i % 5)))
+            self.now += 1
+        with open(self.log_path) as log_file:
+            self.assertLessEqual(len(log_file.readlines()), 200)
+        f.compact()
+        with open(self.log_path) as log_file:
+            self.assertEqual(len(log_file.readlines()), 3)
+        g = self.frecency(max_entries=3)
+        self.assertEqual(len(g.top(5)), 3)
+        self.assertEqual(g.top(5), f.top(5))
+        for p, s in f.scores().items():
+            self.assertAlmostEqual(g.scores()[p], s)
+
+    def test_no_workspace_dir(self) -> None:
+        f = Frecency(os.path.join(self.dir, 'nope', 'frecency'), '/ws')
+        f.record(self.path('a'))
+        self.assertEqual(f.top(1), [self.path('a')])
+
+if __name__ == '__main__':
+    unittest.main()
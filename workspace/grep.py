@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Searching the files of a workspace for a pattern.
+'''
+
+import functools
+import locale
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+from typing import (
+    Callable, Iterable, Iterator, List, NamedTuple, Optional, Pattern, Tuple)
+from workspace.dispatch import Dispatch, DispatchQueue
+from workspace.path import Path
+from workspace.workspace import Workspace
+
+log = logging.getLogger(__name__)
+
+# Files with a NUL in their first this many bytes are taken to be binary
+BINARY_SNIFF = 8192
+# Longest line text reported with a match
+MAX_LINE_BYTES = 512
+
+class GrepMatch(NamedTuple):
+    path: Path
+    # Counting from 1
+    line: int
+    # In characters, counting from 0
+    column: int
+    # The line matched, cut short if long
+    text: str
+
+# (regex, literal every match contains, max matches per file, encoding)
+GrepArgs = Tuple[Pattern[bytes], bytes, int, str]
+
+def required_literal(pattern:str) -> str:
+    '''
+    Find a string which every match of a regex must contain, or '' if none
+    is found.  Conservative: alternations, flags and the insides of groups
+    are given up on.
+    '''
+    if '|' in pattern or re.search(r'\(\?[aiLmsux]', pattern):
+        return ''
+    runs: List[str] = []
+    run = ''
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if escaped and not escaped.isalnum() and depth == 0:
+                run += escaped
+                continue
+            # A class like \d, a backreference, or an anchor like \b
+        elif c in '*?{':
+            # The last character is optional, or repeated
+            run = run[:-1]
+            if c == '{':
+                end = pattern.find('}', i)
+                i = end + 1 if end >= 0 else len(pattern)
+            else:
+                i += 1
+        elif c == '+':
+            # The last character is still needed, but may repeat
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if pattern[j:j + 1] == '^':
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            # The first unescaped ']' closes the class
+            while j < len(pattern) and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            i = j + 1
+        elif c in '.^$()':
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            i += 1
+        else:
+            i += 1
+            if depth == 0:
+                run += c
+                continue
+        runs.append(run)
+        run = ''
+    runs.append(run)
+    return max(runs, key=len)
+
+def _scan(data:'mmap.mmap', args:GrepArgs, path:Path) -> List[GrepMatch]:
+    regex, _literal, max_matches, encoding = args
+    res: List[GrepMatch] = []
+    line = 1
+    counted = 0
+    for m in regex.finditer(data):
+        start = m.start()
+        line += data[counted:start].count(b'\n')
+        counted = start
+        line_start = data.rfind(b'\n', 0, start) + 1
+        line_end = data.find(b'\n', start)
+        if line_end < 0:
+            line_end = len(data)
+        text = data[line_start:min(line_end, line_start + MAX_LINE_BYTES)]
+        column = len(data[line_start:start].decode(encoding, errors='replace'))
+        res.append(GrepMatch(path, line, column,
+            text.decode(encoding, errors='replace').rstrip('\r')))
+        if len(res) >= max_matches:
+            break
+    return res
+
+def grep_file(path:Path, args:GrepArgs) -> List[GrepMatch]:
+    '''
+    Find the matches in one file.  Binary and unreadable files have none.
+    '''
+    _regex, literal, _max_matches, _encoding = args
+    try:
+        with open(path.abs, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if literal and data.find(literal) < 0:
+                    return []
+                if data.find(b'\0', 0, BINARY_SNIFF) >= 0:
+                    return []
+                return _scan(data, args, path)
+    except (IOError, ValueError) as e:
+        # ValueError if the file shrank to nothing before it was mapped
+        log.debug("Couldn't search {}: {}".format(path.abs, e))
+        return []
+
+_worker_args: Optional[GrepArgs] = None
+
+def _init_worker(args:GrepArgs) -> None:
+    global _worker_args
+    _worker_args = args
+
+def _grep_in_worker(path:Path) -> List[GrepMatch]:
+    assert _worker_args is not None
+    return grep_file(path, _worker_args)
+
+def workspace_files(ws:Workspace) -> List[Path]:
+    '''
+    The files of a workspace to search: all of them but the excluded ones.
+    '''
+    return sorted(ws.files - ws.dirs, key=lambda p: p.abs)
+
+class Grep(object):
+    '''
+    A search of many files for a pattern, in a pool of processes.  Each file
+    is memory mapped, and skipped unless it contains the longest literal
+    which every match must, before the regex is run over it.
+
+    Patterns are matched against the files' bytes, after encoding, so
+    character classes and case insensitivity only know about ASCII.
+    '''
+    MAX_PER_FILE = 1000
+
+    def __init__(self,
+            pattern:str,
+            regex:bool=False,
+            ignore_case:bool=False,
+            jobs:int=None,
+            max_per_file:int=MAX_PER_FILE,
+            encoding:str=None) -> None:
+        '''
+        @param jobs: processes to search with  [default: one per CPU]
+        @raise re.error: if regex and the pattern isn't a valid one
+        @raise ValueError: if the pattern is empty
+        '''
+        if not pattern:
+            raise ValueError('Empty pattern')
+        encoding = encoding or locale.getpreferredencoding(False)
+        literal = required_literal(pattern) if regex else pattern
+        if ignore_case:
+            # The prefilter is case sensitive
+            literal = ''
+        compiled = re.compile(
+            (pattern if regex else re.escape(pattern)).encode(encoding),
+            re.M | (re.I if ignore_case else 0))
+        self.args: GrepArgs = (
+            compiled, literal.encode(encoding), max_per_file, encoding)
+        self.jobs = jobs or os.cpu_count() or 1
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        '''
+        Stop searching.  Searches in progress stop at the next file.
+        '''
+        self._cancelled.set()
+
+    def search(self, paths:Iterable[Path]) -> Iterator[List[GrepMatch]]:
+        '''
+        Search paths, yielding the matches in each file that has any, in
+        the order the files are finished.
+        '''
+        todo = list(paths)
+        pool = None
+        results: Iterator[List[GrepMatch]]
+        if self.jobs > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(self.jobs,
+                initializer=_init_worker, initargs=(self.args,))
+            chunksize = max(1, min(64, len(todo) // (self.jobs * 8)))
+            results = pool.imap_unordered(_grep_in_worker, todo, chunksize)
+        else:
+            results = (grep_file(p, self.args) for p in todo)
+        try:
+            for res in results:
+                if self.cancelled:
+                    break
+                if res:
+                    yield res
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def start(self,
+            paths:Iterable[Path],
+            dispatch:Dispatch,
+            on_matches:Callable[[List[GrepMatch]], None],
+            on_done:Callable[[], None]) -> threading.Thread:
+        '''
+        Search on a background thread, dispatching each file's matches, and
+        then the end of the search.  Nothing more is dispatched once
+        cancelled, but on_done.
+        '''
+        paths = list(paths)
+        def deliver(res:List[GrepMatch]) -> None:
+            if not self.cancelled:
+                on_matches(res)
+        def run() -> None:
+            for res in self.search(paths):
+                dispatch(functools.partial(deliver, res))
+            dispatch(on_done)
+        t = threading.Thread(target=run, name='grep', daemon=True)
+        t.start()
+        return t
+
+import random
+import shutil
+import tempfile
+import unittest
+
+class RequiredLiteralTest(unittest.TestCase):
+    def test_literals(self) -> None:
+        for pattern, literal in [
+                ('foo', 'foo'),
+                (r'def \w+\(self', '(self'),
+                ('ab?cdef', 'cdef'),
+                ('ab+c', 'ab'),
+                ('x{2,3}yz', 'yz'),
+                ('[abc]+hello.world', 'hello'),
+                ('(abc)?de', 'de'),
+                ('foo|barbaz', ''),
+                ('(?i)foo', ''),
+                (r'a\.b', 'a.b'),
+                (r'[a\]]xy', 'xy'),
+                (r'[\]a]b', 'b'),
+                (r'[^\]\\]+end', 'end'),
+                (r'\d+', ''),
+                ]:
+            self.assertEqual(required_literal(pattern), literal, pattern)
+
+    def test_matches_contain_literal(self) -> None:
+        rand = random.Random(7)
+        pieces = ['a', 'b', 'ab', '.', '?', '*', '+', '(', ')', '[ab]',
+            '{1,2}', '\\.', '^', '$', '\\d', '[a\\]]', '[\\]b]', ']']
+        tried = 0
+        while tried < 300:
+            pattern = ''.join(rand.choice(pieces)
+                for _ in range(rand.randrange(1, 8)))
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                continue
+            tried += 1
+            literal = required_literal(pattern)
+            for _ in range(20):
+                text = ''.join(rand.choice('ab.1]\n')
+                    for _ in range(rand.randrange(12)))
+                if regex.search(text):
+                    self.assertIn(literal, text, pattern)
+
+class GrepTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = os.path.realpath(tempfile.mkdtemp())
+        self.files = {
+            'a.py': 'import os\ndef foo(self):\n    return os.sep\n',
+            'sub/b.txt': 'nothing here\r\nFOO and foo\r\n',
+            'sub/c.bin': 'foo\0\0',
+            'empty': '',
+        }
+        for name, content in self.files.items():
+            path = os.path.join(self.dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', newline='') as f:
+                f.write(content)
+        self.paths = [Path(n, self.dir) for n in sorted(self.files)]
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir)
+
+    def grep(self, pattern:str, **kwargs) -> List[Tuple[str, int, int, str]]:
+        g = Grep(pattern, encoding='utf-8', **kwargs)
+        return sorted((m.path.rel, m.line, m.column, m.text)
+            for res in g.search(self.paths) for m in res)
+
+    def test_literal(self) -> None:
+        self.assertEqual(self.grep('foo', jobs=1), [
+            ('a.py', 2, 4, 'def foo(self):'),
+            ('sub/b.txt', 2, 8, 'FOO and foo'),
+        ])
+        self.assertEqual(self.grep('.', jobs=1), [
+            ('a.py', 3, 13, '    return os.sep'),
+        ])
+
+    def test_regex(self) -> None:
+        self.assertEqual(self.grep(r'^\s*(return|def) ', regex=True), [
+            ('a.py', 2, 0, 'def foo(self):'),
+            ('a.py', 3, 0, '    return os.sep'),
+        ])
+        self.assertEqual(self.grep(r'^foo', regex=True, ignore_case=True,
+            jobs=1), [('sub/b.txt', 2, 0, 'FOO and foo')])
+
+    def test_parallel_matches_serial(self) -> None:
+        for i in range(40):
+            with open(os.path.join(self.dir, 'f{}'.format(i)), 'w') as f:
+                f.write('foo\n' * (i % 3))
+        self.paths = [Path(n, self.dir) for n in os.listdir(self.dir)
+            if n != 'sub']
+        self.assertEqual(self.grep('o', jobs=3), self.grep('o', jobs=1))
+        self.assertEqual(self.grep('o', jobs=1, max_per_file=1),
+            sorted(set(self.grep('o', jobs=2, max_per_file=1))))
+
+    def test_start_and_cancel(self) -> None:
+        main = DispatchQueue()
+        found: list = []
+        done: list = []
+        g = Grep('foo', jobs=1, encoding='utf-8')
+        g.start(self.paths, main.dispatch, found.extend, lambda: done.append(1))
+        main.run_until(lambda: bool(done))
+        self.assertEqual(len(found), 2)
+
+        found.clear()
+        g = Grep('foo', jobs=1)
+        g.cancel()
+        g.start(self.paths, main.dispatch, found.extend, lambda: done.append(2))
+        main.run_until(lambda: done[-1] == 2)
+        self.assertEqual(found, [])
+
+    def test_bad_patterns(self) -> None:
+        with self.assertRaises(re.error):
+            Grep('(', regex=True)
+        with self.assertRaises(ValueError):
+            Grep('')
+
+if __name__ == '__main__':
+    unittest.main()
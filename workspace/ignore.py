@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+import logging
+import os
+import os.path
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern, Tuple
+
+log = logging.getLogger(__name__)
+
+class Rule(NamedTuple):
+    regex: str
+    negate: bool
+    dir_only: bool
+
+def translate(glob:str) -> str:
+    '''
+    Translate a gitignore glob (with any leading '!' and trailing '/' already
+    removed) to a regex matching the paths relative to its base dir.
+    '''
+    i, n = 0, len(glob)
+    res = []
+    while i < n:
+        c = glob[i]
+        if glob.startswith('**', i) and (i == 0 or glob[i - 1] == '/'):
+            if glob[i + 2:i + 3] == '/':
+                # zero or more dirs
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+            if i + 2 == n:
+                # everything inside
+                res.append('.*')
+                i += 2
+                continue
+        if c == '*':
+            while glob.startswith('*', i + 1):
+                i += 1
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if glob[j:j + 1] in ('!', '^'):
+                j += 1
+            if glob[j:j + 1] == ']':
+                j += 1
+            j = glob.find(']', j)
+            if j < 0:
+                res.append(re.escape(c))
+            else:
+                body = glob[i + 1:j].replace('\\', '\\\\')
+                if body[0] in '!^':
+                    res.append('[^/' + body[1:] + ']')
+                else:
+                    res.append('[' + body + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(glob[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+def parse_rule(line:str) -> Optional[Rule]:
+    '''
+    Parse one line of a gitignore file.  Returns None for blanks and comments.
+    '''
+    line = line.rstrip('\n\r')
+    while line.endswith(' ') and not line.endswith('\\ '):
+        line = line[:-1]
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    if '/' in line:
+        # Anchored to the base dir
+        regex = translate(line.lstrip('/'))
+    else:
+        regex = '(?:.*/)?' + translate(line)
+    return Rule(regex, negate, dir_only)
+
+class RuleSet(object):
+    '''
+    The rules of one gitignore file (or equivalent list of patterns), compiled
+    to a single regex each for files and dirs.  As in git, the last matching
+    rule wins.
+    '''
+
+    def __init__(self, lines:Iterable[str]) -> None:
+        rules = [r for r in (parse_rule(l) for l in lines) if r is not None]
+        self._files = self._compile([r for r in rules if not r.dir_only])
+        self._dirs = self._compile(rules)
+
+    def __bool__(self) -> bool:
+        return self._dirs is not None
+
+    @staticmethod
+    def _compile(rules:List[Rule]
+            ) -> Optional[Tuple[Pattern, List[bool]]]:
+        if not rules:
+            return None
+        # Alternation takes the first alternative that matches, so put the
+        # last rule first.  Each rule is the only capturing group of its
+        # alternative, so lastindex identifies the rule that matched.
+        rules = rules[::-1]
+        regex = '|'.join('({})'.format(r.regex) for r in rules)
+        return re.compile(regex, re.DOTALL), [r.negate for r in rules]
+
+    def match(self, rel:str, is_dir:bool) -> Optional[bool]:
+        '''
+        Match a path relative to the rules' base dir.
+        @return True if ignored, False if explicitly not ignored, or None if no
+          rule matched.
+        '''
+        compiled = self._dirs if is_dir else self._files
+        if compiled is None:
+            return None
+        regex, negates = compiled
+        m = regex.fullmatch(rel)
+        if m is None:
+            return None
+        # Each rule is a group, so one of them matched
+        assert m.lastindex is not None
+        return not negates[m.lastindex - 1]
+
+class IgnoreMatcher(object):
+    '''
+    Decides which files under a root dir are ignored, by a list of
+    gitignore-style patterns and optionally the .gitignore files in the tree.
+
+    As in git, the patterns of a deeper .gitignore take precedence, and the
+    given patterns have the lowest precedence.  Also as in git, a path is only
+    checked against the rules, not its parents: callers are expected not to
+    look inside ignored dirs.
+    '''
+
+    def __init__(self, root:str, patterns:List[str],
+            use_gitignore:bool=False) -> None:
+        self.root = os.path.realpath(root)
+        self.use_gitignore = use_gitignore
+        base = RuleSet(patterns)
+        # dir -> [(base dir, rules)], deepest first
+        self._dir_rules: Dict[str, List[Tuple[str, RuleSet]]] = {
+            self.root: self._with_gitignore(self.root,
+                [(self.root, base)] if base else [])}
+
+    def is_ignored(self, dirpath:str, name:str, is_dir:bool) -> bool:
+        '''
+        Check whether the entry name in the (real, absolute) dir dirpath is
+        ignored.
+        '''
+        for base, rules in self._rules(dirpath):
+            if base == dirpath:
+                rel = name
+            else:
+                rel = dirpath[len(base) + 1:] + '/' + name
+            res = rules.match(rel, is_dir)
+            if res is not None:
+                return res
+        return False
+
+    def _rules(self, d:str) -> List[Tuple[str, RuleSet]]:
+        res = self._dir_rules.get(d)
+        if res is None:
+            parent = os.path.dirname(d)
+            if d == self.root or parent == d or not d.startswith(self.root):
+                # Outside the root; nothing applies
+                return []
+            res = self._with_gitignore(d, self._rules(parent))
+            self._dir_rules[d] = res
+        return res
+
+    def _with_gitignore(self, d:str, inherited:List[Tuple[str, RuleSet]]
+            ) -> List[Tuple[str, RuleSet]]:
+        if not self.use_gitignore:
+            return inherited
+        path = os.path.join(d, '.gitignore')
+        try:
+            with open(path, errors='replace') as f:
+                rules = RuleSet(f)
+        except FileNotFoundError:
+            return inherited
+        except IOError as e:
+            log.warning("Couldn't read {}: {}".format(path, e))
+            return inherited
+        if not rules:
+            return inherited
+        return [(d, rules)] + inherited
+
+import shutil
+import tempfile
+import unittest
+
+class RuleSetTest(unittest.TestCase):
+    def assert_matches(self, patterns:List[str], rel:str,
+            expected:Optional[bool], is_dir:bool=False) -> None:
+        self.assertEqual(RuleSet(patterns).match(rel, is_dir), expected,
+            '{} vs {}'.format(patterns, rel))
+
+    def test_basename(self) -> None:
+        self.assert_matches(['foo'], 'foo', True)
+        self.assert_matches(['foo'], 'a/b/foo', True, is_dir=True)
+        self.assert_matches(['foo'], 'foobar', None)
+        self.assert_matches(['foo'], 'foo/bar', None)
+
+    def test_wildcards(self) -> None:
+        self.assert_matches(['*.pyc'], 'a/b.pyc', True)
+        self.assert_matches(['*.pyc'], 'a.pyc/b', None)
+        self.assert_matches(['?.c'], 'a.c', True)
+        self.assert_matches(['?.c'], 'ab.c', None)
+        self.assert_matches(['[ab].c'], 'b.c', True)
+        self.assert_matches(['[!ab].c'], 'b.c', None)
+        self.assert_matches(['[!ab].c'], 'c.c', True)
+        self.assert_matches(['a[.c'], 'a[.c', True)
+
+    def test_anchored(self) -> None:
+        self.assert_matches(['/build'], 'build', True)
+        self.assert_matches(['/build'], 'src/build', None)
+        self.assert_matches(['doc/*.html'], 'doc/a.html', True)
+        self.assert_matches(['doc/*.html'], 'doc/x/a.html', None)
+        self.assert_matches(['doc/*.html'], 'src/doc/a.html', None)
+
+    def test_double_star(self) -> None:
+        self.assert_matches(['**/logs'], 'logs', True)
+        self.assert_matches(['**/logs'], 'a/b/logs', True)
+        self.assert_matches(['a/**/b'], 'a/b', True)
+        self.assert_matches(['a/**/b'], 'a/x/y/b', True)
+        self.assert_matches(['a/**'], 'a/x/y', True)
+        self.assert_matches(['a/**'], 'a', None, is_dir=True)
+
+    def test_dir_only(self) -> None:
+        self.assert_matches(['out/'], 'out', True, is_dir=True)
+        self.assert_matches(['out/'], 'out', None)
+
+    def test_negation_last_wins(self) -> None:
+        self.assert_matches(['*.log', '!keep.log'], 'keep.log', False)
+        self.assert_matches(['*.log', '!keep.log'], 'other.log', True)
+        self.assert_matches(['!keep.log', '*.log'], 'keep.log', True)
+
+    def test_comments_and_escapes(self) -> None:
+        self.assertFalse(RuleSet(['# comment', '', '   ']))
+        self.assert_matches(['\\#foo'], '#foo', True)
+        self.assert_matches(['\\!foo'], '!foo', True)
+        self.assert_matches(['foo  '], 'foo', True)
+        self.assert_matches(['foo\\ '], 'foo ', True)
+
+class IgnoreMatcherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root, 'sub', 'deeper'))
+        self.write('.gitignore', '*.o\n/build/\n')
+        self.write('sub/.gitignore', '!keep.o\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    def write(self, rel:str, text:str) -> None:
+        with open(os.path.join(self.root, rel), 'w') as f:
+            f.write(text)
+
+    def ignored(self, m:IgnoreMatcher, rel:str, is_dir:bool=False) -> bool:
+        d, name = os.path.split(os.path.join(self.root, rel))
+        return m.is_ignored(d, name, is_dir)
+
+    def test_patterns_only(self) -> None:
+        m = IgnoreMatcher(self.root, ['node_modules'])
+        self.assertTrue(self.ignored(m, 'sub/node_modules', True))
+        self.assertFalse(self.ignored(m, 'a.o'))
+
+    def test_gitignore(self) -> None:
+        m = IgnoreMatcher(self.root, [], use_gitignore=True)
+        self.assertTrue(self.ignored(m, 'a.o'))
+        self.assertTrue(self.ignored(m, 'sub/deeper/a.o'))
+        self.assertTrue(self.ignored(m, 'build', True))
+        self.assertFalse(self.ignored(m, 'sub/build', True))
+        self.assertFalse(self.ignored(m, 'a.c'))
+
+    def test_deeper_gitignore_wins(self) -> None:
+        m = IgnoreMatcher(self.root, [], use_gitignore=True)
+        self.assertFalse(self.ignored(m, 'sub/keep.o'))
+        self.assertFalse(self.ignored(m, 'sub/deeper/keep.o'))
+        self.assertTrue(self.ignored(m, 'keep.o'))
+
+    def test_gitignore_over_patterns(self) -> None:
+        m = IgnoreMatcher(self.root, ['*.c', 'keep.o'], use_gitignore=True)
+        self.assertTrue(self.ignored(m, 'sub/a.c'))
+        self.assertFalse(self.ignored(m, 'sub/keep.o'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+import os.path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from workspace.path import Path
+
+class ModuleMap(object):
+    '''
+    Maps dotted python module names to the source files of the modules found
+    under a list of root dirs, as if those roots were on sys.path.  Packages
+    map to their __init__.py.  Where a name exists under several roots, the
+    earliest root wins.
+
+    Built from, and kept up to date with, a workspace's file list; no
+    filesystem access is needed.
+    '''
+
+    def __init__(self, roots:List[str]) -> None:
+        self.roots = [os.path.realpath(r) for r in roots]
+        # abs paths of all python sources in the workspace
+        self._sources: Set[str] = set()
+        # name -> {root index -> abs path}
+        self._modules: Dict[str, Dict[int, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._modules)
+
+    def find(self, name:str) -> Optional[str]:
+        '''
+        Return the absolute path of the source of the given module, or None if
+        the module isn't in the workspace.
+        '''
+        candidates = self._modules.get(name)
+        if not candidates:
+            return None
+        return candidates[min(candidates)]
+
+    def files_changed(self, removed:Set[Path], added:Set[Path]) -> None:
+        '''
+        A Workspace file listener.
+        '''
+        removed_src = set(p.abs for p in removed if p.abs.endswith('.py'))
+        added_src = set(p.abs for p in added if p.abs.endswith('.py'))
+        self._sources.difference_update(removed_src)
+        self._sources.update(added_src)
+
+        if any(os.path.basename(p) == '__init__.py'
+                for p in removed_src | added_src):
+            # Packages appeared or disappeared, which can change the names of
+            # whole subtrees.
+            self._rebuild()
+            return
+
+        for abs_path in removed_src:
+            for name, root_inx in self._names(abs_path):
+                candidates = self._modules.get(name, {})
+                if candidates.get(root_inx) == abs_path:
+                    del candidates[root_inx]
+                    if not candidates:
+                        del self._modules[name]
+        self._add(added_src)
+
+    def _rebuild(self) -> None:
+        self._modules = {}
+        self._add(self._sources)
+
+    def _add(self, sources:Iterable[str]) -> None:
+        for abs_path in sources:
+            for name, root_inx in self._names(abs_path):
+                self._modules.setdefault(name, {})[root_inx] = abs_path
+
+    def _names(self, abs_path:str) -> List[Tuple[str, int]]:
+        '''
+        Find the module names of the given source under each root.
+        '''
+        res = []
+        for root_inx, root in enumerate(self.roots):
+            if not abs_path.startswith(root + os.sep):
+                continue
+            parts = abs_path[len(root) + 1:-len('.py')].split(os.sep)
+            if parts[-1] == '__init__':
+                parts.pop()
+            if not parts or not all(p.isidentifier() for p in parts):
+                continue
+            # All containing directories must be packages
+            if all(os.path.join(root, *parts[:i + 1], '__init__.py')
+                    in self._sources for i in range(len(parts) - 1)):
+                res.append(('.'.join(parts), root_inx))
+        return res
+
+import unittest
+
+class ModuleMapTest(unittest.TestCase):
+    def paths(self, *names:str) -> Set[Path]:
+        return set(Path(n, '/ws') for n in names)
+
+    def test_modules(self) -> None:
+        m = ModuleMap(['/ws'])
+        m.files_changed(set(), self.paths('foo.py', 'pkg/__init__.py',
+            'pkg/bar.py', 'pkg/sub/__init__.py', 'pkg/sub/baz.py', 'README'))
+        self.assertEqual(m.find('foo'), '/ws/foo.py')
+        self.assertEqual(m.find('pkg'), '/ws/pkg/__init__.py')
+        self.assertEqual(m.find('pkg.bar'), '/ws/pkg/bar.py')
+        self.assertEqual(m.find('pkg.sub.baz'), '/ws/pkg/sub/baz.py')
+        self.assertIsNone(m.find('README'))
+        self.assertEqual(len(m), 5)
+
+    def test_not_a_package(self) -> None:
+        m = ModuleMap(['/ws'])
+        m.files_changed(set(), self.paths('dir/foo.py', 'bad-name.py'))
+        self.assertEqual(len(m), 0)
+
+    def test_package_added_and_removed(self) -> None:
+        m = ModuleMap(['/ws'])
+        m.files_changed(set(), self.paths('dir/foo.py'))
+        self.assertIsNone(m.find('dir.foo'))
+        m.files_changed(set(), self.paths('dir/__init__.py'))
+        self.assertEqual(m.find('dir.foo'), '/ws/dir/foo.py')
+        m.files_changed(self.paths('dir/__init__.py'), set())
+        self.assertIsNone(m.find('dir.foo'))
+
+    def test_module_removed(self) -> None:
+        m = ModuleMap(['/ws'])
+        m.files_changed(set(), self.paths('foo.py', 'bar.py'))
+        m.files_changed(self.paths('foo.py'), set())
+        self.assertIsNone(m.find('foo'))
+        self.assertEqual(m.find('bar'), '/ws/bar.py')
+
+    def test_root_precedence(self) -> None:
+        m = ModuleMap(['/ws/src', '/ws'])
+        m.files_changed(set(), self.paths('src/foo.py', 'foo.py'))
+        self.assertEqual(m.find('foo'), '/ws/src/foo.py')
+        m.files_changed(self.paths('src/foo.py'), set())
+        self.assertEqual(m.find('foo'), '/ws/foo.py')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,28 +7,62 @@
 # (at your option) any later version.
 
 import os.path
-from typing import Any
+from typing import Any, Dict, Optional, Tuple
+import weakref
 
 class Path(object):
     '''
     Represents a particular location in the filesystem.  Also knows where the
     workspace root is, enabling useful abs-relative transformations, etc.
+
+    Paths are interned: constructing a Path equal to one which is still alive
+    returns that same object.  So they must be treated as immutable.
     '''
+    __slots__ = ('abs', 'ws_root', '_rel', '_abbrev', '__weakref__')
 
-    def __init__(self, path:str, ws_root:str) -> None:
-        super(Path, self).__init__()
-        if os.path.isabs(path):
-            self.abs = os.path.realpath(path)
-        else:
-            self.abs = os.path.realpath(os.path.join(ws_root, path))
-        self.ws_root = ws_root
+    # ws_root -> abs -> Path
+    _interned: Dict[str, 'weakref.WeakValueDictionary[str, Path]'] = {}
+
+    abs: str
+    ws_root: str
+    _rel: Optional[str]
+    # (max_len, require_basename, result) of the last abbreviate()
+    _abbrev: Optional[Tuple[int, bool, str]]
+
+    def __new__(cls, path:str, ws_root:str) -> 'Path':
+        if not os.path.isabs(path):
+            path = os.path.join(ws_root, path)
+        return cls.canonical(os.path.realpath(path), ws_root)
+
+    @classmethod
+    def canonical(cls, abs_path:str, ws_root:str) -> 'Path':
+        '''
+        Construct a Path from a path which is already absolute and real (ie,
+        as returned by os.path.realpath), skipping the filesystem lookups.
+        '''
+        interned = cls._interned.get(ws_root)
+        if interned is None:
+            interned = cls._interned.setdefault(
+                ws_root, weakref.WeakValueDictionary())
+        res = interned.get(abs_path)
+        if res is None:
+            res = object.__new__(cls)
+            res.abs = abs_path
+            res.ws_root = ws_root
+            res._rel = None
+            res._abbrev = None
+            res = interned.setdefault(abs_path, res)
+        return res
+
+    def __reduce__(self) -> Tuple[Any, Tuple[str, str]]:
+        return (Path.canonical, (self.abs, self.ws_root))
 
     def __repr__(self) -> str:
         return 'Path({!r}, {!r})'.format(self.rel, self.ws_root)
 
     def __eq__(self, other: Any) -> bool:
-        return isinstance(other, Path) and \
-            (self.abs, self.ws_root) == (other.abs, other.ws_root)
+        return self is other or (isinstance(other, Path) and
+            (self.abs, self.ws_root) == (other.abs, other.ws_root))
 
     def __ge__(self, other: Any) -> bool:
         return self.abs >= other.abs
@@ -46,15 +80,19 @@ class Path(object):
         return not self.__ge__(other)
 
     def __hash__(self) -> int:
-        return hash((self.abs, self.ws_root))
+        # Cheap, since strs cache their hashes
+        return hash(self.abs)
 
     @property
     def rel(self) -> str:
-        return os.path.relpath(self.abs, self.ws_root)
+        if self._rel is None:
+            self._rel = os.path.relpath(self.abs, self.ws_root)
+        return self._rel
 
     @property
     def shortest(self) -> str:
-        return self.rel if len(self.rel) < len(self.abs) else self.abs
+        rel = self.rel
+        return rel if len(rel) < len(self.abs) else self.abs
 
     @property
     def in_workspace(self) -> bool:
@@ -62,7 +100,7 @@ class Path(object):
 
     @property
     def basename(self) -> str:
-        return os.path.basename(self.abs)
+        return self.abs[self.abs.rfind(os.sep) + 1:]
 
     @property
     def isdir(self) -> bool:
@@ -77,6 +115,14 @@ class Path(object):
         respected.
         '''
         assert max_len >= 16
+        cached = self._abbrev
+        if cached and cached[0] == max_len and cached[1] == require_basename:
+            return cached[2]
+        res = self._abbreviate(max_len, require_basename)
+        self._abbrev = (max_len, require_basename, res)
+        return res
+
+    def _abbreviate(self, max_len:int, require_basename:bool) -> str:
         res = self.shortest
         if len(res) <= max_len:
             return res
@@ -115,5 +161,31 @@ class PathTest(unittest.TestCase):
         self.assertEqual(p.abbreviate(max_len=16),
             '..this_is_a_very_long_basename')
 
+    def test_interned(self) -> None:
+        p = Path('/foo/bar', '/foo')
+        self.assertIs(Path('bar', '/foo'), p)
+        self.assertIs(Path.canonical('/foo/bar', '/foo'), p)
+        other = Path('/foo/bar', '/')
+        self.assertIsNot(other, p)
+        self.assertNotEqual(other, p)
+
+    def test_cached_properties(self) -> None:
+        p = Path('/foo/bar/baz', '/foo')
+        self.assertEqual(p.rel, 'bar/baz')
+        self.assertEqual(p.basename, 'baz')
+        self.assertEqual(p.shortest, 'bar/baz')
+        self.assertEqual(p.abbreviate(16), 'bar/baz')
+        self.assertEqual(Path('/', '/foo').basename, '')
+
+    def test_slots(self) -> None:
+        p = Path('/foo/bar', '/foo')
+        with self.assertRaises(AttributeError):
+            p.extra = 1 # type: ignore
+
+    def test_pickle(self) -> None:
+        import pickle
+        p = Path('/foo/bar', '/foo')
+        self.assertIs(pickle.loads(pickle.dumps(p)), p)
+
 if __name__ == '__main__':
     unittest.main()
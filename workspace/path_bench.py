@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+'''
+Compares the memory and time costs of workspace.path.Path against the
+original dict-based implementation.  Run as:
+    python3 -m workspace.path_bench [--count N]
+'''
+
+import argparse
+import gc
+import os.path
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, List, Tuple
+
+from workspace.path import Path
+
+class LegacyPath(object):
+    '''
+    Path as it was before interning and caching, for comparison.
+    '''
+
+    def __init__(self, path:str, ws_root:str) -> None:
+        if os.path.isabs(path):
+            self.abs = os.path.realpath(path)
+        else:
+            self.abs = os.path.realpath(os.path.join(ws_root, path))
+        self.ws_root = ws_root
+
+    def __eq__(self, other:Any) -> bool:
+        return isinstance(other, LegacyPath) and \
+            (self.abs, self.ws_root) == (other.abs, other.ws_root)
+
+    def __hash__(self) -> int:
+        return hash((self.abs, self.ws_root))
+
+    @property
+    def rel(self) -> str:
+        return os.path.relpath(self.abs, self.ws_root)
+
+    @property
+    def shortest(self) -> str:
+        return self.rel if len(self.rel) < len(self.abs) else self.abs
+
+    @property
+    def basename(self) -> str:
+        return os.path.basename(self.abs)
+
+    def abbreviate(self, max_len:int=32) -> str:
+        res = self.shortest
+        if len(res) <= max_len:
+            return res
+        suffix_count = max(int(max_len * 2 / 3), len(os.path.basename(res)))
+        prefix_count = max(max_len - suffix_count - 2, 0)
+        return res[:prefix_count] + '..' + res[-suffix_count:]
+
+def make_names(count:int, root:str) -> List[str]:
+    '''
+    Paths shaped like a source tree: 20 files per dir, 3 levels deep.
+    '''
+    return [os.path.join(root, 'pkg{}'.format(i // 8000),
+        'module_dir{}'.format(i // 400), 'sub{}'.format(i // 20),
+        'source_file_{}.py'.format(i)) for i in range(count)]
+
+def measure(fn:Callable[[], Any]) -> Tuple[float, int, Any]:
+    '''
+    @return (seconds, bytes allocated and still live, result)
+    '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = fn()
+    elapsed = time.perf_counter() - start
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, size, res
+
+def bench(label:str, make:Callable[[str, str], Any], names:List[str],
+        root:str) -> None:
+    elapsed, size, paths = measure(lambda: [make(n, root) for n in names])
+    print('{:<16} construct: {:7.3f}s {:8.1f} MB ({} B/path)'.format(
+        label, elapsed, size / 2**20, size // len(names)))
+
+    for prop in ['rel', 'basename', 'shortest']:
+        start = time.perf_counter()
+        for _ in range(3):
+            for p in paths:
+                getattr(p, prop)
+        print('{:<16} 3x {:<8} {:7.3f}s'.format(
+            label, prop + ':', time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for _ in range(3):
+        for p in paths:
+            p.abbreviate(48)
+    print('{:<16} 3x abbrev:   {:7.3f}s'.format(
+        label, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    s = set(paths)
+    for p in paths:
+        p in s
+    print('{:<16} set ops:     {:7.3f}s'.format(
+        label, time.perf_counter() - start))
+
+    # A second, equal set of paths, as when the graph and the file list both
+    # hold the same files.
+    elapsed, size, dups = measure(lambda: [make(n, root) for n in names])
+    print('{:<16} duplicates:  {:7.3f}s {:8.1f} MB'.format(
+        label, elapsed, size / 2**20))
+
+def main(argv:List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', '-n', type=int, default=200000)
+    args = parser.parse_args(argv)
+
+    # A root which doesn't exist keeps realpath from hitting real files
+    root = '/nonexistent/path_bench/workspace'
+    names = make_names(args.count, root)
+    print('{} paths'.format(len(names)))
+    bench('LegacyPath', LegacyPath, names, root)
+    bench('Path', Path, names, root)
+    bench('Path.canonical', Path.canonical, names, root)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
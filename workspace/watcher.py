@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# Copyright 2018 Iain Peet
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import struct
+from typing import Any, Dict, Optional, Set
+
+from workspace.path import Path
+from workspace.workspace import Workspace
+
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event, less the trailing name
+_EVENT = struct.Struct('iIII')
+
+def _load_libc() -> Optional[Any]:
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+class InotifyWatcher(object):
+    '''
+    Watches the directories of a workspace with Linux inotify, and applies
+    created, deleted and moved files to Workspace.files as they happen.  If the
+    kernel's event queue overflows, falls back to a full reload.
+
+    Events are read when process_events() is called; fileno() becomes readable
+    when there are events to process.
+    '''
+    WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    _libc: Optional[Any] = None
+
+    @classmethod
+    def create(cls, workspace:Workspace) -> Optional['InotifyWatcher']:
+        '''
+        Create a watcher for the given workspace, or return None if
+        inotify is unavailable.
+        '''
+        try:
+            return cls(workspace)
+        except OSError as e:
+            log.warning("Can't watch workspace files: {}".format(e))
+            return None
+
+    def __init__(self, workspace:Workspace) -> None:
+        if InotifyWatcher._libc is None:
+            InotifyWatcher._libc = _load_libc()
+        if InotifyWatcher._libc is None:
+            raise OSError('inotify is not available')
+        self.libc = InotifyWatcher._libc
+        self.workspace = workspace
+        self._wd_to_dir: Dict[int, str] = {}
+        self._dir_to_wd: Dict[str, int] = {}
+        # Dir -> its watched subdirs
+        self._subdirs: Dict[str, Set[str]] = {}
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno('inotify_init1')
+        try:
+            self._watch_all()
+        except:
+            self.close()
+            raise
+        self.workspace.file_listeners.append(self.files_changed)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self) -> None:
+        if self.files_changed in self.workspace.file_listeners:
+            self.workspace.file_listeners.remove(self.files_changed)
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def process_events(self) -> None:
+        '''
+        Read all pending events, and apply them to the workspace.
+        '''
+        removed: Set[Path] = set()
+        added: Set[Path] = set()
+        added_dirs: Set[Path] = set()
+        # Dirs deleted or moved away, whose files are found once per batch
+        gone_dirs: Set[str] = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, name_len = _EVENT.unpack_from(buf, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(buf[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                if mask & IN_Q_OVERFLOW:
+                    self._overflow()
+                    # Everything up to now is covered by the reload
+                    removed, added, added_dirs = set(), set(), set()
+                    gone_dirs = set()
+                else:
+                    self._handle_event(
+                        wd, mask, name, removed, added, added_dirs, gone_dirs)
+
+        if gone_dirs:
+            # Files added since are in added, not gone
+            removed.update(p for p in self.workspace.files
+                if os.path.dirname(p.abs) in gone_dirs and p not in added)
+        self.workspace.apply_file_changes(removed, added, added_dirs)
+
+    def _handle_event(self, wd:int, mask:int, name:str,
+            removed:Set[Path], added:Set[Path], added_dirs:Set[Path],
+            gone_dirs:Set[str]) -> None:
+        if mask & IN_IGNORED:
+            # Watch was removed, either by us or because the dir is gone
+            d = self._wd_to_dir.pop(wd, None)
+            if d is not None:
+                self._forget(d)
+            return
+
+        parent = self._wd_to_dir.get(wd)
+        if parent is None or not name or self.workspace.is_excluded(
+                parent, name, bool(mask & IN_ISDIR)):
+            return
+        abs_path = os.path.join(parent, name)
+        path = Path(abs_path, self.workspace.root_dir)
+
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            new = set([path])
+            if mask & IN_ISDIR:
+                # Files may have been created before we could watch the dir
+                self._watch(abs_path)
+                files, dirs = self.workspace.scan(abs_path)
+                new.update(files)
+                for p in dirs:
+                    self._watch(p.abs)
+                added_dirs.add(path)
+                added_dirs.update(dirs)
+            removed.difference_update(new)
+            added.update(new)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if mask & IN_ISDIR:
+                tree = self._watched_tree(abs_path)
+                # A moved dir's watches would follow it out of the workspace
+                for d in tree:
+                    self._unwatch(d)
+                gone_dirs.update(tree)
+                # Files added earlier in the batch are gone too
+                for p in [p for p in added
+                        if os.path.dirname(p.abs) in tree]:
+                    added.discard(p)
+                    removed.add(p)
+            if path in added:
+                added.discard(path)
+            else:
+                removed.add(path)
+
+    def files_changed(self, removed:Set[Path], added:Set[Path]) -> None:
+        '''
+        A Workspace file listener.  Watches the dirs found by a reload of the
+        file list, such as a background crawl.
+        '''
+        dirs = self.workspace.dirs
+        for p in added:
+            if p in dirs:
+                self._watch(p.abs)
+
+    def _overflow(self) -> None:
+        log.warning('inotify queue overflowed, reloading workspace files')
+        for d in list(self._dir_to_wd):
+            self._unwatch(d)
+        self.workspace.reload_file_list()
+        self._watch_all()
+
+    def _watch_all(self) -> None:
+        self._watch(os.path.realpath(self.workspace.root_dir))
+        for p in self.workspace.dirs:
+            self._watch(p.abs)
+
+    def _watch(self, d:str) -> None:
+        if d in self._dir_to_wd:
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(d), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self._raise_errno('inotify_add_watch (raise '
+                    '/proc/sys/fs/inotify/max_user_watches?)')
+            # The dir may already be gone; its deletion will be seen
+            log.debug("Couldn't watch {}: {}".format(d, os.strerror(err)))
+            return
+        self._wd_to_dir[wd] = d
+        self._dir_to_wd[d] = wd
+        # Parents may be watched after their subdirs
+        self._subdirs.setdefault(os.path.dirname(d), set()).add(d)
+
+    def _unwatch(self, d:str) -> None:
+        wd = self._dir_to_wd.get(d)
+        if wd is not None:
+            # Drop any events still queued for the watch, too
+            del self._wd_to_dir[wd]
+            self._forget(d)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _forget(self, d:str) -> None:
+        self._dir_to_wd.pop(d, None)
+        parent = os.path.dirname(d)
+        siblings = self._subdirs.get(parent)
+        if siblings is not None:
+            siblings.discard(d)
+            if not siblings:
+                del self._subdirs[parent]
+
+    def _watched_tree(self, top:str) -> Set[str]:
+        '''
+        Find top and all the watched dirs under it.
+        '''
+        tree = set([top])
+        todo = [top]
+        while todo:
+            for d in self._subdirs.get(todo.pop(), ()):
+                if d not in tree:
+                    tree.add(d)
+                    todo.append(d)
+        return tree
+
+    def _raise_errno(self, what:str) -> None:
+        err = ctypes.get_errno()
+        raise OSError(err, '{}: {}'.format(what, os.strerror(err)))
+
+import select
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+from workspace.dispatch import DispatchQueue
+
+@unittest.skipIf(_load_libc() is None, 'inotify is not available')
+class InotifyWatcherTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(os.path.join(self.temp_dir, 'dir1'))
+        open(os.path.join(self.temp_dir, 'dir1', 'file1'), 'w').close()
+        self.ws = Workspace(os.path.join(self.temp_dir, '.workspace'))
+        self.listener = mock.MagicMock()
+        self.ws.file_listeners.append(self.listener)
+        self.watcher = InotifyWatcher(self.ws)
+
+    def tearDown(self) -> None:
+        self.watcher.close()
+        shutil.rmtree(self.temp_dir)
+
+    def j(self, *parts:str) -> str:
+        return os.path.join(self.temp_dir, *parts)
+
+    def p(self, *rels:str) -> Set[Path]:
+        return set(Path(r, self.temp_dir) for r in rels)
+
+    def process(self) -> None:
+        select.select([self.watcher], [], [], 1.0)
+        self.watcher.process_events()
+
+    def rel_files(self) -> Set[str]:
+        return set(p.rel for p in self.ws.files)
+
+    def test_create_file(self) -> None:
+        open(self.j('dir1', 'file2'), 'w').close()
+        self.process()
+        self.listener.assert_called_once_with(set(), self.p('dir1/file2'))
+        self.assertEqual(self.rel_files(), {'dir1', 'dir1/file1', 'dir1/file2'})
+
+    def test_delete_file(self) -> None:
+        os.unlink(self.j('dir1', 'file1'))
+        self.process()
+        self.listener.assert_called_once_with(self.p('dir1/file1'), set())
+
+    def test_create_and_delete_coalesced(self) -> None:
+        open(self.j('tmp'), 'w').close()
+        os.unlink(self.j('tmp'))
+        self.process()
+        self.listener.assert_not_called()
+
+    def test_create_dir_tree(self) -> None:
+        os.makedirs(self.j('dir2', 'sub'))
+        open(self.j('dir2', 'sub', 'file'), 'w').close()
+        self.process()
+        self.assertEqual(self.rel_files(), {'dir1', 'dir1/file1', 'dir2',
+            'dir2/sub', 'dir2/sub/file'})
+        # New dirs are watched
+        open(self.j('dir2', 'sub', 'file2'), 'w').close()
+        self.process()
+        self.assertIn('dir2/sub/file2', self.rel_files())
+
+    def test_move_dir_out(self) -> None:
+        outside = tempfile.mkdtemp()
+        try:
+            os.rename(self.j('dir1'), os.path.join(outside, 'dir1'))
+            self.process()
+            self.assertEqual(self.rel_files(), set())
+            # No longer watched
+            open(os.path.join(outside, 'dir1', 'file2'), 'w').close()
+            self.process()
+            self.assertEqual(self.rel_files(), set())
+        finally:
+            shutil.rmtree(outside)
+
+    def test_move_tree_out_and_recreate(self) -> None:
+        os.makedirs(self.j('dir1', 'sub', 'deep'))
+        open(self.j('dir1', 'sub', 'deep', 'file'), 'w').close()
+        self.process()
+        outside = tempfile.mkdtemp()
+        try:
+            os.rename(self.j('dir1'), os.path.join(outside, 'dir1'))
+            os.mkdir(self.j('dir1'))
+            open(self.j('dir1', 'file1'), 'w').close()
+            self.process()
+            self.assertEqual(self.rel_files(), {'dir1', 'dir1/file1'})
+            # The moved subdirs are no longer watched
+            open(os.path.join(outside, 'dir1', 'sub', 'file2'), 'w').close()
+            self.process()
+            self.assertEqual(self.rel_files(), {'dir1', 'dir1/file1'})
+        finally:
+            shutil.rmtree(outside)
+
+    def test_delete_tree(self) -> None:
+        os.makedirs(self.j('dir1', 'sub', 'deep'))
+        open(self.j('dir1', 'sub', 'deep', 'file'), 'w').close()
+        self.process()
+        shutil.rmtree(self.j('dir1'))
+        self.process()
+        self.assertEqual(self.rel_files(), set())
+
+    def test_background_reload(self) -> None:
+        os.makedirs(self.j('dir2', 'sub'))
+        ws = Workspace(os.path.join(self.temp_dir, '.workspace'), crawl=False)
+        watcher = InotifyWatcher(ws)
+        self.addCleanup(watcher.close)
+        main = DispatchQueue()
+        ws.start_reload(main.dispatch)
+        main.run_one()
+        self.assertIn('dir2/sub', set(p.rel for p in ws.files))
+        # Dirs found by the crawl are watched
+        open(self.j('dir2', 'sub', 'file'), 'w').close()
+        select.select([watcher], [], [], 1.0)
+        watcher.process_events()
+        self.assertIn('dir2/sub/file', set(p.rel for p in ws.files))
+
+    def test_rename_file(self) -> None:
+        os.rename(self.j('dir1', 'file1'), self.j('file1'))
+        self.process()
+        self.listener.assert_called_once_with(
+            self.p('dir1/file1'), self.p('file1'))
+
+    def test_excluded(self) -> None:
+        open(self.j('.hidden'), 'w').close()
+        self.process()
+        self.listener.assert_not_called()
+
+    def test_overflow_reloads(self) -> None:
+        with mock.patch.object(self.ws, 'reload_file_list') as reload:
+            self.watcher._overflow()
+            reload.assert_called_once_with()
+        open(self.j('dir1', 'file2'), 'w').close()
+        self.process()
+        self.assertIn('dir1/file2', self.rel_files())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,11 +6,19 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
+import functools
 import json
 import logging
 import os.path
-from typing import Callable, Dict, List, Optional, Set
-
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from workspace.crawler import (
+    Crawler, DIR, LINK_DIR, LINK_FILE, Snapshot, load_snapshot, save_snapshot)
+from workspace.dispatch import Dispatch
+from workspace.frecency import Frecency
+from workspace.ignore import IgnoreMatcher
+from workspace.module_map import ModuleMap
 from workspace.path import Path
 
 log = logging.getLogger(__name__)
@@ -24,9 +32,16 @@ def initialize_workspace(path:str) -> None:
     os.makedirs(path)
 
 class Workspace(object):
-    def __init__(self, workspace_dir:str, must_exist:bool=False) -> None:
+    def __init__(self, workspace_dir:str, must_exist:bool=False,
+            crawl:bool=True) -> None:
+        '''
+        @param crawl: if False, the file list is only read from the snapshot
+          of the last crawl, for start_reload() to bring up to date.
+        '''
         self.workspace_dir = os.path.abspath(workspace_dir)
         self.files: Set[Path] = set()
+        # The subset of files which are dirs
+        self.dirs: Set[Path] = set()
         self.file_listeners: List[Callable[[Set[Path], Set[Path]], None]] = []
         self.config: Dict = {}
 
@@ -34,31 +49,130 @@ class Workspace(object):
             raise Exception('No workspace dir: {}'.format(self.workspace_dir))
 
         self._load_config()
-        self.reload_file_list()
+        # How often and recently files were opened
+        self.frecency = Frecency(
+            os.path.join(self.workspace_dir, 'frecency'), self.root_dir)
+        # python modules in the workspace, by name
+        self.module_map = ModuleMap(self.python_path + [self.root_dir])
+        self.file_listeners.append(self.module_map.files_changed)
+        if crawl:
+            self.reload_file_list()
+        else:
+            self._load_ignore()
+            self._set_file_list(*self._files_from_listings(
+                load_snapshot(self._snapshot_path, self._real_root)))
 
-    def reload_file_list(self) -> None:
-        log.info("Loading workspace file list")
-        root = self.root_dir
-        new_files = set()
+    @property
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.workspace_dir, 'file_snapshot')
 
-        for dirpath, dirnames, filenames in os.walk(root, topdown=True):
-            # don't recurse into hidden dirs
-            for name in list(dirnames):
-                if name.startswith(".") or (name in self.exclude_files):
-                    dirnames.remove(name)
+    @property
+    def _real_root(self) -> str:
+        return os.path.realpath(self.root_dir)
 
-            for name in dirnames + filenames:
-                if name.startswith(".") or (name in self.exclude_files):
-                    continue
-                path = os.path.realpath(os.path.join(dirpath, name))
-                new_files.add(Path(path, root))
+    def _load_ignore(self) -> None:
+        # Picks up any changes to the patterns or .gitignore files
+        self._ignore = IgnoreMatcher(
+            self._real_root, self.exclude_files, self.use_gitignore)
 
+    def reload_file_list(self) -> None:
+        log.info("Loading workspace file list")
+        self._load_ignore()
+        self._set_file_list(*self._crawl())
+
+    def start_reload(self, dispatch:Dispatch) -> threading.Thread:
+        '''
+        Crawl the workspace on a worker thread, and apply the new file list
+        via dispatch.
+        '''
+        log.info("Loading workspace file list in the background")
+        self._load_ignore()
+        def run() -> None:
+            dispatch(functools.partial(self._set_file_list, *self._crawl()))
+        t = threading.Thread(target=run, name='workspace-crawl', daemon=True)
+        t.start()
+        return t
+
+    def _crawl(self) -> Tuple[Set[Path], Set[Path]]:
+        '''
+        List the workspace, re-listing only dirs changed since the snapshot,
+        and save a new snapshot.
+        @return (all files and dirs, just the dirs)
+        '''
+        root = self._real_root
+        snapshot_path = self._snapshot_path
+        crawler = Crawler(self.is_excluded, load_snapshot(snapshot_path, root))
+        listings = crawler.crawl(root)
+        log.info("Listed {} of {} dirs".format(crawler.listed, len(listings)))
+        if crawler.listed and os.path.isdir(self.workspace_dir):
+            save_snapshot(snapshot_path, root, listings)
+        return self._files_from_listings(listings)
+
+    def _set_file_list(self, new_files:Set[Path], dirs:Set[Path]) -> None:
+        self.dirs = dirs
         removed = self.files.difference(new_files)
         added = new_files.difference(self.files)
         self.files = new_files
         for listener in self.file_listeners:
             listener(removed, added)
 
+    def scan(self, top:str) -> Tuple[Set[Path], Set[Path]]:
+        '''
+        List all the non-excluded files and dirs under the given dir.
+        @return (all files and dirs, just the dirs)
+        '''
+        return self._files_from_listings(
+            Crawler(self.is_excluded).crawl(os.path.realpath(top)))
+
+    def _files_from_listings(self, listings:Snapshot
+            ) -> Tuple[Set[Path], Set[Path]]:
+        root = self.root_dir
+        files = set()
+        dirs = set()
+        for dirpath, listing in listings.items():
+            for name, kind in listing.entries:
+                is_dir = kind in (DIR, LINK_DIR)
+                if self.is_excluded(dirpath, name, is_dir):
+                    continue
+                abs_path = os.path.join(dirpath, name)
+                if kind in (LINK_FILE, LINK_DIR):
+                    path = Path(abs_path, root)
+                else:
+                    # dirpath is real, so only symlinks need resolving
+                    path = Path.canonical(abs_path, root)
+                files.add(path)
+                if is_dir:
+                    dirs.add(path)
+        return files, dirs
+
+    def is_excluded(self, dirpath:str, name:str, is_dir:bool) -> bool:
+        '''
+        Check if the entry name in the real dir dirpath is excluded from the
+        workspace.  Excluded dirs' contents should not be looked at.
+        '''
+        return (name.startswith(".") or
+            self._ignore.is_ignored(dirpath, name, is_dir))
+
+    def apply_file_changes(self, removed:Set[Path], added:Set[Path],
+            added_dirs:Set[Path]=None) -> None:
+        '''
+        Incrementally update the file list, notifying listeners of any
+        resulting change.
+        @param added_dirs which of added are dirs.  If not given, they are
+          checked on disk.
+        '''
+        removed = removed & self.files
+        added = added - self.files
+        if not removed and not added:
+            return
+        self.files.difference_update(removed)
+        self.files.update(added)
+        self.dirs.difference_update(removed)
+        self.dirs.update(added_dirs & added if added_dirs is not None else
+            set(p for p in added if p.isdir))
+        for listener in self.file_listeners:
+            listener(removed, added)
+
     def _load_config(self) -> None:
         config_path = os.path.join(self.workspace_dir, 'config')
         try:
@@ -107,10 +221,39 @@ class Workspace(object):
     def python_path(self) -> List[str]:
         return self.config.get('python_path', [])
 
+    @property
+    def watch_files(self) -> bool:
+        return self.config.get('watch_files', True)
+
+    @property
+    def lazy_graph(self) -> bool:
+        '''
+        Whether to parse source files only as they're looked at, rather than
+        all at startup.  Until the background importer index is built, files'
+        incoming edges are incomplete.
+        '''
+        return self.config.get('lazy_graph', False)
+
+    @property
+    def compact_graph(self) -> bool:
+        '''
+        Whether to store the source graph's edges compactly, trading some
+        speed for memory on large workspaces.  The graph takes about half the
+        memory; see graph/adjacency_bench.py.
+        '''
+        return self.config.get('compact_graph', False)
+
     @property
     def exclude_files(self) -> List[str]:
+        '''
+        gitignore-style patterns of files to leave out of the workspace.
+        '''
         return self.config.get('exclude_files', [])
 
+    @property
+    def use_gitignore(self) -> bool:
+        return self.config.get('use_gitignore', False)
+
     @property
     def editor_options(self) -> Dict:
         # populate some defaults:
@@ -125,6 +268,8 @@ class Workspace(object):
             'right-margin-position': 80,
             'show-line-numbers': True,
             'smart-backspace': True,
+            # Bigger files are shown read only, a window at a time
+            'large-file-size': 64 * 1024 * 1024,
         }
         res.update(self.config.get('editor_options', {}))
         return res
@@ -148,6 +293,7 @@ import tempfile
 import unittest
 import unittest.mock as mock
 import shutil
+from workspace.dispatch import DispatchQueue
 
 class WorkspaceTest(unittest.TestCase):
     def setUp(self) -> None:
@@ -181,6 +327,35 @@ class WorkspaceTest(unittest.TestCase):
         w = Workspace(self.alt_ws)
         self.assert_default_files(w)
 
+    def test_dirs(self) -> None:
+        w = Workspace(self.ws)
+        self.assertEqual(set([p.rel for p in w.dirs]), set(['dir1', 'dir2']))
+        w.apply_file_changes(set([Path('dir2', self.temp_dir)]), set())
+        self.assertEqual(set([p.rel for p in w.dirs]), set(['dir1']))
+
+    def test_snapshot(self) -> None:
+        os.mkdir(self.ws)
+        w = Workspace(self.ws)
+        self.assertTrue(os.path.exists(os.path.join(self.ws, 'file_snapshot')))
+        open(os.path.join(self.temp_dir, 'dir1', 'file2'), 'w').close()
+        w = Workspace(self.ws)
+        self.assertIn('dir1/file2', set([p.rel for p in w.files]))
+
+    def test_start_reload(self) -> None:
+        os.mkdir(self.ws)
+        Workspace(self.ws)
+        open(os.path.join(self.temp_dir, 'dir1', 'file2'), 'w').close()
+        # The snapshot's listing is used until the crawl is done
+        w = Workspace(self.ws, crawl=False)
+        self.assert_default_files(w)
+        listener = mock.MagicMock()
+        w.file_listeners.append(listener)
+        main = DispatchQueue()
+        w.start_reload(main.dispatch)
+        main.run_one()
+        listener.assert_called_once_with(
+            set(), set([Path('dir1/file2', self.temp_dir)]))
+
     def test_exclude_files(self) -> None:
         os.mkdir(self.ws)
         with open(os.path.join(self.ws, 'config'), 'w') as f:
@@ -190,6 +365,28 @@ class WorkspaceTest(unittest.TestCase):
             set([p.rel for p in w.files]),
             set([  'foo', 'dir1', 'dir1/file1']))
 
+    def test_exclude_patterns(self) -> None:
+        os.mkdir(self.ws)
+        with open(os.path.join(self.ws, 'config'), 'w') as f:
+            f.write('{"exclude_files": ["/dir*/", "!dir1"]}')
+        w = Workspace(self.ws)
+        self.assertEqual(
+            set([p.rel for p in w.files]),
+            set([  'foo', 'dir1', 'dir1/file1']))
+
+    def test_use_gitignore(self) -> None:
+        os.mkdir(self.ws)
+        with open(os.path.join(self.temp_dir, '.gitignore'), 'w') as f:
+            f.write('file1\n')
+        w = Workspace(self.ws)
+        self.assert_default_files(w)
+        with open(os.path.join(self.ws, 'config'), 'w') as f:
+            f.write('{"use_gitignore": true}')
+        w = Workspace(self.ws)
+        self.assertEqual(
+            set([p.rel for p in w.files]),
+            set([  'foo', 'dir1', 'dir2']))
+
     def test_update(self) -> None:
         w = Workspace(self.ws)
         open(os.path.join(self.temp_dir, 'dir1', 'file2'), 'w').close()
@@ -201,6 +398,36 @@ class WorkspaceTest(unittest.TestCase):
             set([Path('dir2/file1', self.temp_dir)]),
             set([Path('dir1/file2', self.temp_dir)]))
 
+    def test_module_map(self) -> None:
+        open(os.path.join(self.temp_dir, 'dir1', '__init__.py'), 'w').close()
+        w = Workspace(self.ws)
+        self.assertIsNone(w.module_map.find('dir1.mod'))
+        open(os.path.join(self.temp_dir, 'dir1', 'mod.py'), 'w').close()
+        w.reload_file_list()
+        self.assertEqual(w.module_map.find('dir1.mod'),
+            os.path.join(os.path.realpath(self.temp_dir), 'dir1', 'mod.py'))
+
+    def test_apply_file_changes(self) -> None:
+        w = Workspace(self.ws)
+        cb = mock.MagicMock()
+        w.file_listeners.append(cb)
+        w.apply_file_changes(
+            set([Path('foo', self.temp_dir), Path('nope', self.temp_dir)]),
+            set([Path('dir1', self.temp_dir), Path('bar', self.temp_dir)]))
+        cb.assert_called_once_with(
+            set([Path('foo', self.temp_dir)]),
+            set([Path('bar', self.temp_dir)]))
+        self.assertEqual(
+            set([p.rel for p in w.files]),
+            set(['bar', 'dir1', 'dir1/file1', 'dir2', 'dir2/file1']))
+
+    def test_apply_no_file_changes(self) -> None:
+        w = Workspace(self.ws)
+        cb = mock.MagicMock()
+        w.file_listeners.append(cb)
+        w.apply_file_changes(set(), set([Path('foo', self.temp_dir)]))
+        cb.assert_not_called()
+
     def test_hidden_file(self) -> None:
         open(os.path.join(self.temp_dir, '.hidden'), 'w').close()
         w = Workspace(self.ws)
@@ -236,7 +463,7 @@ class WorkspaceTest(unittest.TestCase):
         os.mkdir(self.ws)
         w = Workspace(self.ws)
         opts = w.editor_options
-        self.assertEqual(len(opts), 10)
+        self.assertEqual(len(opts), 11)
         self.assertTrue(opts['auto-indent'])
 
     def test_editor_option_override_defaults(self) -> None:
@@ -245,7 +472,7 @@ class WorkspaceTest(unittest.TestCase):
             json.dump({'editor_options': {'indent-width': 42}}, f)
         w = Workspace(self.ws)
         opts = w.editor_options
-        self.assertEqual(len(opts), 10)
+        self.assertEqual(len(opts), 11)
         self.assertEqual(opts['indent-width'], 42)
 
 if __name__ == '__main__':